@@ -0,0 +1,186 @@
+"""
+Thin client of the chatgpt-cli daemon: asks a question without paying the startup of main.py.
+
+    python ask.py "How do I list the open ports?"
+    python ask.py -c README.md "How do I install it?"
+    git diff | python ask.py
+    python ask.py -s notes
+
+The message is taken from the arguments, or from stdin when it's not a terminal. Without a message
+an interactive session is attached to the daemon. The daemon (python main.py daemon) is started in
+the background when it's not running, and stops by itself when it's left idle.
+
+Only the standard library is imported here, the daemon holds everything else.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+from daemon import SOCKET_NAME, connect, read_message, send_message
+
+WORKDIR = Path(__file__).parent
+SOCKET_FILE = Path(WORKDIR, SOCKET_NAME)
+DAEMON_LOG = Path(WORKDIR, ".daemon.log")
+# Seconds to wait for a daemon being started to listen
+START_TIMEOUT = 30
+START_POLL_INTERVAL = 0.02
+
+
+def start_daemon():
+    """
+    Start the daemon in the background, detached from the terminal, its errors go to the log
+    """
+    import subprocess
+
+    with open(DAEMON_LOG, "ab") as log:
+        return subprocess.Popen(
+            [sys.executable, str(Path(WORKDIR, "main.py")), "daemon"],
+            cwd=WORKDIR,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=log,
+            start_new_session=True,
+        )
+
+
+def connect_daemon(autostart: bool):
+    """
+    Connect to the daemon, starting it first if needed and allowed
+    """
+    try:
+        return connect(SOCKET_FILE)
+    except (FileNotFoundError, ConnectionRefusedError):
+        if not autostart:
+            raise
+
+    process = start_daemon()
+    deadline = time.monotonic() + START_TIMEOUT
+    while True:
+        try:
+            return connect(SOCKET_FILE)
+        except (FileNotFoundError, ConnectionRefusedError):
+            # Another client may have started one at the same time, this one gives up
+            if process.poll() is not None and not SOCKET_FILE.exists():
+                raise SystemExit(f"The daemon failed to start, see {DAEMON_LOG}")
+            if time.monotonic() > deadline:
+                raise SystemExit(f"The daemon didn't start in {START_TIMEOUT}s, see {DAEMON_LOG}")
+            time.sleep(START_POLL_INTERVAL)
+
+
+def ask(rfile, wfile, request: dict) -> bool:
+    """
+    Send a request and write the answer to stdout as it arrives, return False on an error
+    """
+    send_message(wfile, request)
+    ended_with_newline = True
+    while True:
+        event = read_message(rfile)
+        if event is None:
+            print("The daemon closed the connection", file=sys.stderr)
+            return False
+
+        if "text" in event:
+            sys.stdout.write(event["text"])
+            sys.stdout.flush()
+            ended_with_newline = event["text"].endswith("\n")
+        elif "notice" in event:
+            print(event["notice"], file=sys.stderr)
+        elif "error" in event:
+            print(event["error"], file=sys.stderr)
+            return False
+        elif event.get("done"):
+            if not ended_with_newline:
+                sys.stdout.write("\n")
+            return True
+
+
+def attach(rfile, wfile, request: dict) -> None:
+    """
+    Interactive session with the daemon, every message is part of the same conversation
+    """
+    # Line editing and recall of the messages of this session
+    import readline  # noqa: F401
+
+    while True:
+        try:
+            message = input(">>> ")
+        except (EOFError, KeyboardInterrupt):
+            print()
+            return
+
+        if message.lower() in ("/q", ""):
+            return
+        ask(rfile, wfile, dict(request, message=message))
+        print()
+
+
+def main() -> None:
+    # argparse rather than click, it's imported ten times faster
+    parser = argparse.ArgumentParser(description="Ask the chatgpt-cli daemon")
+    parser.add_argument("message", nargs="*", help="Message, read from stdin if not given")
+    parser.add_argument(
+        "-s", "--session", help="Continue a named conversation, or a saved session"
+    )
+    parser.add_argument(
+        "-c",
+        "--context",
+        action="append",
+        default=[],
+        help="Path to a context file, a directory or a glob pattern",
+    )
+    parser.add_argument("-m", "--model", help="Set the model")
+    parser.add_argument(
+        "--no-cache", action="store_true", help="Don't answer from the response cache"
+    )
+    parser.add_argument(
+        "--no-start", action="store_true", help="Fail rather than start the daemon"
+    )
+    parser.add_argument("--status", action="store_true", help="Show the status of the daemon")
+    parser.add_argument("--stop", action="store_true", help="Stop the daemon")
+    args = parser.parse_args()
+
+    try:
+        sock = connect_daemon(autostart=not (args.no_start or args.status or args.stop))
+    except (FileNotFoundError, ConnectionRefusedError):
+        raise SystemExit("The daemon is not running")
+    rfile, wfile = sock.makefile("rb"), sock.makefile("wb")
+
+    if args.status or args.stop:
+        send_message(wfile, {"command": "stop" if args.stop else "status"})
+        event = read_message(rfile)
+        if args.status and event is not None:
+            print(json.dumps(event["status"], indent=2))
+        return
+
+    # Paths are resolved here, the daemon runs in another directory
+    request = {
+        "context": [os.path.abspath(pattern) for pattern in args.context],
+        "model": args.model,
+        "no_cache": args.no_cache,
+        "session": args.session,
+    }
+
+    try:
+        if args.message:
+            if not ask(rfile, wfile, dict(request, message=" ".join(args.message))):
+                sys.exit(1)
+        elif not sys.stdin.isatty():
+            if not ask(rfile, wfile, dict(request, message=sys.stdin.read())):
+                sys.exit(1)
+        else:
+            import datetime
+
+            # An attached session is saved like the sessions of main.py
+            request["session"] = args.session or datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+            attach(rfile, wfile, request)
+            print(f"Session: {request['session']}", file=sys.stderr)
+    except KeyboardInterrupt:
+        # Closing the connection stops the answer
+        sys.exit(130)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Iterator, Optional
+
+from client import APIConnectionError, APIError
+from context_window import count_tokens
+from scheduler import RequestScheduler
+
+DEFAULT_CONCURRENCY = 8
+
+
+def read_jobs(file: IO, config: dict) -> Iterator[dict]:
+    """
+    Read prompts from a JSONL file and yield the request body of each one.
+
+    Each line is either {"id": ..., "prompt": "..."} or {"id": ..., "messages": [...]}, optionally
+    with its own "model", "temperature" and "max_tokens". Lines without an id are numbered.
+
+    An invalid line is yielded as {"id": ..., "error": "..."} rather than stopping the batch.
+    """
+    for number, line in enumerate(file, start=1):
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            job = json.loads(line)
+        except ValueError as e:
+            yield {"id": number, "error": f"Invalid JSON on line {number}: {e}"}
+            continue
+        if not isinstance(job, dict) or ("prompt" not in job and "messages" not in job):
+            job_id = job.get("id", number) if isinstance(job, dict) else number
+            yield {"id": job_id, "error": f"No prompt or messages on line {number}"}
+            continue
+        error = job_error(job)
+        if error is not None:
+            yield {"id": job.get("id", number), "error": f"{error} on line {number}"}
+            continue
+
+        if "messages" in job:
+            job_messages = job["messages"]
+        else:
+            job_messages = [{"role": "user", "content": job["prompt"]}]
+
+        body = {
+            "model": job.get("model", config["model"]),
+            "temperature": job.get("temperature", config["temperature"]),
+            "messages": job_messages,
+        }
+        max_tokens = job.get("max_tokens", config.get("max_tokens"))
+        if max_tokens is not None:
+            body["max_tokens"] = max_tokens
+
+        yield {"id": job.get("id", number), "body": body}
+
+
+def job_error(job: dict) -> Optional[str]:
+    """
+    Describe what's wrong with the fields of a job, None if they have the expected types
+    """
+    if "messages" in job:
+        messages = job["messages"]
+        if not isinstance(messages, list) or not messages:
+            return "messages is not a list of messages"
+        for message in messages:
+            if not isinstance(message, dict) or not isinstance(message.get("role"), str):
+                return "A message has no role"
+            if not isinstance(message.get("content"), str):
+                return "A message has no text content"
+    elif not isinstance(job["prompt"], str):
+        return "prompt is not a string"
+
+    if "model" in job and not isinstance(job["model"], str):
+        return "model is not a string"
+    temperature = job.get("temperature", 0)
+    if isinstance(temperature, bool) or not isinstance(temperature, (int, float)):
+        return "temperature is not a number"
+    max_tokens = job.get("max_tokens", 1)
+    if isinstance(max_tokens, bool) or not isinstance(max_tokens, int) or max_tokens < 1:
+        return "max_tokens is not a positive integer"
+    return None
+
+
+def estimate_tokens(body: dict) -> int:
+    """
+    Upper estimate of the tokens a request will use, for the tokens-per-minute budget
+    """
+    prompt = sum(count_tokens(m.get("content") or "") for m in body["messages"])
+    return prompt + body.get("max_tokens", 0)
+
+
+class RateLimiter:
+    """
+    Token buckets for a requests-per-minute and a tokens-per-minute budget, None means no limit
+    """
+
+    def __init__(self, requests_per_minute: Optional[int], tokens_per_minute: Optional[int]):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = float(requests_per_minute or 0)
+        self._tokens = float(tokens_per_minute or 0)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int) -> None:
+        """
+        Wait until one request and the given number of tokens fit in the budget, then take them
+        """
+        if self.tokens_per_minute:
+            # A request bigger than the whole budget would wait forever
+            tokens = min(tokens, self.tokens_per_minute)
+
+        async with self._lock:
+            while True:
+                self._refill()
+                wait = 0.0
+                if self.requests_per_minute and self._requests < 1:
+                    wait = max(wait, (1 - self._requests) * 60 / self.requests_per_minute)
+                if self.tokens_per_minute and self._tokens < tokens:
+                    wait = max(wait, (tokens - self._tokens) * 60 / self.tokens_per_minute)
+
+                if wait == 0:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+
+                await asyncio.sleep(wait)
+
+    def settle(self, estimated: int, actual: int) -> None:
+        """
+        Correct the token bucket once the real usage of a request is known
+        """
+        if self.tokens_per_minute:
+            self._tokens = min(self._tokens + estimated - actual, self.tokens_per_minute)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        if self.requests_per_minute:
+            self._requests = min(
+                self._requests + elapsed * self.requests_per_minute / 60,
+                self.requests_per_minute,
+            )
+        if self.tokens_per_minute:
+            self._tokens = min(
+                self._tokens + elapsed * self.tokens_per_minute / 60,
+                self.tokens_per_minute,
+            )
+
+
+async def run_batch(
+    jobs: Iterator[dict],
+    scheduler: RequestScheduler,
+    output: IO,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    requests_per_minute: Optional[int] = None,
+    tokens_per_minute: Optional[int] = None,
+) -> dict:
+    """
+    Run the jobs with bounded concurrency and write one JSON line per result, in completion order.
+
+    Requests are retried by the scheduler, those that still fail are written with an "error" field
+    instead of stopping the batch. Returns totals for the whole run.
+    """
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    totals = {"jobs": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0}
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def produce() -> None:
+        # Jobs are read lazily, so huge input files are never loaded in memory
+        for job in jobs:
+            await queue.put(job)
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def work() -> None:
+        while True:
+            job = await queue.get()
+            if job is None:
+                return
+
+            if "error" in job:
+                totals["jobs"] += 1
+                totals["errors"] += 1
+                output.write(json.dumps(job, ensure_ascii=False) + "\n")
+                output.flush()
+                continue
+
+            estimated = estimate_tokens(job["body"])
+            await limiter.acquire(estimated)
+
+            record = {"id": job["id"]}
+            start = time.perf_counter()
+            try:
+                response = await loop.run_in_executor(executor, scheduler.chat, job["body"])
+                usage = response["usage"]
+                message = response["choices"][0]["message"]
+            except (APIConnectionError, APIError) as e:
+                limiter.settle(estimated, 0)
+                record["error"] = str(e)
+                totals["errors"] += 1
+            except Exception as e:
+                # An unexpected answer, such as a 200 without JSON, only fails its own job
+                limiter.settle(estimated, 0)
+                record["error"] = f"Unexpected error: {e!r}"
+                totals["errors"] += 1
+            else:
+                limiter.settle(estimated, usage["total_tokens"])
+                record["message"] = message
+                record["usage"] = usage
+                totals["prompt_tokens"] += usage["prompt_tokens"]
+                totals["completion_tokens"] += usage["completion_tokens"]
+            record["latency"] = round(time.perf_counter() - start, 3)
+
+            totals["jobs"] += 1
+            output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            output.flush()
+
+    try:
+        await asyncio.gather(produce(), *(work() for _ in range(concurrency)))
+    finally:
+        executor.shutdown(wait=False)
+
+    return totals
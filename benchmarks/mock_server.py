@@ -0,0 +1,259 @@
+"""
+Local stand-in for the OpenAI chat completions endpoint, to benchmark the CLI without the real API.
+
+    python benchmarks/mock_server.py [--port 8000] [--latency 0.2] [--tokens 300] [--error-rate 0.05]
+
+Point the CLI at it with OPENAI_BASE_URL=http://127.0.0.1:8000/v1 (any API key is accepted).
+Answers are made of Markdown paragraphs and code blocks, streamed one token per event when the
+request asks for a stream. A fraction of the requests can fail with a given status code.
+"""
+import gzip
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+
+WORDS = (
+    "the request is sent over a pooled connection and the answer is rendered as it arrives "
+    "while tokens are counted against the context window of the model"
+).split()
+
+# Answers alternate paragraphs of prose with a code block
+PARAGRAPHS_PER_CODE_BLOCK = 3
+TOKENS_PER_PARAGRAPH = 40
+
+
+def completion_tokens(count: int) -> list:
+    """
+    Build an answer of the given number of tokens, as a list of tokens to send one by one
+    """
+    tokens = []
+    paragraphs = 0
+    while len(tokens) < count:
+        words = [WORDS[(paragraphs + i) % len(WORDS)] for i in range(TOKENS_PER_PARAGRAPH)]
+        tokens.append(words[0].capitalize())
+        tokens.extend(" " + word for word in words[1:])
+        tokens.append(".\n\n")
+        paragraphs += 1
+        if paragraphs % PARAGRAPHS_PER_CODE_BLOCK == 0:
+            tokens.extend(["```python\n", "def answer", "():\n", "    return ", "42\n", "```\n\n"])
+    return tokens[:count]
+
+
+class MockServer:
+    """
+    OpenAI-compatible chat completions server running in a background thread.
+
+    - latency: seconds before the response headers are sent
+    - token_delay: seconds between two streamed tokens
+    - tokens: number of tokens of each answer
+    - error_rate: fraction of the requests answered with error_status (and a Retry-After header)
+    - accept_gzip: accept compressed request bodies, otherwise they are answered with a 415
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        token_delay: float = 0.0,
+        tokens: int = 200,
+        error_rate: float = 0.0,
+        error_status: int = 429,
+        retry_after: float = 0.0,
+        seed: int = 0,
+        accept_gzip: bool = True,
+    ):
+        self.latency = latency
+        self.token_delay = token_delay
+        self.tokens = completion_tokens(tokens)
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.accept_gzip = accept_gzip
+
+        self.requests = 0
+        self.errors = 0
+        self.bytes_received = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        """
+        Base endpoint to use in place of the OpenAI one
+        """
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockServer":
+        """
+        Serve requests in a background thread
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Stop serving and close the listening socket
+        """
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self) -> dict:
+        """
+        Return the number of requests served, of errors injected, and the bytes of request bodies
+        received (as sent, compressed or not)
+        """
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "bytes_received": self.bytes_received,
+            }
+
+    def __enter__(self) -> "MockServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def _fail(self) -> bool:
+        with self._lock:
+            self.requests += 1
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        return failed
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Streamed chunks are sent right away, as API servers do, rather than held back until
+            # the headers are acknowledged (up to 40ms of delayed ACK)
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def do_POST(self) -> None:
+                payload = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with server._lock:
+                    server.bytes_received += len(payload)
+                if self.headers.get("Content-Encoding") == "gzip":
+                    if not server.accept_gzip:
+                        self._send_json(415, {"error": {"message": "Unsupported encoding"}})
+                        return
+                    payload = gzip.decompress(payload)
+                body = json.loads(payload)
+                if not self.path.endswith("/chat/completions"):
+                    self._send_json(404, {"error": {"message": "Not found"}})
+                    return
+
+                time.sleep(server.latency)
+                if server._fail():
+                    self._send_json(
+                        server.error_status,
+                        {"error": {"message": "Injected error"}},
+                        {"Retry-After": str(server.retry_after)},
+                    )
+                    return
+
+                prompt_tokens = sum(len(m.get("content") or "") for m in body["messages"]) // 4
+                usage = {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": len(server.tokens),
+                    "total_tokens": prompt_tokens + len(server.tokens),
+                }
+                if body.get("stream"):
+                    self._send_stream(body["model"], usage)
+                else:
+                    message = {"role": "assistant", "content": "".join(server.tokens)}
+                    self._send_json(
+                        200,
+                        {
+                            "object": "chat.completion",
+                            "model": body["model"],
+                            "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+                            "usage": usage,
+                        },
+                    )
+
+            def _send_json(self, status: int, data: dict, headers: dict = None) -> None:
+                payload = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _send_stream(self, model: str, usage: dict) -> None:
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+
+                self._send_event({"model": model, "choices": [{"delta": {"role": "assistant"}}]})
+                for token in server.tokens:
+                    if server.token_delay:
+                        time.sleep(server.token_delay)
+                    self._send_event({"model": model, "choices": [{"delta": {"content": token}}]})
+                self._send_event({"model": model, "choices": [], "usage": usage})
+                self._send_chunk(b"data: [DONE]\n\n")
+                self._send_chunk(b"")
+
+            def _send_event(self, event: dict) -> None:
+                self._send_chunk(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+
+            def _send_chunk(self, data: bytes) -> None:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+
+        return Handler
+
+
+@click.command()
+@click.option("--host", default="127.0.0.1", help="Address to listen on")
+@click.option("--port", default=8000, help="Port to listen on")
+@click.option("--latency", default=0.0, help="Seconds before the response headers")
+@click.option("--token-delay", default=0.0, help="Seconds between two streamed tokens")
+@click.option("--tokens", default=200, help="Tokens per answer")
+@click.option("--error-rate", default=0.0, help="Fraction of requests answered with an error")
+@click.option("--error-status", default=429, help="Status code of the injected errors")
+@click.option("--retry-after", default=0.0, help="Retry-After of the injected errors, in seconds")
+@click.option("--gzip/--no-gzip", "accept_gzip", default=True, help="Accept compressed requests")
+def main(host, port, latency, token_delay, tokens, error_rate, error_status, retry_after,
+         accept_gzip) -> None:
+    server = MockServer(
+        host,
+        port,
+        latency,
+        token_delay,
+        tokens,
+        error_rate,
+        error_status,
+        retry_after,
+        accept_gzip=accept_gzip,
+    )
+    click.echo(f"Serving on {server.url}, press Ctrl-C to stop")
+    with server:
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Startup benchmark: import time breakdown and wall-clock time to the first prompt.
+
+    python benchmarks/startup.py [--script main_improved.py] [--runs 5] [--json]
+
+Exits with status 1 when the median import time or time to first prompt is over its budget, so it
+can be used as a check before merging changes that touch the startup path.
+"""
+import json
+import os
+import pty
+import re
+import select
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+
+ROOT = Path(__file__).resolve().parent.parent
+IMPORT_TIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+PROMPT_MARKER = b">>>"
+
+
+def import_breakdown(module: str) -> list:
+    """
+    Import a module in a fresh interpreter with -X importtime and return its imports as
+    (cumulative microseconds, depth, name), slowest first
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            cumulative, indent, name = int(match[2]), match[3], match[4]
+            imports.append((cumulative, len(indent) // 2, name))
+
+    return sorted(imports, reverse=True)
+
+
+def time_to_first_prompt(script: str, timeout: float) -> float:
+    """
+    Start the CLI in a pseudo-terminal and return the seconds until the prompt is displayed.
+    It runs from a copy of the code, its history and cache files are next to the script.
+    """
+    master, slave = pty.openpty()
+    with tempfile.TemporaryDirectory() as cwd:
+        for path in ROOT.glob("*.py"):
+            shutil.copy(path, cwd)
+        shutil.copy(ROOT / "config.yaml", cwd)
+
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, str(Path(cwd, script))],
+            stdin=slave,
+            stdout=slave,
+            stderr=slave,
+            cwd=cwd,
+            close_fds=True,
+        )
+        os.close(slave)
+
+        output = b""
+        try:
+            while PROMPT_MARKER not in output:
+                remaining = timeout - (time.perf_counter() - start)
+                ready, _, _ = select.select([master], [], [], max(remaining, 0))
+                if not ready:
+                    raise click.ClickException(f"No prompt after {timeout}s: {output[-200:]!r}")
+                output += os.read(master, 4096)
+            elapsed = time.perf_counter() - start
+
+            os.write(master, b"/q\r")
+            process.wait(timeout=timeout)
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            os.close(master)
+
+    return elapsed
+
+
+@click.command()
+@click.option("--script", default="main.py", help="Entry point to benchmark")
+@click.option("--runs", default=5, help="Number of measured runs")
+@click.option("--top", default=10, help="Number of slowest imports to show")
+@click.option("--import-budget-ms", default=150.0, help="Budget for importing the entry point")
+@click.option("--prompt-budget-ms", default=700.0, help="Budget for the time to first prompt")
+@click.option("--timeout", default=30.0, help="Seconds to wait for the prompt")
+@click.option("--json", "as_json", is_flag=True, help="Print the results as JSON")
+def main(script, runs, top, import_budget_ms, prompt_budget_ms, timeout, as_json) -> None:
+    module = Path(script).stem
+
+    breakdowns = [import_breakdown(module) for _ in range(runs)]
+    import_ms = statistics.median(
+        next(c for c, depth, name in b if name == module) / 1000 for b in breakdowns
+    )
+    prompt_ms = statistics.median(
+        time_to_first_prompt(script, timeout) * 1000 for _ in range(runs)
+    )
+
+    slowest = [
+        {"module": name, "depth": depth, "ms": round(cumulative / 1000, 1)}
+        for cumulative, depth, name in breakdowns[-1][:top]
+    ]
+    results = {
+        "script": script,
+        "runs": runs,
+        "import_ms": round(import_ms, 1),
+        "first_prompt_ms": round(prompt_ms, 1),
+        "import_budget_ms": import_budget_ms,
+        "prompt_budget_ms": prompt_budget_ms,
+        "slowest_imports": slowest,
+    }
+
+    if as_json:
+        click.echo(json.dumps(results, indent=2))
+    else:
+        click.echo(f"Import time of {module}: {import_ms:.1f} ms (budget {import_budget_ms} ms)")
+        click.echo(f"Time to first prompt: {prompt_ms:.1f} ms (budget {prompt_budget_ms} ms)")
+        click.echo("Slowest imports (cumulative):")
+        for entry in slowest:
+            click.echo(f"  {entry['ms']:8.1f} ms  {'  ' * entry['depth']}{entry['module']}")
+
+    if import_ms > import_budget_ms or prompt_ms > prompt_budget_ms:
+        click.echo("Startup budget exceeded", err=True)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
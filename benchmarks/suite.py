@@ -0,0 +1,425 @@
+"""
+Benchmark suite: drives the CLI against a local mock of the chat completions API.
+
+    python benchmarks/suite.py [--script main.py] [--turns 1000] [--output results.json]
+
+For each entry point, an interactive session is run in a pseudo-terminal for --turns turns, measuring
+the end-to-end latency of each turn and the memory of the process as the conversation grows. When
+the entry point writes a metrics file, the time spent building request bodies, rendering, etc. is
+summarized from it. The batch command is then timed on --batch-jobs prompts, and the thin client
+(ask.py) on --asks one-shot questions to the daemon.
+
+Each session runs in a temporary copy of the code with its own config, history and cache, the
+server is reached through OPENAI_BASE_URL. The results are printed as JSON, along with the commit
+and the settings, so that runs on different commits can be compared.
+"""
+import fcntl
+import json
+import os
+import platform
+import pty
+import re
+import select
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import termios
+import time
+from pathlib import Path
+from typing import Optional
+
+import click
+import yaml
+
+from mock_server import MockServer
+
+ROOT = Path(__file__).resolve().parent.parent
+PROMPT_MARKER = b">>>"
+# prompt_toolkit turns bracketed paste off when a prompt is accepted. The prompt comes back right
+# away while the answer is pending, the turn is over once it shows the token count alone. Redraws
+# only print what changed: either the new count, with the cursor moved over unchanged spaces, or
+# the end of the prompt followed by the erasure of the "(1 pending)" that was after it.
+PROMPT_ACCEPTED = b"\x1b[?2004l"
+IDLE_PROMPT = re.compile(rb"\d\](?: |\x1b\[C)>>>|>>>\x1b\[0m\x1b\[K")
+TERMINAL_SIZE = (40, 120)
+
+
+def summarize(values: list, scale: float = 1.0) -> dict:
+    """
+    Count, mean and percentiles of a list of measurements, multiplied by scale
+    """
+    if not values:
+        return {"count": 0}
+    values = sorted(value * scale for value in values)
+    if len(values) > 1:
+        quantiles = statistics.quantiles(values, n=100, method="inclusive")
+    else:
+        quantiles = values * 99
+    return {
+        "count": len(values),
+        "mean": round(statistics.fmean(values), 3),
+        "p50": round(quantiles[49], 3),
+        "p95": round(quantiles[94], 3),
+        "p99": round(quantiles[98], 3),
+        "max": round(values[-1], 3),
+    }
+
+
+def rss_bytes(pid: int) -> Optional[int]:
+    """
+    Resident memory of a process, None where it can't be read
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    result = subprocess.run(["ps", "-o", "rss=", "-p", str(pid)], capture_output=True, text=True)
+    if result.returncode == 0 and result.stdout.strip():
+        return int(result.stdout) * 1024
+    return None
+
+
+def prepare_workdir(directory: Path, overrides: dict) -> None:
+    """
+    Copy the code and config into a directory, with the given config values replaced
+    """
+    for path in ROOT.glob("*.py"):
+        shutil.copy(path, directory)
+
+    with open(ROOT / "config.yaml") as f:
+        config = yaml.safe_load(f)
+    config.update(overrides)
+    with open(directory / "config.yaml", "w") as f:
+        yaml.safe_dump(config, f)
+
+
+def git_commit() -> Optional[str]:
+    """
+    Commit of the code being measured, with a suffix when the tree has local changes
+    """
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        return None
+    return f"{commit}-dirty" if commit and dirty else commit or None
+
+
+class TerminalSession:
+    """
+    An interactive CLI session running in a pseudo-terminal
+    """
+
+    def __init__(self, script: str, cwd: Path, env: dict, timeout: float):
+        self.timeout = timeout
+        self.master, slave = pty.openpty()
+        fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack("HHHH", *TERMINAL_SIZE, 0, 0))
+        self.process = subprocess.Popen(
+            [sys.executable, script],
+            stdin=slave,
+            stdout=slave,
+            stderr=slave,
+            cwd=cwd,
+            env=env,
+            close_fds=True,
+        )
+        os.close(slave)
+
+    def wait_for(self, *markers) -> bytes:
+        """
+        Read the output until the markers (bytes or compiled patterns) have been seen in order, and
+        return it
+        """
+        output = b""
+        position = 0
+        start = time.perf_counter()
+        for marker in markers:
+            if isinstance(marker, bytes):
+                marker = re.compile(re.escape(marker))
+            while True:
+                found = marker.search(output, position)
+                if found:
+                    position = found.end()
+                    break
+                remaining = self.timeout - (time.perf_counter() - start)
+                ready, _, _ = select.select([self.master], [], [], max(remaining, 0))
+                if not ready:
+                    raise click.ClickException(
+                        f"No prompt after {self.timeout}s: {output[-200:]!r}"
+                    )
+                output += os.read(self.master, 65536)
+        return output
+
+    def turn(self, message: str) -> float:
+        """
+        Send a message and return the seconds until the next prompt
+        """
+        start = time.perf_counter()
+        os.write(self.master, message.encode("utf-8") + b"\r")
+        self.wait_for(PROMPT_ACCEPTED, IDLE_PROMPT)
+        return time.perf_counter() - start
+
+    def close(self) -> None:
+        """
+        Quit the session, or kill it if it doesn't quit
+        """
+        try:
+            os.write(self.master, b"/q\r")
+            self.process.wait(timeout=self.timeout)
+        except (OSError, subprocess.TimeoutExpired):
+            pass
+        finally:
+            if self.process.poll() is None:
+                self.process.kill()
+                self.process.wait()
+            os.close(self.master)
+
+
+def read_metrics(path: Path) -> dict:
+    """
+    Summarize the metrics file written by the session, durations in milliseconds
+    """
+    if not path.exists():
+        return {}
+
+    measurements = {}
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            for name, value in record.items():
+                if name not in ("cost", "prompt_tokens", "completion_tokens") and isinstance(
+                    value, (int, float)
+                ) and not isinstance(value, bool):
+                    measurements.setdefault(name, []).append(value)
+
+    summary = {}
+    for name, values in measurements.items():
+        if name in ("tokens_per_second", "sent_bytes"):
+            summary[name] = summarize(values)
+        else:
+            summary[f"{name}_ms"] = summarize(values, 1000)
+    return summary
+
+
+def run_session(script: str, server: MockServer, overrides: dict, turns: int, sample_every: int,
+                timeout: float) -> dict:
+    """
+    Run an interactive session of the given number of turns and return its measurements
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        prepare_workdir(directory, overrides)
+        # The pseudo-terminal doesn't answer cursor position requests, prompt_toolkit would wait
+        # for the answer at each prompt
+        env = dict(
+            os.environ,
+            OPENAI_API_KEY="benchmark",
+            OPENAI_BASE_URL=server.url,
+            PROMPT_TOOLKIT_NO_CPR="1",
+        )
+
+        start = time.perf_counter()
+        session = TerminalSession(script, directory, env, timeout)
+        try:
+            session.wait_for(PROMPT_MARKER)
+            first_prompt = time.perf_counter() - start
+
+            latencies = []
+            memory = [(0, rss_bytes(session.process.pid))]
+            for turn in range(1, turns + 1):
+                latencies.append(session.turn(f"Question {turn}: how are answers rendered?"))
+                if turn % sample_every == 0 or turn == turns:
+                    memory.append((turn, rss_bytes(session.process.pid)))
+        finally:
+            session.close()
+
+        breakdown = read_metrics(directory / "session-history" / "metrics.jsonl")
+
+    result = {
+        "first_prompt_ms": round(first_prompt * 1000, 1),
+        "turn_latency_ms": summarize(latencies, 1000),
+        "breakdown": breakdown,
+    }
+    if memory[0][1] is not None:
+        growth = memory[-1][1] - memory[0][1]
+        result["memory"] = {
+            "start_bytes": memory[0][1],
+            "end_bytes": memory[-1][1],
+            "growth_bytes": growth,
+            "growth_per_turn_bytes": round(growth / turns),
+            "samples": [{"turn": turn, "rss_bytes": rss} for turn, rss in memory],
+        }
+    return result
+
+
+def run_batch(server: MockServer, overrides: dict, jobs: int, concurrency: int,
+              timeout: float) -> dict:
+    """
+    Time the batch command on the given number of prompts
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        prepare_workdir(directory, overrides)
+        env = dict(os.environ, OPENAI_API_KEY="benchmark", OPENAI_BASE_URL=server.url)
+
+        with open(directory / "jobs.jsonl", "w") as f:
+            for job in range(jobs):
+                f.write(json.dumps({"id": job, "prompt": f"Question {job}"}) + "\n")
+
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "main.py", "batch", "jobs.jsonl", "-o", "results.jsonl",
+             "-n", str(concurrency)],
+            cwd=directory,
+            env=env,
+            capture_output=True,
+            timeout=timeout,
+            check=True,
+        )
+        elapsed = time.perf_counter() - start
+
+        errors = 0
+        completion_tokens = 0
+        with open(directory / "results.jsonl") as f:
+            for line in f:
+                record = json.loads(line)
+                if "error" in record:
+                    errors += 1
+                else:
+                    completion_tokens += record["usage"]["completion_tokens"]
+
+    return {
+        "jobs": jobs,
+        "concurrency": concurrency,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "jobs_per_second": round(jobs / elapsed, 1),
+        "completion_tokens_per_second": round(completion_tokens / elapsed, 1),
+    }
+
+
+def run_asks(server: MockServer, overrides: dict, asks: int, timeout: float) -> dict:
+    """
+    Time one-shot questions through the thin client: the first one starts the daemon, the next
+    ones find it warm
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        prepare_workdir(directory, overrides)
+        env = dict(os.environ, OPENAI_API_KEY="benchmark", OPENAI_BASE_URL=server.url)
+
+        def ask(*args) -> tuple:
+            start = time.perf_counter()
+            process = subprocess.Popen(
+                [sys.executable, "ask.py", *args], cwd=directory, env=env, stdout=subprocess.PIPE
+            )
+            os.read(process.stdout.fileno(), 1)
+            first_output = time.perf_counter() - start
+            process.stdout.read()
+            process.wait(timeout)
+            return first_output, time.perf_counter() - start
+
+        try:
+            cold_first_output, cold_total = ask("Question 0")
+            first_outputs, totals = [], []
+            for number in range(1, asks + 1):
+                first_output, total = ask(f"Question {number}")
+                first_outputs.append(first_output)
+                totals.append(total)
+        finally:
+            subprocess.run(
+                [sys.executable, "ask.py", "--stop"], cwd=directory, env=env, timeout=timeout
+            )
+
+    return {
+        "asks": asks,
+        "cold_first_output_ms": round(cold_first_output * 1000, 1),
+        "cold_total_ms": round(cold_total * 1000, 1),
+        "first_output_ms": summarize(first_outputs, 1000),
+        "total_ms": summarize(totals, 1000),
+    }
+
+
+@click.command()
+@click.option("--script", "scripts", multiple=True, help="Entry points to benchmark (default both)")
+@click.option("--turns", default=1000, help="Turns of each interactive session")
+@click.option("--sample-every", default=100, help="Turns between two memory samples")
+@click.option("--stream/--no-stream", default=True, help="Stream the answers")
+@click.option("--markdown/--no-markdown", default=True, help="Render the answers as Markdown")
+@click.option("--compression/--no-compression", default=False, help="Compress the request bodies")
+@click.option("--latency", default=0.0, help="Seconds before the server answers")
+@click.option("--token-delay", default=0.0, help="Seconds between two streamed tokens")
+@click.option("--tokens", default=200, help="Tokens per answer")
+@click.option("--error-rate", default=0.0, help="Fraction of requests answered with a 429")
+@click.option("--batch-jobs", default=1000, help="Prompts of the batch run, 0 to skip it")
+@click.option("--concurrency", default=16, help="Concurrency of the batch run")
+@click.option("--asks", default=50, help="One-shot questions through the daemon, 0 to skip them")
+@click.option("--timeout", default=60.0, help="Seconds to wait for a turn or the batch")
+@click.option("--output", type=click.File("w"), default="-", help="Where to write the JSON results")
+def main(scripts, turns, sample_every, stream, markdown, compression, latency, token_delay, tokens,
+         error_rate, batch_jobs, concurrency, asks, timeout, output) -> None:
+    scripts = scripts or ("main.py", "main_improved.py")
+    # A non-zero temperature keeps the response cache out of the measurements
+    overrides = {
+        "stream": stream,
+        "markdown": markdown,
+        "temperature": 0.7,
+        "request_compression": compression,
+    }
+    settings = {
+        "turns": turns,
+        "stream": stream,
+        "markdown": markdown,
+        "compression": compression,
+        "latency": latency,
+        "token_delay": token_delay,
+        "tokens": tokens,
+        "error_rate": error_rate,
+    }
+
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": settings,
+        "sessions": {},
+    }
+
+    with MockServer(
+        latency=latency, token_delay=token_delay, tokens=tokens, error_rate=error_rate
+    ) as server:
+        for script in scripts:
+            click.echo(f"Running {turns} turns of {script}...", err=True)
+            results["sessions"][script] = run_session(
+                script, server, overrides, turns, sample_every, timeout
+            )
+
+        if batch_jobs:
+            click.echo(f"Running a batch of {batch_jobs} prompts...", err=True)
+            results["batch"] = run_batch(server, overrides, batch_jobs, concurrency, timeout)
+
+        if asks:
+            click.echo(f"Asking {asks} questions through the daemon...", err=True)
+            results["asks"] = run_asks(server, overrides, asks, timeout)
+
+        results["server"] = server.stats()
+
+    output.write(json.dumps(results, indent=2) + "\n")
+
+
+if __name__ == "__main__":
+    main()
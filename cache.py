@@ -0,0 +1,150 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024
+DEFAULT_MAX_AGE = 30 * 24 * 3600
+
+# Only these fields of the request body determine the response
+KEY_FIELDS = ("model", "temperature", "max_tokens", "messages")
+
+
+def cache_key(body: dict) -> str:
+    """
+    Content address of a request: a hash of its canonicalized body
+    """
+    canonical = {field: body[field] for field in KEY_FIELDS if field in body}
+    encoded = json.dumps(canonical, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Persistent SQLite cache of chat completion responses, with size and age based LRU eviction.
+
+    Only worth using for deterministic requests (temperature 0), otherwise a hit would replay a
+    single sample of the model.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        max_age: float = DEFAULT_MAX_AGE,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )
+            """
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._db.commit()
+        self._closed = False
+
+    @classmethod
+    def from_config(cls, path: Path, config: dict) -> "ResponseCache":
+        """
+        Build a cache from the cache settings of the config file
+        """
+        return cls(
+            path,
+            max_entries=config.get("cache_max_entries", DEFAULT_MAX_ENTRIES),
+            max_bytes=config.get("cache_max_bytes", DEFAULT_MAX_BYTES),
+            max_age=config.get("cache_max_age", DEFAULT_MAX_AGE),
+        )
+
+    def get(self, key: str) -> Optional[dict]:
+        """
+        Return the cached response for a key, or None on a miss
+        """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT response, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None or now - row[1] > self.max_age:
+                if row is not None:
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._db.commit()
+                self.misses += 1
+                return None
+
+            self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self.hits += 1
+
+        return json.loads(row[0])
+
+    def put(self, key: str, response: dict) -> None:
+        """
+        Store a response and evict the least recently used entries beyond the limits
+        """
+        encoded = json.dumps(response, separators=(",", ":"), ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, encoded, len(encoded), now, now),
+            )
+            self._evict(now)
+            self._db.commit()
+
+    def stats(self) -> dict:
+        """
+        Return the hit/miss counters and the current size of the cache, nothing once closed
+        """
+        with self._lock:
+            if self._closed:
+                return {}
+            entries, size = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+    def close(self) -> None:
+        """
+        Close the underlying database
+        """
+        with self._lock:
+            self._db.close()
+            self._closed = True
+
+    def _evict(self, now: float) -> None:
+        self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.max_age,))
+
+        entries, size = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        if entries <= self.max_entries and size <= self.max_bytes:
+            return
+
+        rows = self._db.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall()
+        evicted = []
+        for key, entry_size in rows:
+            if entries <= self.max_entries and size <= self.max_bytes:
+                break
+            evicted.append((key,))
+            entries -= 1
+            size -= entry_size
+        self._db.executemany("DELETE FROM responses WHERE key = ?", evicted)
@@ -0,0 +1,455 @@
+import gzip
+import importlib.util
+import socket
+import threading
+import time
+from functools import lru_cache
+from typing import Iterator, Optional
+
+from request_body import RequestEncoder
+
+# The HTTP libraries are slow to import, they are only loaded when the first request is sent.
+# httpx (with h2) is only needed for HTTP/2, which is optional.
+HTTPX_AVAILABLE = all(importlib.util.find_spec(name) for name in ("httpx", "h2"))
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 120
+
+# Request bodies are compressed fast rather than small: JSON conversations shrink several times
+# even at the lowest level. Bodies smaller than a packet are not worth compressing.
+COMPRESSION_LEVEL = 1
+MIN_COMPRESSED_BYTES = 1400
+
+
+class APIError(Exception):
+    """
+    The API answered with a non-200 status code
+    """
+
+    def __init__(self, status_code: int, message: str = "", retry_after: Optional[float] = None):
+        super().__init__(f"Error: {status_code} {message}".strip())
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class APIConnectionError(Exception):
+    """
+    The API could not be reached
+    """
+
+
+class APITimeoutError(APIConnectionError):
+    """
+    The API did not answer within the configured timeout
+    """
+
+
+class APICancelledError(Exception):
+    """
+    The request was cancelled from another thread, see ChatClient.cancel. Not worth retrying.
+    """
+
+
+# Seconds spent opening connections (DNS, TCP and TLS) by the current thread, see _timed_pools
+_connect_time = threading.local()
+# Thread id -> urllib3 connection sending its current request, see _timed_pools
+_active_connections = {}
+
+
+@lru_cache(maxsize=None)
+def _timed_pools() -> dict:
+    """
+    urllib3 connection pools whose connections add their setup time to _connect_time, and
+    register themselves in _active_connections when they send a request
+    """
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    def timed(connection_class):
+        class TimedConnection(connection_class):
+            def connect(self):
+                start = time.perf_counter()
+                try:
+                    super().connect()
+                finally:
+                    _connect_time.seconds = getattr(_connect_time, "seconds", 0.0) + (
+                        time.perf_counter() - start
+                    )
+
+            def request(self, *args, **kwargs):
+                _active_connections[threading.get_ident()] = self
+                return super().request(*args, **kwargs)
+
+        return TimedConnection
+
+    class TimedHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = timed(HTTPConnection)
+
+    class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = timed(HTTPSConnection)
+
+    return {"http": TimedHTTPConnectionPool, "https": TimedHTTPSConnectionPool}
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Parse a Retry-After header given in seconds, ignoring HTTP dates and garbage
+    """
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class StreamLines:
+    """
+    Iterator over the lines of a streamed response. Closing it closes the response, even before
+    the first line is read.
+    """
+
+    def __init__(self, lines: Iterator, response):
+        self._lines = lines
+        self._response = response
+
+    def __iter__(self) -> "StreamLines":
+        return self
+
+    def __next__(self):
+        return next(self._lines)
+
+    def close(self) -> None:
+        self._lines.close()
+        self._response.close()
+
+
+class ChatClient:
+    """
+    Pooled keep-alive HTTP client for the chat completions endpoint.
+
+    A single instance is meant to be shared by every code path that talks to the API, so that
+    TCP and TLS handshakes are paid once per connection instead of once per request.
+
+    With compress, request bodies are sent gzipped. Not every endpoint accepts them: when one
+    answers 415 (Unsupported Media Type), the request is sent again uncompressed and compression
+    is turned off.
+    """
+
+    def __init__(
+        self,
+        base_endpoint: str,
+        api_key: Optional[str],
+        pool_size: int = DEFAULT_POOL_SIZE,
+        connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+        read_timeout: float = DEFAULT_READ_TIMEOUT,
+        http2: bool = False,
+        compress: bool = False,
+    ):
+        self.base_endpoint = base_endpoint.rstrip("/")
+        self.headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}",
+        }
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.http2 = http2 and HTTPX_AVAILABLE
+        self.compress = compress
+        self.encoder = RequestEncoder()
+
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._connections = 0
+        self._session = None
+        self._local = threading.local()
+        # Ids of the threads whose requests are cancelled
+        self._cancelled = set()
+
+    @classmethod
+    def from_config(cls, base_endpoint: str, api_key: Optional[str], config: dict) -> "ChatClient":
+        """
+        Build a client from the connection settings of the config file
+        """
+        return cls(
+            base_endpoint,
+            api_key,
+            pool_size=config.get("pool_size", DEFAULT_POOL_SIZE),
+            connect_timeout=config.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT),
+            read_timeout=config.get("read_timeout", DEFAULT_READ_TIMEOUT),
+            http2=config.get("http2", False),
+            compress=config.get("request_compression", False),
+        )
+
+    def chat(self, body: dict, timeout: Optional[float] = None) -> dict:
+        """
+        Send a chat completion request and return the decoded response.
+        The timeout, if given, caps the configured read timeout for this request.
+        """
+        try:
+            response = self._post("/chat/completions", body, False, timeout)
+        finally:
+            _active_connections.pop(threading.get_ident(), None)
+
+        start = time.perf_counter()
+        data = response.json()
+        self._local.timing["parse"] = time.perf_counter() - start
+        return data
+
+    def stream(self, body: dict, timeout: Optional[float] = None) -> Iterator:
+        """
+        Send a streaming chat completion request and return an iterator over the raw SSE lines.
+
+        Errors are raised before the first line is returned, the connection goes back to the pool
+        once the iterator is exhausted or closed. The timeout, if given, caps the configured read
+        timeout, and the stream raises APITimeoutError once it has lasted longer.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        response = self._post("/chat/completions", body, True, timeout)
+        return StreamLines(
+            self._iter_lines(response, self._local.timing, self._local.start, deadline), response
+        )
+
+    def cancel(self, thread: int) -> None:
+        """
+        Cancel the request a thread is sending or reading, from another thread: its connection is
+        shut down, and it gets APICancelledError from this request and the next ones, until it
+        calls reset_cancel. Over HTTP/2 a stream stops at its next line.
+        """
+        with self._lock:
+            self._cancelled.add(thread)
+        connection = _active_connections.get(thread)
+        sock = getattr(connection, "sock", None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def reset_cancel(self) -> None:
+        """
+        Let the current thread send requests again after a cancel
+        """
+        with self._lock:
+            self._cancelled.discard(threading.get_ident())
+
+    @property
+    def last_timing(self) -> Optional[dict]:
+        """
+        Timings of the last request of the current thread, in seconds: encode (JSON encoding and
+        compression of the body), connect (DNS, TCP and TLS, 0 when a pooled connection was
+        reused), ttfb (until the response headers), total (until the last byte, set once a stream
+        is exhausted) and parse (decoding of a JSON response). Also the bytes of body sent.
+        """
+        return getattr(self._local, "timing", None)
+
+    def stats(self) -> dict:
+        """
+        Return the number of requests sent and the number of connections opened to serve them
+        """
+        with self._lock:
+            requests_sent = self._requests
+            connections = self._connections
+
+        if not self.http2 and self._session is not None:
+            connections = 0
+            pools = self._session.adapters["https://"].poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    connections += pool.num_connections
+
+        return {
+            "requests": requests_sent,
+            "connections": connections,
+            "reused": max(requests_sent - connections, 0),
+            "http2": self.http2,
+            "compressed": self.compress,
+        }
+
+    def close(self) -> None:
+        """
+        Close every pooled connection
+        """
+        if self._session is not None:
+            self._session.close()
+
+    def _get_session(self):
+        # Created on the first request, so that starting the CLI doesn't pay for the HTTP stack
+        with self._lock:
+            if self._session is not None:
+                return self._session
+
+            if self.http2:
+                import httpx
+
+                self._session = httpx.Client(
+                    http2=True,
+                    headers=self.headers,
+                    limits=httpx.Limits(
+                        max_connections=self.pool_size, max_keepalive_connections=self.pool_size
+                    ),
+                    timeout=httpx.Timeout(self.timeout[1], connect=self.timeout[0]),
+                )
+            else:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                self._session = requests.Session()
+                self._session.headers.update(self.headers)
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                adapter.poolmanager.pool_classes_by_scheme = _timed_pools()
+                self._session.mount("https://", adapter)
+                self._session.mount("http://", adapter)
+
+            return self._session
+
+    def _post(self, path: str, body: dict, stream: bool, timeout: Optional[float]):
+        # The connection of the previous request may be used by another thread by now
+        _active_connections.pop(threading.get_ident(), None)
+        self._check_cancelled()
+        with self._lock:
+            self._requests += 1
+
+        connect_timeout, read_timeout = self.timeout
+        if timeout is not None:
+            read_timeout = min(read_timeout, timeout)
+
+        start = time.perf_counter()
+        payload = self.encoder.encode(body)
+        headers = {}
+        compressed = self.compress and len(payload) >= MIN_COMPRESSED_BYTES
+        if compressed:
+            payload = gzip.compress(payload, COMPRESSION_LEVEL)
+            headers["Content-Encoding"] = "gzip"
+
+        timing = {
+            "encode": time.perf_counter() - start,
+            "bytes": len(payload),
+            "connect": 0.0,
+            "ttfb": None,
+            "total": None,
+            "parse": 0.0,
+        }
+        self._local.timing = timing
+        self._local.start = time.perf_counter()
+        _connect_time.seconds = 0.0
+
+        timeouts = (connect_timeout, read_timeout)
+        try:
+            if self.http2:
+                response = self._post_httpx(path, payload, headers, stream, timeouts)
+            else:
+                response = self._post_requests(path, payload, headers, stream, timeouts)
+        except APIConnectionError:
+            # A connection shut down by cancel
+            self._check_cancelled()
+            raise
+        if not self.http2:
+            timing["connect"] = _connect_time.seconds
+            timing["ttfb"] = response.elapsed.total_seconds()
+
+        if not stream:
+            timing["total"] = time.perf_counter() - self._local.start
+
+        if response.status_code == 415 and compressed:
+            response.close()
+            self.compress = False
+            return self._post(path, body, stream, timeout)
+
+        if response.status_code != 200:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if stream:
+                response.close()
+            raise APIError(response.status_code, retry_after=retry_after)
+
+        return response
+
+    def _post_requests(self, path: str, payload: bytes, headers: dict, stream: bool,
+                       timeout: tuple):
+        import requests
+
+        try:
+            return self._get_session().post(
+                f"{self.base_endpoint}{path}",
+                data=payload,
+                headers=headers,
+                stream=stream,
+                timeout=timeout,
+            )
+        except requests.Timeout as e:
+            raise APITimeoutError(str(e)) from e
+        except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+            raise APIConnectionError(str(e)) from e
+
+    def _post_httpx(self, path: str, payload: bytes, headers: dict, stream: bool, timeout: tuple):
+        import httpx
+
+        session = self._get_session()
+        request = session.build_request(
+            "POST",
+            f"{self.base_endpoint}{path}",
+            content=payload,
+            headers=headers,
+            timeout=httpx.Timeout(timeout[1], connect=timeout[0]),
+            extensions={"trace": self._trace},
+        )
+        try:
+            return session.send(request, stream=stream)
+        except httpx.TimeoutException as e:
+            raise APITimeoutError(str(e)) from e
+        except httpx.TransportError as e:
+            raise APIConnectionError(str(e)) from e
+
+    def _trace(self, event_name: str, info: dict) -> None:
+        # httpcore reports every new connection and response through the trace extension,
+        # from the thread sending the request
+        now = time.perf_counter()
+        if event_name == "connection.connect_tcp.started":
+            self._local.connect_start = now
+        elif event_name in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+            self._local.timing["connect"] = now - self._local.connect_start
+        elif event_name.endswith(".receive_response_headers.complete"):
+            self._local.timing["ttfb"] = now - self._local.start
+
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self._connections += 1
+
+    def _iter_lines(
+        self, response, timing: dict, start: float, deadline: Optional[float]
+    ) -> Iterator:
+        # The request is only over once the stream is
+        if self.http2:
+            import httpx
+
+            timeout_errors = httpx.TimeoutException
+            connection_errors = httpx.TransportError
+        else:
+            import requests
+
+            timeout_errors = requests.Timeout
+            connection_errors = (requests.ConnectionError, requests.exceptions.ChunkedEncodingError)
+
+        try:
+            for line in response.iter_lines():
+                self._check_cancelled()
+                yield line
+                # The read timeout only bounds each read, a slow stream could go on forever
+                if deadline is not None and time.monotonic() > deadline:
+                    raise APITimeoutError("The answer didn't complete within the deadline")
+            # A connection shut down by cancel may end the stream without an error
+            self._check_cancelled()
+        except timeout_errors as e:
+            self._check_cancelled()
+            raise APITimeoutError(str(e)) from e
+        except connection_errors as e:
+            self._check_cancelled()
+            raise APIConnectionError(str(e)) from e
+        finally:
+            timing["total"] = time.perf_counter() - start
+            _active_connections.pop(threading.get_ident(), None)
+            response.close()
+
+    def _check_cancelled(self) -> None:
+        with self._lock:
+            if threading.get_ident() in self._cancelled:
+                raise APICancelledError("The request was cancelled")
@@ -0,0 +1,179 @@
+import importlib.util
+from functools import lru_cache
+from typing import Callable, Optional
+
+# tiktoken gives exact counts, without it tokens are estimated from the text length.
+# It's slow to import, so it's only loaded when the first message is counted.
+TIKTOKEN_AVAILABLE = importlib.util.find_spec("tiktoken") is not None
+
+POLICIES = ("none", "sliding", "pin", "summarize")
+
+# Fixed overhead of the chat format, see the OpenAI cookbook on counting tokens
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+DEFAULT_RESERVE_TOKENS = 1024
+DEFAULT_SUMMARY_TOKENS = 256
+SUMMARY_CHARS_PER_MESSAGE = 200
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model: Optional[str]):
+    import tiktoken
+
+    try:
+        return tiktoken.encoding_for_model(model)
+    except (KeyError, TypeError):
+        return tiktoken.get_encoding("cl100k_base")
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    """
+    Count the tokens of a piece of text, results are cached so each message is tokenized once
+    """
+    if not TIKTOKEN_AVAILABLE:
+        return (len(text) + 3) // 4
+    return len(_get_encoding(model).encode(text, disallowed_special=()))
+
+
+class ContextWindow:
+    """
+    Keeps the messages sent to the API within the context window of the model.
+
+    The full conversation is left untouched, `fit` returns the list of messages to send along with
+    the number of tokens it saved. Policies:
+
+    - none: send everything
+    - sliding: drop the oldest messages first
+    - pin: like sliding, but system messages (instructions and context files) are never dropped
+    - summarize: like pin, but dropped turns are collapsed into a short summary message
+
+    When the messages that can't be dropped are over the budget on their own, they are sent as is
+    and notify is told the request may be rejected.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        window: int,
+        policy: str = "pin",
+        reserve_tokens: int = DEFAULT_RESERVE_TOKENS,
+        summary_tokens: int = DEFAULT_SUMMARY_TOKENS,
+        notify: Callable[[str], None] = lambda text: None,
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown context policy '{policy}', use one of {', '.join(POLICIES)}")
+
+        self.model = model
+        self.policy = policy
+        self.budget = window - reserve_tokens
+        self.summary_tokens = summary_tokens
+        self.notify = notify
+
+    @classmethod
+    def from_config(
+        cls,
+        config: dict,
+        context_windows: dict,
+        notify: Callable[[str], None] = lambda text: None,
+    ) -> "ContextWindow":
+        """
+        Build a context window manager for the configured model. For a model missing from
+        context_windows, nothing can be trimmed: the policy is none, and notify is told so.
+        """
+        model = config["model"]
+        window = context_windows.get(model)
+        policy = config.get("context_policy", "pin")
+        if window is None:
+            notify(f"Unknown context window for {model}, the conversation won't be trimmed")
+            window, policy = 0, "none"
+
+        return cls(
+            model,
+            window,
+            policy=policy,
+            reserve_tokens=config.get("max_tokens", DEFAULT_RESERVE_TOKENS),
+            summary_tokens=config.get("summary_tokens", DEFAULT_SUMMARY_TOKENS),
+            notify=notify,
+        )
+
+    def count_message(self, message: dict) -> int:
+        """
+        Count the tokens of a single message, including the chat format overhead
+        """
+        return (
+            TOKENS_PER_MESSAGE
+            + count_tokens(message["role"], self.model)
+            + count_tokens(message.get("content") or "", self.model)
+        )
+
+    def count(self, messages: list) -> int:
+        """
+        Count the prompt tokens of a list of messages
+        """
+        return sum(self.count_message(m) for m in messages) + TOKENS_PER_REPLY
+
+    def fit(self, messages: list) -> tuple:
+        """
+        Apply the policy and return the messages to send and the number of tokens saved
+        """
+        counts = [self.count_message(m) for m in messages]
+        total = sum(counts) + TOKENS_PER_REPLY
+
+        if self.policy == "none" or total <= self.budget:
+            return messages, 0
+
+        budget = self.budget
+        if self.policy == "summarize":
+            budget -= self.summary_tokens
+
+        # The last message is the prompt being answered, it's always sent
+        kept = total
+        dropped = set()
+        for i, message in enumerate(messages[:-1]):
+            if kept <= budget:
+                break
+            if self.policy != "sliding" and message["role"] == "system":
+                continue
+            dropped.add(i)
+            kept -= counts[i]
+
+        fitted = [m for i, m in enumerate(messages) if i not in dropped]
+
+        if self.policy == "summarize" and dropped:
+            summary = self._summarize([messages[i] for i in sorted(dropped)])
+            # Place the summary right after the pinned system messages that precede it
+            position = 0
+            while position < len(fitted) - 1 and fitted[position]["role"] == "system":
+                position += 1
+            fitted.insert(position, summary)
+
+        sent = self.count(fitted)
+        if sent > self.budget:
+            self.notify(
+                f"The messages that can't be dropped take {sent} tokens, over the {self.budget}"
+                f" available for {self.model}, the request may be rejected"
+            )
+        return fitted, total - sent
+
+    def _summarize(self, dropped: list) -> dict:
+        """
+        Collapse old turns into a single system message, keeping the most recent ones that fit
+        """
+        lines = []
+        used = count_tokens("Summary of the earlier conversation:", self.model)
+        for message in reversed(dropped):
+            content = " ".join((message.get("content") or "").split())
+            if len(content) > SUMMARY_CHARS_PER_MESSAGE:
+                content = content[:SUMMARY_CHARS_PER_MESSAGE] + "..."
+            line = f"- {message['role']}: {content}"
+
+            tokens = count_tokens(line, self.model)
+            if used + tokens > self.summary_tokens - TOKENS_PER_MESSAGE:
+                break
+            lines.append(line)
+            used += tokens
+
+        content = "\n".join(["Summary of the earlier conversation:"] + lines[::-1])
+        return {"role": "system", "content": content}
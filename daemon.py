@@ -0,0 +1,436 @@
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import IO, Callable, Iterable, Optional
+
+from journal import SessionJournal, read_journal
+
+# Socket of the daemon, next to the code it runs
+SOCKET_NAME = ".daemon.sock"
+DEFAULT_IDLE_TIMEOUT = 900
+# Seconds between two checks of the idle timeout
+IDLE_CHECK_INTERVAL = 1.0
+# Seconds before the context patterns of a request are expanded again, to find new files
+DEFAULT_CONTEXT_RESCAN_INTERVAL = 30
+
+
+def send_message(file: IO, message: dict) -> None:
+    """
+    Write a message of the daemon protocol: one JSON object per line
+    """
+    file.write(json.dumps(message, ensure_ascii=False).encode("utf-8") + b"\n")
+    file.flush()
+
+
+def read_message(file: IO) -> Optional[dict]:
+    """
+    Read a message of the daemon protocol, None when the other side closed the connection
+    """
+    line = file.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+
+def connect(path: Path) -> socket.socket:
+    """
+    Connect to a daemon socket. Raises FileNotFoundError or ConnectionRefusedError when no daemon
+    is listening on it.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def forward_stream(lines: Iterable, send: Callable[[dict], None], messages: list) -> dict:
+    """
+    Send the text of a streamed chat completion as it arrives and return the assembled result:
+    the message, the usage, the time to first token, the total stream time and the parse time
+    """
+    from streaming import estimate_usage, iter_sse_events
+
+    start = time.perf_counter()
+    timing = {"parse": 0.0}
+    ttft = None
+    role = "assistant"
+    parts = []
+    usage = None
+
+    try:
+        for event in iter_sse_events(lines, timing):
+            if event.get("usage"):
+                usage = event["usage"]
+
+            for choice in event.get("choices", []):
+                delta = choice.get("delta", {})
+                role = delta.get("role", role)
+                text = delta.get("content")
+                if not text:
+                    continue
+
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                parts.append(text)
+                send({"text": text})
+
+        # Read what follows [DONE], a stream closed before its end can't go back to the pool
+        for _ in lines:
+            pass
+    finally:
+        # A client gone in the middle of an answer closes the stream right away
+        if hasattr(lines, "close"):
+            lines.close()
+
+    content = "".join(parts)
+    if usage is None:
+        usage = estimate_usage(messages, content)
+
+    return {
+        "message": {"role": role, "content": content},
+        "usage": usage,
+        "ttft": ttft,
+        "elapsed": time.perf_counter() - start,
+        "parse": timing["parse"],
+    }
+
+
+class Conversation:
+    """
+    Messages of a named conversation, journaled like a session. The lock keeps the turns of
+    clients sharing it in order.
+    """
+
+    def __init__(self, messages: list, journal: SessionJournal):
+        self.messages = messages
+        self.journal = journal
+        self.lock = threading.Lock()
+
+
+class Conversations:
+    """
+    Named conversations kept in memory between requests.
+
+    A conversation is loaded from its session file the first time it's used, if there is one, and
+    each turn is appended to it. new_messages gives the first messages of a new conversation.
+    """
+
+    def __init__(self, folder: str, new_messages: Callable[[], list]):
+        self.folder = Path(folder)
+        self.new_messages = new_messages
+        self._conversations = {}
+        self._lock = threading.Lock()
+
+    def open(self, name: str) -> Conversation:
+        """
+        Return a conversation by name, the name of a saved session or a new one
+        """
+        if not name or Path(name).name != name or name.startswith("."):
+            raise ValueError(f"Invalid session name: {name}")
+
+        with self._lock:
+            conversation = self._conversations.get(name)
+            if conversation is not None:
+                return conversation
+
+            # The file name of a saved session, as shown by search, or a name of our own
+            path = self.folder / f"{Path(name).stem}.jsonl"
+            if not path.exists():
+                path = self.folder / f"chatgpt-session-{name}.jsonl"
+
+            if path.exists():
+                messages = list(read_journal(path))
+                journal = SessionJournal(path, len(messages))
+            else:
+                messages = self.new_messages()
+                journal = SessionJournal(path)
+                journal.sync(messages)
+
+            conversation = Conversation(messages, journal)
+            self._conversations[name] = conversation
+            return conversation
+
+    def stats(self) -> dict:
+        """
+        Return the number of conversations in memory and of their messages
+        """
+        with self._lock:
+            conversations = list(self._conversations.values())
+        return {
+            "open": len(conversations),
+            "messages": sum(len(c.messages) for c in conversations),
+        }
+
+    def close(self) -> None:
+        """
+        Close the journals of the conversations
+        """
+        with self._lock:
+            for conversation in self._conversations.values():
+                with conversation.lock:
+                    conversation.journal.close()
+            self._conversations.clear()
+
+
+class Context:
+    """
+    Context files matching a set of patterns, and their messages and retriever. The lock is held
+    while they are prepared and while the retriever is used.
+    """
+
+    def __init__(self):
+        self.files = []
+        self.skipped = []
+        self.messages = []
+        self.retriever = None
+        self.stamp = None
+        self.scanned = 0.0
+        self.lock = threading.Lock()
+
+
+class Contexts:
+    """
+    Context files sent with the requests, prepared once per set of patterns.
+
+    expand turns patterns into the files to use and the ones skipped, prepare turns files into
+    their messages and retriever. The patterns are expanded again every rescan_interval seconds,
+    in between only the files found are checked for changes. A context is prepared again when its
+    files change, the retriever it had is closed.
+    """
+
+    def __init__(
+        self,
+        expand: Callable[[tuple], tuple],
+        prepare: Callable[[list], tuple],
+        rescan_interval: float = DEFAULT_CONTEXT_RESCAN_INTERVAL,
+    ):
+        self.expand = expand
+        self.prepare = prepare
+        self.rescan_interval = rescan_interval
+        self._contexts = {}
+        self._lock = threading.Lock()
+
+    def open(self, patterns: tuple) -> Context:
+        """
+        Return the context of a set of patterns, prepared again if its files changed. Raises
+        FileNotFoundError when a pattern matches no file.
+        """
+        with self._lock:
+            context = self._contexts.get(patterns)
+            if context is None:
+                context = self._contexts[patterns] = Context()
+
+        with context.lock:
+            now = time.monotonic()
+            stamp = None
+            if context.stamp is not None and now - context.scanned < self.rescan_interval:
+                stamp = self._stamp(context.files)
+            if stamp is None:
+                # Not expanded yet, due for a rescan, or a file is gone
+                context.files, context.skipped = self.expand(patterns)
+                context.scanned = now
+                stamp = self._stamp(context.files)
+
+            if stamp != context.stamp:
+                retriever = context.retriever
+                context.messages, context.retriever = self.prepare(context.files)
+                context.stamp = stamp
+                if retriever is not None:
+                    retriever.close()
+        return context
+
+    def stats(self) -> dict:
+        """
+        Return the number of contexts in memory and of their files
+        """
+        with self._lock:
+            contexts = list(self._contexts.values())
+        return {"open": len(contexts), "files": sum(len(c.files) for c in contexts)}
+
+    def close(self) -> None:
+        """
+        Close the retrievers of the contexts
+        """
+        with self._lock:
+            for context in self._contexts.values():
+                with context.lock:
+                    if context.retriever is not None:
+                        context.retriever.close()
+            self._contexts.clear()
+
+    @staticmethod
+    def _stamp(files: list) -> Optional[tuple]:
+        try:
+            return tuple((path, path.stat().st_mtime_ns) for path in files)
+        except FileNotFoundError:
+            return None
+
+
+class ChatDaemon:
+    """
+    Serves the requests of thin clients on a Unix socket, from a process that stays warm between
+    them: modules imported, connections pooled, context files and conversations loaded.
+
+    Clients send requests as JSON lines and read the events of each answer as JSON lines, the last
+    one has either "done" or "error". Several requests can be sent over a connection, connections
+    are served concurrently, a thread each. Requests are passed to handle along with a function
+    sending an event back, except for the "status" and "stop" commands.
+
+    The daemon stops on a stop command, or after idle_timeout seconds without any client connected
+    (0 to never stop on its own).
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        handle: Callable[[dict, Callable[[dict], None]], None],
+        idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+    ):
+        self.path = Path(path)
+        self.handle = handle
+        self.idle_timeout = idle_timeout
+        self.sources = {}
+
+        self._lock = threading.Lock()
+        self._connections = 0
+        self._requests = 0
+        self._started = time.monotonic()
+        self._last_active = self._started
+        self._stopped = threading.Event()
+
+    @classmethod
+    def from_config(
+        cls, path: Path, handle: Callable[[dict, Callable[[dict], None]], None], config: dict
+    ) -> "ChatDaemon":
+        """
+        Build a daemon from the daemon settings of the config file
+        """
+        return cls(path, handle, config.get("daemon_idle_timeout", DEFAULT_IDLE_TIMEOUT))
+
+    def add_source(self, name: str, stats: Callable[[], dict]) -> None:
+        """
+        Register a function returning statistics to include in the status
+        """
+        self.sources[name] = stats
+
+    def serve(self) -> None:
+        """
+        Listen on the socket until stopped or idle for too long
+        """
+        # Imported here, the thin client only imports this module for the protocol
+        import socketserver
+
+        self._remove_stale_socket()
+
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self) -> None:
+                daemon._serve_connection(self.rfile, self.wfile)
+
+        # Only the user running the daemon can connect to it
+        umask = os.umask(0o177)
+        try:
+            server = socketserver.ThreadingUnixStreamServer(str(self.path), Handler)
+        finally:
+            os.umask(umask)
+        server.daemon_threads = True
+
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            while not self._stopped.wait(IDLE_CHECK_INTERVAL):
+                if self.idle_timeout and self._idle() >= self.idle_timeout:
+                    break
+        finally:
+            server.shutdown()
+            server.server_close()
+            self.path.unlink(missing_ok=True)
+
+    def stop(self) -> None:
+        """
+        Stop serving, from any thread
+        """
+        self._stopped.set()
+
+    def status(self) -> dict:
+        """
+        Return the process id, uptime, connections and requests served, and the registered stats
+        """
+        with self._lock:
+            status = {
+                "pid": os.getpid(),
+                "uptime": round(time.monotonic() - self._started, 1),
+                "connections": self._connections,
+                "requests": self._requests,
+            }
+        for name, stats in self.sources.items():
+            status[name] = stats()
+        return status
+
+    def _serve_connection(self, rfile: IO, wfile: IO) -> None:
+        with self._lock:
+            self._connections += 1
+        try:
+            while True:
+                try:
+                    request = read_message(rfile)
+                except ValueError:
+                    send_message(wfile, {"error": "Invalid request"})
+                    return
+                if request is None:
+                    return
+
+                with self._lock:
+                    self._requests += 1
+
+                command = request.get("command")
+                if command == "stop":
+                    send_message(wfile, {"done": True})
+                    self.stop()
+                    return
+                if command == "status":
+                    send_message(wfile, {"done": True, "status": self.status()})
+                    continue
+
+                try:
+                    self.handle(request, lambda event: send_message(wfile, event))
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client went away in the middle of the answer
+                    return
+                except Exception as e:
+                    import traceback
+
+                    # A bug in a request must not take down the daemon and its other clients
+                    traceback.print_exc(file=sys.stderr)
+                    send_message(wfile, {"error": f"Internal error: {e}"})
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with self._lock:
+                self._connections -= 1
+                self._last_active = time.monotonic()
+
+    def _idle(self) -> float:
+        with self._lock:
+            if self._connections:
+                return 0.0
+            return time.monotonic() - self._last_active
+
+    def _remove_stale_socket(self) -> None:
+        # A socket left by a daemon that was killed refuses connections
+        try:
+            connect(self.path).close()
+        except FileNotFoundError:
+            return
+        except ConnectionRefusedError:
+            self.path.unlink(missing_ok=True)
+            return
+        raise RuntimeError(f"A daemon is already listening on {self.path}")
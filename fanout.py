@@ -0,0 +1,42 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from client import APIConnectionError, APIError
+from scheduler import RequestScheduler
+
+
+async def fan_out(bodies: dict, scheduler: RequestScheduler) -> list:
+    """
+    Send requests to several models at once and return the result of each, in the order given.
+
+    bodies maps each model to its request body. Each result has the model asked, the model that
+    answered (a fallback one if the model failed), the latency and timings, and either the message
+    and usage or an "error" for requests that still failed after the retries.
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=len(bodies))
+
+    def request(model: str, body: dict) -> dict:
+        result = {"model": model}
+        start = time.perf_counter()
+        try:
+            response = scheduler.chat(body)
+        except (APIConnectionError, APIError) as e:
+            result["error"] = str(e)
+        else:
+            # The scheduler keeps the model and timings of the last request per thread
+            result["answered_by"] = scheduler.last_model
+            result["timing"] = scheduler.last_timing
+            result["message"] = response["choices"][0]["message"]
+            result["usage"] = response["usage"]
+        result["latency"] = time.perf_counter() - start
+        return result
+
+    try:
+        futures = [
+            loop.run_in_executor(executor, request, model, body) for model, body in bodies.items()
+        ]
+        return await asyncio.gather(*futures)
+    finally:
+        executor.shutdown(wait=False)
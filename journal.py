@@ -0,0 +1,79 @@
+import json
+from pathlib import Path
+from typing import Iterator
+
+
+class SessionJournal:
+    """
+    Append-only JSONL journal of a session, one message per line.
+
+    Each turn only appends the messages added since the last sync and flushes them, so the cost per
+    turn doesn't depend on the session length and a crash loses at most the turn in progress.
+    """
+
+    def __init__(self, path: Path, written: int = 0):
+        self.path = Path(path)
+        self.written = written
+        self._drop_partial_line()
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def sync(self, messages: list) -> None:
+        """
+        Append the messages that are not in the journal yet and flush them to disk
+        """
+        new_messages = messages[self.written:]
+        if not new_messages:
+            return
+
+        self._file.write(
+            "".join(json.dumps(m, ensure_ascii=False) + "\n" for m in new_messages)
+        )
+        self._file.flush()
+        self.written = len(messages)
+
+    def close(self) -> None:
+        """
+        Close the journal file
+        """
+        self._file.close()
+
+    def _drop_partial_line(self) -> None:
+        # A crash in the middle of a write leaves a truncated last line, cut it before appending
+        if not self.path.exists():
+            return
+
+        with open(self.path, "rb+") as f:
+            end = f.seek(0, 2)
+            position = end
+            while position > 0:
+                start = max(position - 4096, 0)
+                f.seek(start)
+                block = f.read(position - start)
+                newline = block.rfind(b"\n")
+                if newline != -1:
+                    position = start + newline + 1
+                    break
+                position = start
+
+            if position != end:
+                f.truncate(position)
+
+
+def read_journal(path: Path) -> Iterator[dict]:
+    """
+    Stream the messages of a saved session, line by line.
+
+    Plain JSON sessions saved by older versions are supported too. A truncated last line, left by
+    a crash in the middle of a write, is ignored.
+    """
+    path = Path(path)
+    if path.suffix == ".json":
+        with open(path, encoding="utf-8") as f:
+            yield from json.load(f)
+        return
+
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            yield json.loads(line)
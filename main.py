@@ -1,31 +1,67 @@
+from __future__ import annotations
+
 import atexit
+import contextlib
 import os
 import click
 import datetime
-import requests
 import sys
-import yaml
-import json
+from functools import lru_cache
+import time
 from pathlib import Path
-from prompt_toolkit import PromptSession, HTML
-from prompt_toolkit.history import FileHistory
+from typing import TYPE_CHECKING, Callable, Optional
 from rich.console import Console
-from rich.markdown import Markdown
-from dotenv import load_dotenv
+from cache import ResponseCache, cache_key
+from client import (
+    DEFAULT_POOL_SIZE,
+    APICancelledError,
+    APIConnectionError,
+    APIError,
+    APITimeoutError,
+    ChatClient,
+)
+from context_window import ContextWindow
+from journal import SessionJournal, read_journal
+from metrics import DURATIONS, MEASUREMENTS, Metrics
+from rendering import Renderer
+from retrieval import (
+    DEFAULT_BUDGET,
+    DEFAULT_CHUNK_TOKENS,
+    DEFAULT_TOP_K,
+    ContextIndex,
+    ContextRetriever,
+    expand_paths,
+    read_text,
+)
+from scheduler import RequestScheduler
+from search import DEFAULT_LIMIT, HIGHLIGHT_END, HIGHLIGHT_START, SessionIndex
 
-# Load environment variables from .env file. This will read the file and set the environment variables.
-load_dotenv()
+# Heavy modules (prompt_toolkit, rich.markdown, yaml, the HTTP stack...) are imported where they
+# are first needed, so that the prompt shows up as fast as possible.
+if TYPE_CHECKING:
+    from prompt_toolkit import HTML, PromptSession
+    from daemon import Contexts, Conversations
+    from prompt_history import PromptHistory
+    from repl import Repl
 
 # Define some constants and global variables. These are used throughout the script.
 WORKDIR = Path(__file__).parent
 CONFIG_FILE = Path(WORKDIR, "config.yaml")
-HISTORY_FILE = Path(WORKDIR, ".history")
+HISTORY_FILE = Path(WORKDIR, ".history.sqlite")
+# Plain text history of earlier versions, imported into the database once
+LEGACY_HISTORY_FILE = Path(WORKDIR, ".history")
+CACHE_FILE = Path(WORKDIR, ".cache.sqlite")
+CONTEXT_INDEX_FILE = Path(WORKDIR, ".context-index.sqlite")
+# Context files skipped (binary or too big) listed by name, the others are only counted
+MAX_SKIPPED_SHOWN = 5
 BASE_ENDPOINT = "https://api.openai.com/v1"
 SAVE_FOLDER = "session-history"
 SAVE_FILE = (
-    "chatgpt-session-" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + ".json"
+    "chatgpt-session-" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + ".jsonl"
 )
 
+MARKDOWN_INSTRUCTION = "Always use code blocks with the appropriate language tags. If asked for a table, always format it using Markdown syntax."
+
 # Pricing rate per model, these are constants. 
 PRICING_RATE = {
     "gpt-3.5-turbo": {"prompt": 0.0015, "completion": 0.002},
@@ -37,6 +73,17 @@ PRICING_RATE = {
     "gpt-4-32k-0613": {"prompt": 0.06, "completion": 0.12},
 }
 
+# Context window size per model, in tokens.
+CONTEXT_WINDOW = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-0613": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-4": 8192,
+    "gpt-4-0613": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-32k-0613": 32768,
+}
+
 # Initialize the messages history list
 # It's mandatory to pass it at each API call in order to have a conversation
 messages = []
@@ -54,11 +101,29 @@ def load_config(config_file: str) -> dict:
     """
     Read a YAML config file and return its content as a dictionary
     """
+    import yaml
+
     with open(config_file) as file:
         config = yaml.load(file, Loader=yaml.FullLoader)
 
     return config
 
+def load_api_key() -> Optional[str]:
+    """
+    Load environment variables from the .env file and return the API key
+    """
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    return os.getenv("OPENAI_API_KEY")
+
+def load_base_endpoint(config: dict) -> str:
+    """
+    Return the API endpoint: the OPENAI_BASE_URL environment variable (which can be set in the
+    .env file), the base_endpoint config parameter, or the OpenAI API
+    """
+    return os.getenv("OPENAI_BASE_URL") or config.get("base_endpoint", BASE_ENDPOINT)
+
 def create_save_folder() -> None:
     """
     Create the session history folder if it doesn't exist
@@ -70,8 +135,15 @@ def add_markdown_system_message() -> None:
     """
     Try to force ChatGPT to always respond with well-formatted code blocks and tables if markdown is enabled.
     """
-    instruction = "Always use code blocks with the appropriate language tags. If asked for a table, always format it using Markdown syntax."
-    messages.append({"role": "system", "content": instruction})
+    messages.append({"role": "system", "content": MARKDOWN_INSTRUCTION})
+
+def new_conversation(config: dict) -> list:
+    """
+    First messages of a conversation started by the daemon, as the interactive session starts
+    """
+    if config["markdown"]:
+        return [{"role": "system", "content": MARKDOWN_INSTRUCTION}]
+    return []
 
 def calculate_expense(
     prompt_tokens: int,
@@ -87,111 +159,671 @@ def calculate_expense(
     )
     return round(expense, 6)
 
-def display_expense(model: str) -> None:
+def request_expense(model: str, usage: dict) -> Optional[float]:
     """
-    Given the model used, display the total tokens used and estimated expense
+    Calculate the expense of a single request, None if the pricing of the model is unknown
     """
-    total_expense = calculate_expense(
-        prompt_tokens,
-        completion_tokens,
+    if model not in PRICING_RATE:
+        return None
+    return calculate_expense(
+        usage["prompt_tokens"],
+        usage["completion_tokens"],
         PRICING_RATE[model]["prompt"],
         PRICING_RATE[model]["completion"],
     )
-    console.print(
-        f"\nTotal tokens used: [green bold]{prompt_tokens + completion_tokens}"
-    )
-    console.print(f"Estimated expense: [green bold]${total_expense}")
 
-def start_prompt(session: PromptSession, config: dict) -> None:
+def display_expense(metrics: Metrics) -> None:
     """
-    Ask the user for input, build the request, and perform it
+    Display the total tokens used and estimated expense, per model if several were used
     """
+    # Only the totals, the registered sources are closed by the time this runs at exit
+    models = metrics.totals()
+    total_tokens = sum(t["prompt_tokens"] + t["completion_tokens"] for t in models.values())
+    total_expense = round(sum(t["cost"] for t in models.values()), 6)
+    cached_tokens = sum(t["cached_tokens"] for t in models.values())
 
-    # TODO: Refactor to avoid using global variables
-    global prompt_tokens, completion_tokens
+    console.print(f"\nTotal tokens used: [green bold]{total_tokens}")
+    console.print(f"Estimated expense: [green bold]${total_expense}")
+    if len(models) > 1:
+        for model, totals in models.items():
+            console.print(
+                f"  {model}: {totals['prompt_tokens'] + totals['completion_tokens']} tokens, "
+                f"${round(totals['cost'], 6)}"
+            )
+    unpriced = [model for model in models if model not in PRICING_RATE]
+    if unpriced:
+        console.print(f"No pricing for {', '.join(unpriced)}, not included in the expense")
+    if cached_tokens:
+        console.print(f"Tokens served from cache (free): [green bold]{cached_tokens}")
 
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {os.getenv('OPENAI_API_KEY')}",  # Here's where we use the API Key from the environment variable
-    }
+def prompt_message(repl: Repl) -> HTML:
+    """
+    Build the prompt, with the tokens used so far and the number of answers still pending
+    """
+    from prompt_toolkit import HTML
 
-    message = session.prompt(HTML(f"<b>[{prompt_tokens + completion_tokens}] >>> </b>"))
+    pending = f" ({repl.pending} pending)" if repl.pending else ""
+    return HTML(f"<b>[{prompt_tokens + completion_tokens}]{pending} >>> </b>")
 
-    if message.lower() == "/q":
+def handle_message(
+    message: str,
+    config: dict,
+    scheduler: RequestScheduler,
+    window: ContextWindow,
+    cache: Optional[ResponseCache],
+    index: SessionIndex,
+    retriever: Optional[ContextRetriever],
+    metrics: Metrics,
+    renderer: Renderer,
+    repl: Repl,
+    history: PromptHistory,
+) -> None:
+    """
+    Handle a line typed by the user: commands run right away, fan-outs in the background, and
+    messages are queued to be answered in order
+    """
+    if message.lower() in ("/q", ""):
         raise EOFError
-    if message.lower() == "":
-        raise KeyboardInterrupt
 
-    messages.append({"role": "user", "content": message})
+    command, _, argument = message.partition(" ")
+    if command == "/fanout" and argument.strip():
+        models = config.get("fanout_models") or list(PRICING_RATE)
+        prompt = argument.strip()
+        repl.spawn(fan_out_prompt(prompt, models, config, scheduler, retriever, metrics, renderer))
+        return
+    if message.startswith("/") and run_command(message, index, metrics, repl, history):
+        return
+
+    repl.submit(run_turn, message, config, scheduler, window, cache, retriever, metrics, renderer)
+
+def build_request(
+    request_messages: list,
+    model: str,
+    config: dict,
+    window: ContextWindow,
+    retriever: Optional[ContextRetriever],
+) -> tuple:
+    """
+    Build the request body of a conversation ending with a user message, and return it with the
+    number of tokens trimmed to fit the context window of the model
+    """
+    # Only the parts of the context files relevant to this message are sent along with it
+    if retriever is not None:
+        context_message = retriever.context_message(request_messages[-1]["content"])
+        if context_message is not None:
+            request_messages = request_messages[:-1] + [context_message, request_messages[-1]]
+
+    # Keep the request within the context window of the model
+    request_messages, saved_tokens = window.fit(request_messages)
 
     body = {
-        "model": config["model"],
+        "model": model,
         "temperature": config["temperature"],
-        "messages": messages,
+        "messages": request_messages,
     }
 
     if "max_tokens" in config:
         body["max_tokens"] = config["max_tokens"]
 
+    return body, saved_tokens
+
+def run_turn(
+    message: str,
+    config: dict,
+    scheduler: RequestScheduler,
+    window: ContextWindow,
+    cache: Optional[ResponseCache],
+    retriever: Optional[ContextRetriever],
+    metrics: Metrics,
+    renderer: Renderer,
+) -> None:
+    """
+    Build the request of a user message, perform it and display the answer
+    """
+
+    # TODO: Refactor to avoid using global variables
+    global prompt_tokens, completion_tokens
+
+    messages.append({"role": "user", "content": message})
+    build_start = time.perf_counter()
+
+    body, saved_tokens = build_request(messages, config["model"], config, window, retriever)
+    if saved_tokens:
+        console.print(f"Context trimmed, {saved_tokens} tokens saved", style="dim")
+
+    # Identical deterministic requests are answered from the cache, without touching the network
+    key = None
+    if cache is not None:
+        key = cache_key(body)
+        cached = None if config.get("cache_bypass") else cache.get(key)
+        if cached is not None:
+            message_response = cached["choices"][0]["message"]
+
+            build = time.perf_counter() - build_start
+            console.line()
+            render_start = time.perf_counter()
+            renderer.render(message_response["content"])
+            timing = {"build": build, "render": time.perf_counter() - render_start}
+            # A question asked again on purpose must not pass an old answer off as a new one
+            console.print("(cached, use --no-cache for a fresh answer)", style="dim")
+
+            messages.append(message_response)
+            metrics.record(body["model"], cached["usage"], timing, cached=True)
+            return
+
+    stream = config.get("stream", False)
+    if stream:
+        body["stream"] = True
+        body["stream_options"] = {"include_usage": True}
+    build = time.perf_counter() - build_start
+
     try:
-        r = requests.post(
-            f"{BASE_ENDPOINT}/chat/completions", headers=headers, json=body
-        )
-    except requests.ConnectionError:
-        console.print("Connection error, try again...", style="red bold")
+        if stream:
+            from streaming import stream_chat_completion
+
+            lines = scheduler.stream(body)
+            console.line()
+            result = stream_chat_completion(
+                lines, console, config["markdown"], body["messages"], renderer
+            )
+            message_response = result["message"]
+            usage_response = result["usage"]
+            response = {"choices": [{"message": message_response}], "usage": usage_response}
+
+            parse, render = result["parse"], result["render"]
+            # Throughput of a stream is measured once the first token arrived
+            generation = None
+            if result["ttft"] is not None:
+                generation = result["elapsed"] - result["ttft"]
+        else:
+            response = scheduler.chat(body)
+
+            message_response = response["choices"][0]["message"]
+            usage_response = response["usage"]
+
+            console.line()
+            render_start = time.perf_counter()
+            renderer.render(message_response["content"])
+
+            parse, render = scheduler.last_timing["parse"], time.perf_counter() - render_start
+            generation = None
+    except APICancelledError:
+        console.print("Answer cancelled", style="yellow")
         messages.pop()
-        raise KeyboardInterrupt
-    except requests.Timeout:
+        return
+    except APITimeoutError:
         console.print("Connection timed out, try again...", style="red bold")
         messages.pop()
-        raise KeyboardInterrupt
+        return
+    except APIConnectionError:
+        console.print("Connection error, try again...", style="red bold")
+        messages.pop()
+        return
+    except APIError as e:
+        if e.status_code == 401:
+            console.print("Unauthorized. Check your API key.", style="red bold")
+            sys.exit(1)
+        # Transient errors were already retried, the session goes on
+        console.print(f"Error: {e.status_code}, try again...", style="red bold")
+        messages.pop()
+        return
+
+    # An answer from a fallback model is not cached under the original request
+    if key is not None and scheduler.last_model == body["model"]:
+        cache.put(key, response)
+
+    messages.append(message_response)
+
+    # Calculate tokens
+    prompt_tokens += usage_response["prompt_tokens"]
+    completion_tokens += usage_response["completion_tokens"]
+
+    timing = scheduler.last_timing
+    timing = {
+        "build": build,
+        "encode": timing["encode"],
+        "sent_bytes": timing["bytes"],
+        "connect": timing["connect"],
+        "ttfb": timing["ttfb"],
+        "request": timing["total"],
+        "parse": parse,
+        "render": render,
+        "generation": generation,
+    }
+    model = scheduler.last_model
+    metrics.record(model, usage_response, timing, request_expense(model, usage_response))
+
+async def fan_out_prompt(
+    message: str,
+    models: list,
+    config: dict,
+    scheduler: RequestScheduler,
+    retriever: Optional[ContextRetriever],
+    metrics: Metrics,
+    renderer: Renderer,
+) -> None:
+    """
+    Send the conversation and a message to several models at once and display their answers side
+    by side. The answers are not added to the conversation.
+    """
+    from fanout import fan_out
+
+    request_messages = messages + [{"role": "user", "content": message}]
+    bodies = {}
+    for model in models:
+        window = ContextWindow.from_config(
+            dict(config, model=model),
+            CONTEXT_WINDOW,
+            notify=lambda text: console.print(text, style="yellow"),
+        )
+        bodies[model], _ = build_request(request_messages, model, config, window, retriever)
+
+    console.print(f"Asking {', '.join(models)}...", style="dim")
+    results = await fan_out(bodies, scheduler)
+
+    for result in results:
+        if "error" in result:
+            continue
+        model, usage, timing = result["answered_by"], result["usage"], result["timing"]
+        metrics.record(
+            model,
+            usage,
+            {
+                "encode": timing["encode"],
+                "sent_bytes": timing["bytes"],
+                "connect": timing["connect"],
+                "ttfb": timing["ttfb"],
+                "request": timing["total"],
+                "parse": timing["parse"],
+            },
+            request_expense(model, usage),
+        )
+
+    print_fan_out(results, renderer)
+
+def print_fan_out(results: list, renderer: Renderer) -> None:
+    """
+    Display the answers of several models side by side, fastest first, with their latency, tokens
+    and expense
+    """
+    from rich.table import Table
+    from rich.text import Text
+    from rendering import Block
+
+    results = sorted(results, key=lambda result: ("error" in result, result["latency"]))
+
+    table = Table(show_header=True, header_style="bold", show_lines=True)
+    table.add_column("")
+    for result in results:
+        header = result["model"]
+        if result.get("answered_by", header) != header:
+            header += f" ({result['answered_by']})"
+        table.add_column(header, ratio=1)
 
-    if r.status_code == 200:
-        response = r.json()
+    answers, latencies, tokens, expenses = [], [], [], []
+    for result in results:
+        latencies.append(f"{result['latency']:.2f}s")
+        if "error" in result:
+            answers.append(Text(result["error"], style="red"))
+            tokens.append("")
+            expenses.append("")
+            continue
 
-        message_response = response["choices"][0]["message"]
-        usage_response = response["usage"]
+        answers.append(renderer.renderable(Block(result["message"]["content"])))
+        usage = result["usage"]
+        tokens.append(f"{usage['prompt_tokens']} + {usage['completion_tokens']}")
+        expense = request_expense(result["answered_by"], usage)
+        expenses.append("n/a" if expense is None else f"${expense:.6f}")
 
-        console.line()
-        if config["markdown"]:
-            console.print(Markdown(message_response["content"]))
+    table.add_row("Answer", *answers)
+    table.add_row("Latency", *latencies)
+    table.add_row("Tokens", *tokens)
+    table.add_row("Expense", *expenses)
+    console.line()
+    console.print(table)
+
+def print_search_results(results: list) -> None:
+    """
+    Display search results with their session name, turn number and highlighted snippet
+    """
+    from rich.markup import escape
+    from rich.table import Table
+
+    if not results:
+        console.print("No results", style="yellow")
+        return
+
+    table = Table(show_header=True, header_style="bold")
+    table.add_column("Session")
+    table.add_column("Turn", justify="right")
+    table.add_column("Match")
+    for result in results:
+        snippet = (
+            escape(" ".join(result["snippet"].split()))
+            .replace(HIGHLIGHT_START, "[bold yellow]")
+            .replace(HIGHLIGHT_END, "[/bold yellow]")
+        )
+        table.add_row(result["session"], str(result["turn"]), f"{result['role']}: {snippet}")
+    console.print(table)
+
+def print_history_results(entries: list) -> None:
+    """
+    Display the prompts found in the history, most recent first
+    """
+    if not entries:
+        console.print("No results", style="yellow")
+        return
+
+    from rich.text import Text
+
+    # Multiline prompts are shown by their first line
+    for entry in entries:
+        lines = entry.splitlines() or [""]
+        text = Text(lines[0])
+        if len(lines) > 1:
+            text.append(f" (+{len(lines) - 1} lines)", style="dim")
+        console.print(text)
+
+def print_stats(metrics: Metrics) -> None:
+    """
+    Display the latency and throughput percentiles, the usage per model and the statistics of
+    the connections, cache and retries
+    """
+    from rich.table import Table
+
+    summary = metrics.summary()
+
+    table = Table(show_header=True, header_style="bold")
+    table.add_column("Measurement")
+    for column in ("Count", "p50", "p90", "p99", "Max"):
+        table.add_column(column, justify="right")
+    for name in MEASUREMENTS:
+        histogram = summary["measurements"][name]
+        if not histogram["count"]:
+            continue
+        # Durations are shown in milliseconds
+        if name in DURATIONS:
+            label, scale, digits = f"{name} (ms)", 1000, 1
+        elif name == "sent_bytes":
+            label, scale, digits = "sent (bytes)", 1, 0
         else:
-            console.print(message_response["content"])
+            label, scale, digits = "tokens/s", 1, 1
+        values = [f"{histogram[key] * scale:.{digits}f}" for key in ("p50", "p90", "p99", "max")]
+        table.add_row(label, str(histogram["count"]), *values)
+    console.print(table)
 
-        messages.append(message_response)
+    table = Table(show_header=True, header_style="bold")
+    table.add_column("Model")
+    for column in ("Turns", "Prompt", "Completion", "Cached", "Expense"):
+        table.add_column(column, justify="right")
+    for model, totals in summary["models"].items():
+        table.add_row(
+            model,
+            str(totals["turns"]),
+            str(totals["prompt_tokens"]),
+            str(totals["completion_tokens"]),
+            str(totals["cached_tokens"]),
+            f"${totals['cost']:.6f}",
+        )
+    console.print(table)
 
-        # Calculate tokens
-        prompt_tokens += usage_response["prompt_tokens"]
-        completion_tokens += usage_response["total_tokens"]
+    for name, stats in summary["sources"].items():
+        values = ", ".join(f"{key} {value}" for key, value in stats.items())
+        console.print(f"{name.capitalize()}: {values}", style="dim")
 
-    elif r.status_code == 401:
-        console.print("Unauthorized. Check your API key.", style="red bold")
-        sys.exit(1)
-    else:
-        console.print(f"Error: {r.status_code}", style="red bold")
-        sys.exit(1)
+def run_command(
+    message: str, index: SessionIndex, metrics: Metrics, repl: Repl, history: PromptHistory
+) -> bool:
+    """
+    Run an in-session slash command, return False if the message is not a known command
+    """
+    command, _, argument = message.partition(" ")
+    argument = argument.strip()
+
+    if command == "/stats":
+        print_stats(metrics)
+        return True
+
+    if command == "/search" and argument:
+        index.update()
+        print_search_results(index.search(argument))
+        return True
+
+    if command == "/history" and argument:
+        print_history_results(history.search(argument))
+        return True
+
+    if command == "/open" and argument:
+        # The messages of the session become part of the current conversation
+        path = index.session_path(argument)
+        if path is None:
+            console.print(f"Session not found: {argument}", style="red bold")
+        else:
+            loaded = [m for m in read_journal(path) if m["role"] != "system"]
+            # After the answers still pending, so that the conversation stays in order
+            repl.submit(messages.extend, loaded)
+            console.print(f"Loaded {len(loaded)} messages from {path.stem}", style="dim")
+        return True
+
+    return False
 
-def load_context_files(context_files) -> None:
+def load_context_files(context_files: list) -> list:
     """
-    Load context files and append their content to the messages
+    Read context files and return a system message with the content of each one
     """
-    for file in context_files:
-        messages.append({"role": "system", "content": file.read()})
+    return [{"role": "system", "content": read_text(path)} for path in context_files]
 
-@click.command()
+def index_context(context_files: list, config: dict) -> tuple:
+    """
+    Index the context files and return either their messages and no retriever, when they fit in
+    the context budget, or no messages and a retriever that selects the relevant chunks at each
+    turn
+    """
+    budget = config.get("context_budget", DEFAULT_BUDGET)
+    context_index = ContextIndex(
+        CONTEXT_INDEX_FILE, config.get("context_chunk_tokens", DEFAULT_CHUNK_TOKENS)
+    )
+    context_index.update(context_files)
+
+    if context_index.total_tokens() <= budget:
+        context_index.close()
+        return load_context_files(context_files), None
+
+    return [], ContextRetriever(context_index, config.get("context_top_k", DEFAULT_TOP_K), budget)
+
+def prepare_context(patterns: tuple, config: dict) -> Optional[ContextRetriever]:
+    """
+    Load the context files into the messages when they fit in the context budget, otherwise
+    return a retriever that selects the relevant chunks at each turn. "-" reads one more context
+    message from stdin, always sent whole.
+    """
+    if "-" in patterns:
+        messages.append({"role": "system", "content": sys.stdin.read()})
+        # The questions are then typed in the terminal, when there is one
+        if not sys.stdin.isatty() and sys.stdout.isatty():
+            with contextlib.suppress(OSError):
+                sys.stdin = open("CON" if os.name == "nt" else "/dev/tty")
+        patterns = tuple(pattern for pattern in patterns if pattern != "-")
+        if not patterns:
+            return None
+
+    try:
+        context_files, skipped = expand_paths(patterns)
+    except FileNotFoundError as e:
+        raise click.BadParameter(str(e), param_hint="--context")
+
+    for path, reason in skipped[:MAX_SKIPPED_SHOWN]:
+        console.print(f"Context file skipped ({reason}): {path}", style="yellow")
+    if len(skipped) > MAX_SKIPPED_SHOWN:
+        console.print(
+            f"{len(skipped) - MAX_SKIPPED_SHOWN} more context files skipped", style="yellow"
+        )
+
+    context_messages, retriever = index_context(context_files, config)
+    messages.extend(context_messages)
+    return retriever
+
+def serve_request(
+    request: dict,
+    send: Callable[[dict], None],
+    config: dict,
+    scheduler: RequestScheduler,
+    window: Callable[[str], ContextWindow],
+    cache: Optional[ResponseCache],
+    metrics: Metrics,
+    conversations: Conversations,
+    contexts: Contexts,
+) -> None:
+    """
+    Answer a message sent to the daemon, on its own or as part of a named conversation, sending
+    the text back as it arrives and a last event with the model, usage and cost. window returns
+    the context window of a model.
+    """
+    from daemon import forward_stream
+
+    try:
+        context = None
+        if request.get("context"):
+            context = contexts.open(tuple(request["context"]))
+        conversation = None
+        if request.get("session"):
+            conversation = conversations.open(request["session"])
+    except (FileNotFoundError, ValueError) as e:
+        send({"error": str(e)})
+        return
+
+    # Context files are sent along with each message rather than stored in the conversation, so
+    # that a conversation always gets their current content
+    if conversation is None:
+        history, lock = new_conversation(config), contextlib.nullcontext()
+    else:
+        history, lock = conversation.messages, conversation.lock
+    context_lock = contextlib.nullcontext() if context is None else context.lock
+
+    with lock:
+        user_message = {"role": "user", "content": request["message"]}
+        build_start = time.perf_counter()
+
+        model = request.get("model") or config["model"]
+        # The retriever of a context is closed when its files change, it's used under its lock
+        with context_lock:
+            context_messages, retriever = [], None
+            if context is not None:
+                context_messages, retriever = context.messages, context.retriever
+            body, saved_tokens = build_request(
+                context_messages + history + [user_message], model, config, window(model), retriever
+            )
+        if saved_tokens:
+            send({"notice": f"Context trimmed, {saved_tokens} tokens saved"})
+
+        key = None
+        cached = None
+        if cache is not None:
+            key = cache_key(body)
+            if not request.get("no_cache"):
+                cached = cache.get(key)
+
+        if cached is not None:
+            message_response = cached["choices"][0]["message"]
+            usage_response = cached["usage"]
+            model, cost = body["model"], 0.0
+            send({"notice": "(cached, use --no-cache for a fresh answer)"})
+            send({"text": message_response["content"]})
+            metrics.record(
+                model, usage_response, {"build": time.perf_counter() - build_start}, cached=True
+            )
+        else:
+            # Always streamed, the client shows the answer as it arrives
+            body["stream"] = True
+            body["stream_options"] = {"include_usage": True}
+            build = time.perf_counter() - build_start
+
+            try:
+                result = forward_stream(scheduler.stream(body), send, body["messages"])
+            except APITimeoutError:
+                send({"error": "Connection timed out, try again..."})
+                return
+            except APIConnectionError:
+                send({"error": "Connection error, try again..."})
+                return
+            except APIError as e:
+                if e.status_code == 401:
+                    send({"error": "Unauthorized. Check your API key."})
+                else:
+                    send({"error": f"Error: {e.status_code}, try again..."})
+                return
+
+            message_response = result["message"]
+            usage_response = result["usage"]
+            model = scheduler.last_model
+            if key is not None and model == body["model"]:
+                response = {"choices": [{"message": message_response}], "usage": usage_response}
+                cache.put(key, response)
+
+            timing = scheduler.last_timing
+            timing = {
+                "build": build,
+                "encode": timing["encode"],
+                "sent_bytes": timing["bytes"],
+                "connect": timing["connect"],
+                "ttfb": timing["ttfb"],
+                "request": timing["total"],
+                "parse": result["parse"],
+                "generation": (
+                    result["elapsed"] - result["ttft"] if result["ttft"] is not None else None
+                ),
+            }
+            cost = request_expense(model, usage_response)
+            metrics.record(model, usage_response, timing, cost)
+
+        if conversation is not None:
+            conversation.messages.extend([user_message, message_response])
+            conversation.journal.sync(conversation.messages)
+
+    send(
+        {
+            "done": True,
+            "model": model,
+            "usage": usage_response,
+            "cost": cost,
+            "cached": cached is not None,
+        }
+    )
+
+@click.group(invoke_without_command=True)
 @click.option(
     "-c",
     "--context",
     "context",
-    type=click.File("r"),
-    help="Path to a context file",
+    help="Path to a context file, a directory or a glob pattern",
     multiple=True,
 )
 @click.option("-m", "--model", "model", help="Set the model")
 @click.option(
     "-ml", "--multiline", "multiline", is_flag=True, help="Use the multiline input mode"
 )
-def main(context, model, multiline) -> None:
+@click.option(
+    "--stream/--no-stream",
+    "stream",
+    default=None,
+    help="Render the response while it is being generated",
+)
+@click.option(
+    "--no-cache", "no_cache", is_flag=True, help="Don't answer from the response cache"
+)
+@click.option(
+    "-r",
+    "--resume",
+    "resume",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Resume a saved session",
+)
+@click.pass_context
+def main(ctx, context, model, multiline, stream, no_cache, resume) -> None:
+    # Subcommands take care of themselves, without a subcommand start the interactive session
+    if ctx.invoked_subcommand is not None:
+        return
+
     config = load_config(CONFIG_FILE)
 
     if model:
@@ -200,27 +832,269 @@ def main(context, model, multiline) -> None:
     if multiline:
         config["multiline"] = multiline
 
+    if stream is not None:
+        config["stream"] = stream
+
+    if no_cache:
+        config["cache_bypass"] = True
+
     create_save_folder()
 
-    if config["markdown"]:
+    # A resumed journal keeps growing, older JSON sessions are continued in a new journal
+    journal_file = Path(SAVE_FOLDER, SAVE_FILE)
+    written = 0
+    if resume:
+        messages.extend(read_journal(resume))
+        if resume.endswith(".jsonl"):
+            journal_file = Path(resume)
+            written = len(messages)
+    elif config["markdown"]:
         add_markdown_system_message()
 
-    if context:
-        load_context_files(context)
+    journal = SessionJournal(journal_file, written)
+
+    retriever = prepare_context(context, config) if context else None
+
+    metrics = Metrics.from_config(config, SAVE_FOLDER)
+    atexit.register(display_expense, metrics)
+
+    from prompt_toolkit import PromptSession
+    from prompt_toolkit.auto_suggest import ThreadedAutoSuggest
+    from prompt_toolkit.history import ThreadedHistory
+    from prompt_history import HistorySuggest, PromptHistory
+
+    # The history is loaded in the background, the prompt shows up before it's read
+    history = PromptHistory.from_config(HISTORY_FILE, config, LEGACY_HISTORY_FILE)
+    auto_suggest = None
+    if config.get("history_suggest", True):
+        auto_suggest = ThreadedAutoSuggest(HistorySuggest(history))
+    session = PromptSession(history=ThreadedHistory(history), auto_suggest=auto_suggest)
+    metrics.add_source("history", history.stats)
+
+    # A single pooled client for the whole session, connections are kept alive between turns.
+    # The connection itself is only opened by the first request. A fan-out needs a connection per
+    # model, besides the one of the turn being answered.
+    fanout_models = config.get("fanout_models") or list(PRICING_RATE)
+    config["pool_size"] = max(config.get("pool_size", DEFAULT_POOL_SIZE), len(fanout_models) + 1)
+    api_key = load_api_key()
+    client = ChatClient.from_config(load_base_endpoint(config), api_key, config)
+    scheduler = RequestScheduler.from_config(
+        client, config, notify=lambda text: console.print(text, style="dim")
+    )
+    window = ContextWindow.from_config(
+        config, CONTEXT_WINDOW, notify=lambda text: console.print(text, style="yellow")
+    )
+    # Long code blocks are saved next to the session they come from
+    renderer = Renderer.from_config(console, config, Path(SAVE_FOLDER, "code"))
+    metrics.add_source("connections", client.stats)
+    metrics.add_source("messages", client.encoder.stats)
+    metrics.add_source("retries", scheduler.stats)
+
+    # Only deterministic requests are cached
+    cache = None
+    if config.get("cache", True) and config["temperature"] == 0:
+        cache = ResponseCache.from_config(CACHE_FILE, config)
+        metrics.add_source("cache", cache.stats)
+
+    index = SessionIndex(SAVE_FOLDER)
+
+    # Each turn is appended to the journal, a crash doesn't lose the session
+    journal.sync(messages)
+    index.update_file(journal.path)
 
-    atexit.register(display_expense, config["model"])
+    import asyncio
+    from repl import Repl
 
-    history = FileHistory(HISTORY_FILE)
-    session = PromptSession(history=history)
+    # Answers are requested in the background, the prompt stays available meanwhile
+    repl = Repl(
+        session,
+        lambda: prompt_message(repl),
+        after=lambda: (journal.sync(messages), index.update_file(journal.path)),
+        cancel=client.cancel,
+    )
+    renderer.run_in_terminal = repl.run_in_terminal
+    try:
+        asyncio.run(
+            repl.run(
+                lambda message: handle_message(
+                    message, config, scheduler, window, cache, index, retriever, metrics,
+                    renderer, repl, history
+                )
+            )
+        )
+    except KeyboardInterrupt:
+        # Interrupted while waiting for the pending answers
+        pass
+
+    scheduler.close()
+    client.close()
+    history.close()
+    if cache is not None:
+        cache.close()
+
+    journal.sync(messages)
+    journal.close()
+    index.update_file(journal.path)
+    index.close()
+    if retriever is not None:
+        retriever.index.close()
+
+@main.command()
+@click.argument("input_file", type=click.File("r"))
+@click.option(
+    "-o", "--output", "output", type=click.File("w"), default="-", help="Output JSONL file"
+)
+@click.option("-m", "--model", "model", help="Set the model")
+@click.option(
+    "-n",
+    "--concurrency",
+    "concurrency",
+    type=int,
+    help="Maximum number of requests in flight (default 8)",
+)
+@click.option("--rpm", "rpm", type=int, help="Requests per minute budget")
+@click.option("--tpm", "tpm", type=int, help="Tokens per minute budget")
+def batch(input_file, output, model, concurrency, rpm, tpm) -> None:
+    """
+    Run the prompts of a JSONL file (or - for stdin) and write the results as JSONL
+    """
+    import asyncio
+    from batch import DEFAULT_CONCURRENCY, read_jobs, run_batch
+
+    config = load_config(CONFIG_FILE)
+
+    if model:
+        config["model"] = model
+
+    concurrency = concurrency or DEFAULT_CONCURRENCY
+
+    # Enough pooled connections for every request in flight
+    config["pool_size"] = max(config.get("pool_size", 0), concurrency)
+    api_key = load_api_key()
+    client = ChatClient.from_config(load_base_endpoint(config), api_key, config)
+    scheduler = RequestScheduler.from_config(client, config)
+
+    start = time.perf_counter()
+    totals = asyncio.run(
+        run_batch(read_jobs(input_file, config), scheduler, output, concurrency, rpm, tpm)
+    )
+    elapsed = time.perf_counter() - start
+
+    scheduler.close()
+    client.close()
+
+    # The results may be written to stdout, the summary goes to stderr
+    summary = Console(stderr=True)
+    summary.print(
+        f"Processed [green bold]{totals['jobs']}[/] prompts "
+        f"([red bold]{totals['errors']}[/] errors) in [green bold]{elapsed:.1f}s"
+    )
+    summary.print(
+        f"Total tokens used: [green bold]{totals['prompt_tokens'] + totals['completion_tokens']}"
+    )
 
-    while True:
-        try:
-            start_prompt(session, config)
-        except (EOFError, KeyboardInterrupt):
-            break
+@main.command()
+@click.option(
+    "--idle-timeout",
+    "idle_timeout",
+    type=int,
+    help="Seconds without clients before stopping, 0 to never stop (default 900)",
+)
+def daemon(idle_timeout) -> None:
+    """
+    Answer the thin client (ask.py) from a warm process listening on a Unix socket
+    """
+    import signal
+    from daemon import (
+        DEFAULT_CONTEXT_RESCAN_INTERVAL,
+        SOCKET_NAME,
+        ChatDaemon,
+        Contexts,
+        Conversations,
+    )
+
+    # Imported now rather than by the first request
+    import streaming  # noqa: F401
+
+    config = load_config(CONFIG_FILE)
+
+    if idle_timeout is not None:
+        config["daemon_idle_timeout"] = idle_timeout
+
+    create_save_folder()
+
+    api_key = load_api_key()
+    client = ChatClient.from_config(load_base_endpoint(config), api_key, config)
+    scheduler = RequestScheduler.from_config(client, config)
+    # A request can pick its model, each model gets its own window. The daemon has no terminal,
+    # warnings go to its log.
+    @lru_cache(maxsize=None)
+    def window(model: str) -> ContextWindow:
+        return ContextWindow.from_config(
+            dict(config, model=model),
+            CONTEXT_WINDOW,
+            notify=lambda text: print(text, file=sys.stderr),
+        )
+    metrics = Metrics.from_config(config, SAVE_FOLDER)
+
+    # Only deterministic requests are cached
+    cache = None
+    if config.get("cache", True) and config["temperature"] == 0:
+        cache = ResponseCache.from_config(CACHE_FILE, config)
+
+    conversations = Conversations(SAVE_FOLDER, lambda: new_conversation(config))
+    contexts = Contexts(
+        expand_paths,
+        lambda files: index_context(files, config),
+        config.get("daemon_context_rescan", DEFAULT_CONTEXT_RESCAN_INTERVAL),
+    )
+
+    chat_daemon = ChatDaemon.from_config(
+        Path(WORKDIR, SOCKET_NAME),
+        lambda request, send: serve_request(
+            request, send, config, scheduler, window, cache, metrics, conversations, contexts
+        ),
+        config,
+    )
+    chat_daemon.add_source("conversations", conversations.stats)
+    chat_daemon.add_source("contexts", contexts.stats)
+    chat_daemon.add_source("connections", client.stats)
+    chat_daemon.add_source("retries", scheduler.stats)
+    chat_daemon.add_source("usage", metrics.totals)
+    if cache is not None:
+        chat_daemon.add_source("cache", cache.stats)
+
+    # Stopped by kill like by the stop command, the socket is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: chat_daemon.stop())
+    try:
+        chat_daemon.serve()
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        conversations.close()
+        contexts.close()
+        scheduler.close()
+        client.close()
+        if cache is not None:
+            cache.close()
+
+@main.command()
+@click.argument("query", nargs=-1, required=True)
+@click.option(
+    "-n", "--limit", "limit", type=int, default=DEFAULT_LIMIT, help="Maximum number of results"
+)
+def search(query, limit) -> None:
+    """
+    Search the saved sessions
+    """
+    create_save_folder()
 
-    with open(f"{SAVE_FOLDER}/{SAVE_FILE}", "w") as f:
-        json.dump(messages, f, indent=2)
+    index = SessionIndex(SAVE_FOLDER)
+    index.update()
+    print_search_results(index.search(" ".join(query), limit))
+    index.close()
 
 if __name__ == "__main__":
     main()
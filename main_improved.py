@@ -1,206 +1,376 @@
-import atexit                                                                                
- import os                                                                                    
- import click                                                                                 
- import datetime                                                                              
- import requests                                                                              
- import sys                                                                                   
- import yaml                                                                                  
- import json                                                                                  
- from pathlib import Path                                                                     
- from prompt_toolkit import PromptSession, HTML                                               
- from prompt_toolkit.history import FileHistory                                               
- from rich.console import Console                                                             
- from rich.markdown import Markdown                                                           
- from dotenv import load_dotenv                                                               
-                                                                                              
- # Load environment variables from .env file. This will read the file and set the environment                                                                               
- load_dotenv()                                                                                
-                                                                                              
- # Define some constants and global variables. These are used throughout the script.          
- WORKDIR = Path(__file__).parent                                                              
- CONFIG_FILE = Path(WORKDIR, "config.yaml")                                                   
- HISTORY_FILE = Path(WORKDIR, ".history")                                                     
- BASE_ENDPOINT = "https://api.openai.com/v1"                                                  
- SAVE_FOLDER = "session-history"                                                              
- SAVE_FILE = (                                                                                
-     "chatgpt-session-" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + ".json"         
- )                                                                                            
-                                                                                              
- # Pricing rate per model, these are constants.                                               
- PRICING_RATE = {                                                                             
-     "gpt-3.5-turbo": {"prompt": 0.0015, "completion": 0.002},                                
-     "gpt-3.5-turbo-0613": {"prompt": 0.0015, "completion": 0.002},                           
-     "gpt-3.5-turbo-16k": {"prompt": 0.003, "completion": 0.004},                             
-     "gpt-4": {"prompt": 0.03, "completion": 0.06},                                           
-     "gpt-4-0613": {"prompt": 0.03, "completion": 0.06},                                      
-     "gpt-4-32k": {"prompt": 0.06, "completion": 0.12},                                       
-     "gpt-4-32k-0613": {"prompt": 0.06, "completion": 0.12},                                  
- }                                                                                            
-                                                                                              
- # Initialize the console                                                                     
- console = Console()                                                                          
-                                                                                              
- def load_config(config_file: str) -> dict:                                                   
-     """                                                                                      
-     Read a YAML config file and return its content as a dictionary                           
-     """                                                                                      
-     with open(config_file) as file:                                                          
-         config = yaml.safe_load(file)                                                        
-                                                                                              
-     return config                                                                            
-                                                                                              
- def create_save_folder() -> None:                                                            
-     """                                                                                      
-     Create the session history folder if it doesn't exist                                    
-     """                                                                                      
-     Path(SAVE_FOLDER).mkdir(parents=True, exist_ok=True)                                     
-                                                                                              
- def calculate_expense(                                                                       
-     prompt_tokens: int,                                                                      
-     completion_tokens: int,                                                                  
-     prompt_pricing: float,                                                                   
-     completion_pricing: float,                                                               
- ) -> float:                                                                                  
-     """                                                                                      
-     Calculate the expense given the number of tokens and the pricing rates                   
-     """                                                                                      
-     expense = ((prompt_tokens / 1000) * prompt_pricing) + (                                  
-         (completion_tokens / 1000) * completion_pricing                                      
-     )                                                                                        
-     return round(expense, 6)                                                                 
-                                                                                              
- def display_expense(prompt_tokens: int, completion_tokens: int, model: str) -> None:         
-     """                                                                                      
-     Given the model used, display the total tokens used and estimated expense                
-     """                                                                                      
-     total_tokens = prompt_tokens + completion_tokens                                         
-     total_expense = calculate_expense(                                                       
-         prompt_tokens,                                                                       
-         completion_tokens,                                                                   
-         PRICING_RATE[model]["prompt"],                                                       
-         PRICING_RATE[model]["completion"],                                                   
-     )                                                                                        
-     console.print(f"\nTotal tokens used: [green bold]{total_tokens}")                        
-     console.print(f"Estimated expense: [green bold]${total_expense}")                        
-                                                                                              
- def construct_request(model: str, messages: list, config: dict) -> dict:                     
-     """                                                                                      
-     Construct the API request body                                                           
-     """                                                                                      
-     body = {                                                                                 
-         "model": model,                                                                      
-         "temperature": config["temperature"],                                                
-         "messages": messages,                                                                
-     }                                                                                        
-                                                                                              
-     if "max_tokens" in config:                                                               
-         body["max_tokens"] = config["max_tokens"]                                            
-                                                                                              
-     return body                                                                              
-                                                                                              
- def send_api_request(headers: dict, body: dict) -> dict:                                     
-     """                                                                                      
-     Send the chat completion API request and return the response                             
-     """                                                                                      
-     try:                                                                                     
-         response = requests.post(                                                            
-             f"{BASE_ENDPOINT}/chat/completions", headers=headers, json=body                  
-         )                                                                                    
-         response.raise_for_status()                                                          
-         return response.json()                                                               
-     except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:            
-         console.print(f"API request error: {e}", style="red bold")                           
-         sys.exit(1)                                                                          
-                                                                                              
- def start_prompt(session: PromptSession, config: dict, headers: dict, messages: list,        
- prompt_tokens: int, completion_tokens: int) -> None:                                         
-     """                                                                                      
-     Ask the user for input, build the request, and perform it                                
-     """                                                                                      
-     message = session.prompt(HTML(f"<b>[{prompt_tokens + completion_tokens}] >>> </b>"))     
-                                                                                              
-     if message.lower() == "/q":                                                              
-         raise EOFError                                                                       
-     if message.lower() == "":                                                                
-         raise KeyboardInterrupt                                                              
-                                                                                              
-     messages.append({"role": "user", "content": message})                                    
-                                                                                              
-     body = construct_request(config["model"], messages, config)                              
-                                                                                              
-     response = send_api_request(headers, body)                                               
-                                                                                              
-     message_response = response["choices"][0]["message"]                                     
-     usage_response = response["usage"]                                                       
-                                                                                              
-     console.line()                                                                           
-     if config["markdown"]:                                                                   
-         console.print(Markdown(message_response["content"]))                                 
-     else:                                                                                    
-         console.print(message_response["content"])                                           
-                                                                                              
-     messages.append(message_response)                                                        
-                                                                                              
-     # Calculate tokens                                                                       
-     prompt_tokens += usage_response["prompt_tokens"]                                         
-     completion_tokens += usage_response["total_tokens"]                                      
-                                                                                              
-     return prompt_tokens, completion_tokens                                                  
-                                                                                              
- @click.command()                                                                             
- @click.option(                                                                               
-     "-c",                                                                                    
-     "--context",                                                                             
-     "context",                                                                               
-     type=click.File("r"),                                                                    
-     help="Path to a context file",                                                           
-     multiple=True,                                                                           
- )                                                                                            
- @click.option("-m", "--model", "model", help="Set the model")                                
- @click.option(                                                                               
-     "-ml", "--multiline", "multiline", is_flag=True, help="Use the multiline input mode"     
- )                                                                                            
- def main(context, model, multiline) -> None:                                                 
-     config = load_config(CONFIG_FILE)                                                        
-                                                                                              
-     if model:                                                                                
-         config["model"] = model                                                              
-                                                                                              
-     if multiline:                                                                            
-         config["multiline"] = multiline                                                      
-                                                                                              
-     create_save_folder()                                                                     
-                                                                                              
-     if config["markdown"]:                                                                   
-         messages.append({"role": "system", "content": "Always use code blocks with the       
- appropriate language tags. If asked for a table, always format it using Markdown syntax."})  
-                                                                                              
-     for file in context:                                                                     
-         messages.append({"role": "system", "content": file.read()})                          
-                                                                                              
-     atexit.register(display_expense, prompt_tokens, completion_tokens, config["model"])      
-                                                                                              
-     history = FileHistory(HISTORY_FILE)                                                      
-     session = PromptSession(history=history)                                                 
-                                                                                              
-     prompt_tokens = 0                                                                        
-     completion_tokens = 0                                                                    
-                                                                                              
-     headers = {                                                                              
-         "Content-Type": "application/json",                                                  
-         "Authorization": f"Bearer {os.getenv('OPENAI_API_KEY')}",                            
-     }                                                                                        
-                                                                                              
-     while True:                                                                              
-         try:                                                                                 
-             prompt_tokens, completion_tokens = start_prompt(                                 
-                 session, config, headers, messages, prompt_tokens, completion_tokens         
-             )                                                                                
-         except (EOFError, KeyboardInterrupt):                                                
-             break                                                                            
-                                                                                              
-     with open(f"{SAVE_FOLDER}/{SAVE_FILE}", "w") as f:                                       
-         json.dump(messages, f, indent=2)                                                     
-                                                                                              
- if __name__ == "__main__":                                                                   
-     main()                               
+from __future__ import annotations
+
+import atexit
+import os
+import click
+import datetime
+import sys
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
+from rich.console import Console
+from cache import ResponseCache, cache_key
+from client import APIConnectionError, APIError, ChatClient
+from context_window import ContextWindow
+from journal import SessionJournal, read_journal
+from rendering import Renderer
+from scheduler import RequestScheduler
+
+# Heavy modules are imported where they are first needed, so that the prompt shows up fast
+if TYPE_CHECKING:
+    from prompt_toolkit import PromptSession
+
+# Define some constants and global variables. These are used throughout the script.
+WORKDIR = Path(__file__).parent
+CONFIG_FILE = Path(WORKDIR, "config.yaml")
+HISTORY_FILE = Path(WORKDIR, ".history.sqlite")
+# Plain text history of earlier versions, imported into the database once
+LEGACY_HISTORY_FILE = Path(WORKDIR, ".history")
+CACHE_FILE = Path(WORKDIR, ".cache.sqlite")
+BASE_ENDPOINT = "https://api.openai.com/v1"
+SAVE_FOLDER = "session-history"
+SAVE_FILE = (
+    "chatgpt-session-" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + ".jsonl"
+)
+
+# Pricing rate per model, these are constants.
+PRICING_RATE = {
+    "gpt-3.5-turbo": {"prompt": 0.0015, "completion": 0.002},
+    "gpt-3.5-turbo-0613": {"prompt": 0.0015, "completion": 0.002},
+    "gpt-3.5-turbo-16k": {"prompt": 0.003, "completion": 0.004},
+    "gpt-4": {"prompt": 0.03, "completion": 0.06},
+    "gpt-4-0613": {"prompt": 0.03, "completion": 0.06},
+    "gpt-4-32k": {"prompt": 0.06, "completion": 0.12},
+    "gpt-4-32k-0613": {"prompt": 0.06, "completion": 0.12},
+}
+
+# Context window size per model, in tokens.
+CONTEXT_WINDOW = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-0613": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-4": 8192,
+    "gpt-4-0613": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-32k-0613": 32768,
+}
+
+# Initialize the console
+console = Console()
+
+def load_config(config_file: str) -> dict:
+    """
+    Read a YAML config file and return its content as a dictionary
+    """
+    import yaml
+
+    with open(config_file) as file:
+        config = yaml.safe_load(file)
+
+    return config
+
+def load_api_key() -> Optional[str]:
+    """
+    Load environment variables from the .env file and return the API key
+    """
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    return os.getenv("OPENAI_API_KEY")
+
+def load_base_endpoint(config: dict) -> str:
+    """
+    Return the API endpoint: the OPENAI_BASE_URL environment variable (which can be set in the
+    .env file), the base_endpoint config parameter, or the OpenAI API
+    """
+    return os.getenv("OPENAI_BASE_URL") or config.get("base_endpoint", BASE_ENDPOINT)
+
+def create_save_folder() -> None:
+    """
+    Create the session history folder if it doesn't exist
+    """
+    Path(SAVE_FOLDER).mkdir(parents=True, exist_ok=True)
+
+def calculate_expense(
+    prompt_tokens: int,
+    completion_tokens: int,
+    prompt_pricing: float,
+    completion_pricing: float,
+) -> float:
+    """
+    Calculate the expense given the number of tokens and the pricing rates
+    """
+    expense = ((prompt_tokens / 1000) * prompt_pricing) + (
+        (completion_tokens / 1000) * completion_pricing
+    )
+    return round(expense, 6)
+
+def display_expense(
+    prompt_tokens: int, completion_tokens: int, model: str, cached_tokens: int = 0
+) -> None:
+    """
+    Given the model used, display the total tokens used and estimated expense.
+    Tokens served from the response cache are displayed separately, they don't cost anything.
+    """
+    total_tokens = prompt_tokens + completion_tokens
+    total_expense = calculate_expense(
+        prompt_tokens,
+        completion_tokens,
+        PRICING_RATE[model]["prompt"],
+        PRICING_RATE[model]["completion"],
+    )
+    console.print(f"\nTotal tokens used: [green bold]{total_tokens}")
+    console.print(f"Estimated expense: [green bold]${total_expense}")
+    if cached_tokens:
+        console.print(f"Tokens served from cache (free): [green bold]{cached_tokens}")
+
+def construct_request(model: str, messages: list, config: dict) -> dict:
+    """
+    Construct the API request body
+    """
+    body = {
+        "model": model,
+        "temperature": config["temperature"],
+        "messages": messages,
+    }
+
+    if "max_tokens" in config:
+        body["max_tokens"] = config["max_tokens"]
+
+    if config.get("stream", False):
+        body["stream"] = True
+        body["stream_options"] = {"include_usage": True}
+
+    return body
+
+def handle_api_error(error: Exception) -> None:
+    """
+    Report an API error that survived the retries, only an invalid API key ends the session
+    """
+    console.print(f"API request error: {error}", style="red bold")
+    if isinstance(error, APIError) and error.status_code == 401:
+        sys.exit(1)
+
+def send_api_request(scheduler: RequestScheduler, body: dict) -> Optional[dict]:
+    """
+    Send the chat completion API request and return the response, or None if it failed
+    """
+    try:
+        return scheduler.chat(body)
+    except (APIConnectionError, APIError) as e:
+        handle_api_error(e)
+        return None
+
+def stream_api_request(scheduler: RequestScheduler, body: dict, renderer: Renderer) -> Optional[dict]:
+    """
+    Send a streaming chat completion API request, render it as it arrives and return the result,
+    or None if it failed
+    """
+    from streaming import stream_chat_completion
+
+    try:
+        lines = scheduler.stream(body)
+        return stream_chat_completion(
+            lines, console, renderer.markdown, body["messages"], renderer
+        )
+    except (APIConnectionError, APIError) as e:
+        handle_api_error(e)
+        return None
+
+def start_prompt(session: PromptSession, config: dict, scheduler: RequestScheduler, window: ContextWindow,
+cache: Optional[ResponseCache], messages: list, prompt_tokens: int, completion_tokens: int,
+cached_tokens: int, renderer: Renderer) -> tuple:
+    """
+    Ask the user for input, build the request, and perform it
+    """
+    from prompt_toolkit import HTML
+
+    message = session.prompt(HTML(f"<b>[{prompt_tokens + completion_tokens}] >>> </b>"))
+
+    if message.lower() == "/q":
+        raise EOFError
+    if message.lower() == "":
+        raise KeyboardInterrupt
+
+    messages.append({"role": "user", "content": message})
+
+    # Keep the request within the context window of the model
+    request_messages, saved_tokens = window.fit(messages)
+    if saved_tokens:
+        console.print(f"Context trimmed, {saved_tokens} tokens saved", style="dim")
+
+    body = construct_request(config["model"], request_messages, config)
+
+    # Identical deterministic requests are answered from the cache, without touching the network
+    key = None
+    if cache is not None:
+        key = cache_key(body)
+        cached = None if config.get("cache_bypass") else cache.get(key)
+        if cached is not None:
+            message_response = cached["choices"][0]["message"]
+
+            console.line()
+            renderer.render(message_response["content"])
+            # A question asked again on purpose must not pass an old answer off as a new one
+            console.print("(cached, use --no-cache for a fresh answer)", style="dim")
+
+            messages.append(message_response)
+            cached_tokens += cached["usage"]["total_tokens"]
+
+            return prompt_tokens, completion_tokens, cached_tokens
+
+    if body.get("stream"):
+        console.line()
+        result = stream_api_request(scheduler, body, renderer)
+        if result is None:
+            messages.pop()
+            return prompt_tokens, completion_tokens, cached_tokens
+
+        message_response = result["message"]
+        usage_response = result["usage"]
+        response = {"choices": [{"message": message_response}], "usage": usage_response}
+    else:
+        response = send_api_request(scheduler, body)
+        if response is None:
+            messages.pop()
+            return prompt_tokens, completion_tokens, cached_tokens
+
+        message_response = response["choices"][0]["message"]
+        usage_response = response["usage"]
+
+        console.line()
+        renderer.render(message_response["content"])
+
+    # An answer from a fallback model is not cached under the original request
+    if key is not None and scheduler.last_model == body["model"]:
+        cache.put(key, response)
+
+    messages.append(message_response)
+
+    # Calculate tokens
+    prompt_tokens += usage_response["prompt_tokens"]
+    completion_tokens += usage_response["completion_tokens"]
+
+    return prompt_tokens, completion_tokens, cached_tokens
+
+@click.command()
+@click.option(
+    "-c",
+    "--context",
+    "context",
+    type=click.File("r"),
+    help="Path to a context file",
+    multiple=True,
+)
+@click.option("-m", "--model", "model", help="Set the model")
+@click.option(
+    "-ml", "--multiline", "multiline", is_flag=True, help="Use the multiline input mode"
+)
+@click.option(
+    "--stream/--no-stream",
+    "stream",
+    default=None,
+    help="Render the response while it is being generated",
+)
+@click.option(
+    "--no-cache", "no_cache", is_flag=True, help="Don't answer from the response cache"
+)
+@click.option(
+    "-r",
+    "--resume",
+    "resume",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Resume a saved session",
+)
+def main(context, model, multiline, stream, no_cache, resume) -> None:
+    config = load_config(CONFIG_FILE)
+
+    if model:
+        config["model"] = model
+
+    if multiline:
+        config["multiline"] = multiline
+
+    if stream is not None:
+        config["stream"] = stream
+
+    if no_cache:
+        config["cache_bypass"] = True
+
+    create_save_folder()
+
+    messages = []
+
+    # A resumed journal keeps growing, older JSON sessions are continued in a new journal
+    journal_file = Path(SAVE_FOLDER, SAVE_FILE)
+    written = 0
+    if resume:
+        messages.extend(read_journal(resume))
+        if resume.endswith(".jsonl"):
+            journal_file = Path(resume)
+            written = len(messages)
+    elif config["markdown"]:
+        messages.append({"role": "system", "content": "Always use code blocks with the appropriate language tags. If asked for a table, always format it using Markdown syntax."})
+
+    journal = SessionJournal(journal_file, written)
+
+    for file in context:
+        messages.append({"role": "system", "content": file.read()})
+
+    from prompt_toolkit import PromptSession
+    from prompt_toolkit.auto_suggest import ThreadedAutoSuggest
+    from prompt_toolkit.history import ThreadedHistory
+    from prompt_history import HistorySuggest, PromptHistory
+
+    # The history is loaded in the background, the prompt shows up before it's read
+    history = PromptHistory.from_config(HISTORY_FILE, config, LEGACY_HISTORY_FILE)
+    auto_suggest = None
+    if config.get("history_suggest", True):
+        auto_suggest = ThreadedAutoSuggest(HistorySuggest(history))
+    session = PromptSession(history=ThreadedHistory(history), auto_suggest=auto_suggest)
+
+    prompt_tokens = 0
+    completion_tokens = 0
+    cached_tokens = 0
+
+    # Read the counters at exit time, not at registration time
+    atexit.register(
+        lambda: display_expense(prompt_tokens, completion_tokens, config["model"], cached_tokens)
+    )
+
+    api_key = load_api_key()
+    client = ChatClient.from_config(load_base_endpoint(config), api_key, config)
+    scheduler = RequestScheduler.from_config(
+        client, config, notify=lambda text: console.print(text, style="dim")
+    )
+    window = ContextWindow.from_config(
+        config, CONTEXT_WINDOW, notify=lambda text: console.print(text, style="yellow")
+    )
+    renderer = Renderer.from_config(console, config, Path(SAVE_FOLDER, "code"))
+
+    # Only deterministic requests are cached
+    cache = None
+    if config.get("cache", True) and config["temperature"] == 0:
+        cache = ResponseCache.from_config(CACHE_FILE, config)
+
+    while True:
+        # Each turn is appended to the journal, a crash doesn't lose the session
+        journal.sync(messages)
+        try:
+            prompt_tokens, completion_tokens, cached_tokens = start_prompt(
+                session, config, scheduler, window, cache, messages,
+                prompt_tokens, completion_tokens, cached_tokens, renderer
+            )
+        except (EOFError, KeyboardInterrupt):
+            break
+
+    scheduler.close()
+    client.close()
+    history.close()
+    if cache is not None:
+        cache.close()
+
+    journal.sync(messages)
+    journal.close()
+
+if __name__ == "__main__":
+    main()
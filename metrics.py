@@ -0,0 +1,237 @@
+import datetime
+import json
+import os
+import threading
+from collections import deque
+from pathlib import Path
+from typing import Callable, Optional
+
+from scheduler import percentile
+
+FORMATS = ("jsonl", "prometheus")
+
+# Samples kept per histogram, percentiles are computed over the most recent ones
+DEFAULT_WINDOW = 1000
+QUANTILES = (0.5, 0.9, 0.99)
+
+# Measurements taken at each turn. Durations are in seconds.
+# - build: from the user message to the request body (context retrieval and trimming included)
+# - encode: JSON encoding of the request body, and its compression
+# - connect: DNS, TCP and TLS setup, 0 when a pooled connection was reused
+# - ttfb: from sending the request to receiving the response headers
+# - request: from sending the request to receiving the last byte
+# - parse: decoding the JSON response or the stream events
+# - render: printing the answer, Markdown included
+# - sent_bytes: size of the request body sent, compressed or not
+# - tokens_per_second: completion tokens over the generation time (after the first token when
+#   streaming, the whole request otherwise)
+DURATIONS = ("build", "encode", "connect", "ttfb", "request", "parse", "render")
+MEASUREMENTS = DURATIONS + ("sent_bytes", "tokens_per_second")
+
+PROMETHEUS_PREFIX = "chatgpt_cli"
+
+
+class Histogram:
+    """
+    Bounded record of a measurement: percentiles over the latest samples, count and sum over all
+    """
+
+    def __init__(self, window: int = DEFAULT_WINDOW):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float) -> None:
+        """
+        Add a sample
+        """
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+
+    def summary(self) -> dict:
+        """
+        Return the count, sum, quantiles and maximum of the measurement
+        """
+        summary = {"count": self.count, "sum": self.total}
+        if self.samples:
+            values = list(self.samples)
+            for quantile in QUANTILES:
+                summary[f"p{round(quantile * 100)}"] = percentile(values, quantile)
+            summary["max"] = max(values)
+        return summary
+
+
+class Metrics:
+    """
+    Per-turn latency, throughput and token accounting, kept in bounded in-memory histograms.
+
+    Each turn is also exported to a metrics file, either appended as a JSON line or, for the
+    Prometheus format, by rewriting a text file with the current totals and quantiles (as read by
+    the node_exporter textfile collector). Other components can register their own statistics,
+    which are shown along with the turn metrics.
+    """
+
+    def __init__(
+        self,
+        path: Optional[Path] = None,
+        file_format: str = "jsonl",
+        window: int = DEFAULT_WINDOW,
+    ):
+        if file_format not in FORMATS:
+            raise ValueError(
+                f"Unknown metrics format '{file_format}', use one of {', '.join(FORMATS)}"
+            )
+
+        self.path = path
+        self.file_format = file_format
+        self.histograms = {name: Histogram(window) for name in MEASUREMENTS}
+        self.models = {}
+        self.sources = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: dict, folder: str) -> "Metrics":
+        """
+        Build the metrics from the config file, the file is written in the given folder by default
+        """
+        file_format = config.get("metrics_format", "jsonl")
+        path = None
+        if config.get("metrics", True):
+            default = "metrics.prom" if file_format == "prometheus" else "metrics.jsonl"
+            path = Path(config.get("metrics_file") or Path(folder, default))
+
+        return cls(
+            path,
+            file_format=file_format,
+            window=config.get("metrics_window", DEFAULT_WINDOW),
+        )
+
+    def add_source(self, name: str, stats: Callable[[], dict]) -> None:
+        """
+        Register a function returning statistics to show with the metrics, such as cache hits
+        """
+        self.sources[name] = stats
+
+    def record(
+        self,
+        model: str,
+        usage: dict,
+        timing: dict,
+        cost: Optional[float] = None,
+        cached: bool = False,
+    ) -> dict:
+        """
+        Record a turn and return it as exported.
+
+        The timing holds the measurements of the turn, missing ones are left out of the histograms,
+        and optionally the generation time used for the throughput. The cost is None when the
+        pricing of the model is unknown. Answers served from the cache only have their build and
+        render times, no throughput and no cost, and their tokens count as cached.
+        """
+        record = {
+            "time": datetime.datetime.now().isoformat(timespec="milliseconds"),
+            "model": model,
+            "cached": cached,
+            "prompt_tokens": usage["prompt_tokens"],
+            "completion_tokens": usage["completion_tokens"],
+            "cost": 0.0 if cached else cost,
+        }
+
+        generation = timing.get("generation") or timing.get("request")
+        if not cached and generation:
+            timing = dict(timing, tokens_per_second=usage["completion_tokens"] / generation)
+
+        with self._lock:
+            for name in MEASUREMENTS:
+                value = timing.get(name)
+                if value is not None:
+                    self.histograms[name].observe(value)
+                    record[name] = round(value, 6)
+
+            totals = self.models.setdefault(
+                model,
+                {
+                    "turns": 0,
+                    "prompt_tokens": 0,
+                    "completion_tokens": 0,
+                    "cached_tokens": 0,
+                    "cost": 0.0,
+                },
+            )
+            totals["turns"] += 1
+            if cached:
+                totals["cached_tokens"] += usage["prompt_tokens"] + usage["completion_tokens"]
+            else:
+                totals["prompt_tokens"] += usage["prompt_tokens"]
+                totals["completion_tokens"] += usage["completion_tokens"]
+                totals["cost"] += record["cost"] or 0.0
+
+            self._export(record)
+
+        return record
+
+    def totals(self) -> dict:
+        """
+        Return the per-model totals: turns, tokens and cost
+        """
+        with self._lock:
+            return {model: dict(totals) for model, totals in self.models.items()}
+
+    def summary(self) -> dict:
+        """
+        Return the histograms, the per-model totals and the statistics of the registered sources
+        """
+        with self._lock:
+            summary = {
+                "measurements": {
+                    name: histogram.summary() for name, histogram in self.histograms.items()
+                },
+                "models": {model: dict(totals) for model, totals in self.models.items()},
+            }
+        summary["sources"] = {name: stats() for name, stats in self.sources.items()}
+        return summary
+
+    def _export(self, record: dict) -> None:
+        if self.path is None:
+            return
+
+        if self.file_format == "jsonl":
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+            return
+
+        # The whole file is replaced at once, so a scraper never reads it half written
+        temporary = self.path.with_name(self.path.name + ".tmp")
+        with open(temporary, "w", encoding="utf-8") as f:
+            f.write(self._prometheus())
+        os.replace(temporary, self.path)
+
+    def _prometheus(self) -> str:
+        lines = []
+        for name, histogram in self.histograms.items():
+            metric = f"{PROMETHEUS_PREFIX}_{name}"
+            if name in DURATIONS:
+                metric += "_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            if histogram.samples:
+                values = list(histogram.samples)
+                for quantile in QUANTILES:
+                    lines.append(
+                        f'{metric}{{quantile="{quantile}"}} {percentile(values, quantile)}'
+                    )
+            lines.append(f"{metric}_sum {histogram.total}")
+            lines.append(f"{metric}_count {histogram.count}")
+
+        for field, metric in (
+            ("turns", "turns_total"),
+            ("prompt_tokens", "prompt_tokens_total"),
+            ("completion_tokens", "completion_tokens_total"),
+            ("cached_tokens", "cached_tokens_total"),
+            ("cost", "cost_dollars_total"),
+        ):
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{metric} counter")
+            for model, totals in self.models.items():
+                lines.append(f'{PROMETHEUS_PREFIX}_{metric}{{model="{model}"}} {totals[field]}')
+
+        return "\n".join(lines) + "\n"
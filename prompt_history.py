@@ -0,0 +1,273 @@
+import datetime
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+from prompt_toolkit.auto_suggest import AutoSuggest, Suggestion
+from prompt_toolkit.history import History
+
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+# Most recent entries loaded for the up arrow and Ctrl-R, older ones are found with search
+DEFAULT_LOAD_LIMIT = 1000
+DEFAULT_SEARCH_LIMIT = 20
+
+# The trigram index finds substrings of 3 characters or more without scanning the entries
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    hash TEXT NOT NULL UNIQUE,
+    text TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_used ON entries (used);
+CREATE VIRTUAL TABLE IF NOT EXISTS entries_text USING fts5(
+    text, content='entries', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+    INSERT INTO entries_text (rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+    INSERT INTO entries_text (entries_text, rowid, text) VALUES ('delete', old.id, old.text);
+END;
+"""
+
+
+def entry_hash(text: str) -> str:
+    """
+    Identity of an entry, repeated prompts share it
+    """
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def like_pattern(text: str, prefix: bool) -> tuple:
+    """
+    LIKE pattern matching a text literally, at the start of the entries or anywhere in them, and
+    whether it needs an ESCAPE clause. The trigram index is not used with one, it's only added
+    when the text has wildcards.
+    """
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    pattern = f"{escaped}%" if prefix else f"%{escaped}%"
+    return pattern, escaped != text
+
+
+def read_file_history(path: Path) -> Iterator[tuple]:
+    """
+    Yield the (text, timestamp) entries of a prompt_toolkit FileHistory file, oldest first.
+
+    Each entry is a "# <date>" line followed by its lines prefixed with "+". Entries without a
+    readable date get the date of the previous one.
+    """
+    used = 0.0
+    lines = []
+    with open(path, "rb") as f:
+        for line in f:
+            line = line.decode("utf-8", errors="replace")
+            if line.startswith("+"):
+                lines.append(line[1:])
+                continue
+
+            if lines:
+                yield "".join(lines)[:-1], used
+                lines = []
+            if line.startswith("# "):
+                try:
+                    used = datetime.datetime.fromisoformat(line[2:].strip()).timestamp()
+                except ValueError:
+                    pass
+    if lines:
+        yield "".join(lines)[:-1], used
+
+
+class PromptHistory(History):
+    """
+    Prompt history in an indexed SQLite database, bounded in entries and bytes.
+
+    - Repeated prompts are stored once, using one again makes it the most recent
+    - The least recently used entries are evicted beyond the limits
+    - Only the load_limit most recent entries are loaded for the prompt, all of them can be
+      searched by prefix or substring
+    - A FileHistory file given as legacy_path is imported once, then renamed to *.migrated
+
+    Loading happens on the first call to load_history_strings, wrap the history in a
+    ThreadedHistory to load it in the background while the prompt is already shown.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        load_limit: int = DEFAULT_LOAD_LIMIT,
+        legacy_path: Optional[Path] = None,
+    ):
+        super().__init__()
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.load_limit = load_limit
+        self.legacy_path = legacy_path
+
+        self._lock = threading.Lock()
+        # Loaded from the ThreadedHistory thread, written from the prompt
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+        self._closed = False
+
+    @classmethod
+    def from_config(
+        cls, path: Path, config: dict, legacy_path: Optional[Path] = None
+    ) -> "PromptHistory":
+        """
+        Build a history from the history settings of the config file
+        """
+        return cls(
+            path,
+            max_entries=config.get("history_max_entries", DEFAULT_MAX_ENTRIES),
+            max_bytes=config.get("history_max_bytes", DEFAULT_MAX_BYTES),
+            load_limit=config.get("history_load_limit", DEFAULT_LOAD_LIMIT),
+            legacy_path=legacy_path,
+        )
+
+    def load_history_strings(self) -> Iterable[str]:
+        """
+        Yield the most recent entries, most recent first
+        """
+        if self.legacy_path is not None and self.legacy_path.exists():
+            self.migrate(self.legacy_path)
+
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT text FROM entries ORDER BY used DESC LIMIT ?", (self.load_limit,)
+            ).fetchall()
+        for (text,) in rows:
+            yield text
+
+    def store_string(self, string: str) -> None:
+        """
+        Store an entry, or make it the most recent if it's already stored
+        """
+        with self._lock:
+            self._upsert([(string, time.time())])
+            self._evict()
+            self._db.commit()
+
+    def search(
+        self, text: str, limit: int = DEFAULT_SEARCH_LIMIT, prefix: bool = False
+    ) -> list:
+        """
+        Return the most recent entries starting with a text, or containing it, case-insensitively
+        """
+        pattern, escape = like_pattern(text, prefix)
+        escape_clause = "ESCAPE '\\'" if escape else ""
+        with self._lock:
+            rows = self._db.execute(
+                f"""
+                SELECT entries.text FROM entries_text
+                JOIN entries ON entries.id = entries_text.rowid
+                WHERE entries_text.text LIKE ? {escape_clause}
+                ORDER BY entries.used DESC LIMIT ?
+                """,
+                (pattern, limit),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def migrate(self, legacy_path: Path) -> int:
+        """
+        Import a FileHistory file and rename it, return the number of entries read
+        """
+        read = 0
+
+        def entries() -> Iterator[tuple]:
+            nonlocal read
+            for entry in read_file_history(legacy_path):
+                read += 1
+                yield entry
+
+        with self._lock:
+            self._upsert(entries())
+            evicted = self._evict()
+            self._db.commit()
+            # Space left by a history much bigger than the limits is given back
+            if evicted:
+                self._db.execute("VACUUM")
+
+        os.replace(legacy_path, legacy_path.with_name(legacy_path.name + ".migrated"))
+        return read
+
+    def stats(self) -> dict:
+        """
+        Return the number of entries and their total size, nothing once closed
+        """
+        with self._lock:
+            if self._closed:
+                return {}
+            entries, size = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+        return {"entries": entries, "bytes": size}
+
+    def close(self) -> None:
+        """
+        Close the underlying database
+        """
+        with self._lock:
+            self._db.close()
+            self._closed = True
+
+    def _upsert(self, entries: Iterable[tuple]) -> None:
+        self._db.executemany(
+            """
+            INSERT INTO entries (hash, text, size, used) VALUES (?, ?, ?, ?)
+            ON CONFLICT (hash) DO UPDATE SET used = max(used, excluded.used)
+            """,
+            (
+                (entry_hash(text), text, len(text.encode("utf-8")), used)
+                for text, used in entries
+            ),
+        )
+
+    def _evict(self) -> int:
+        entries, size = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+        if entries <= self.max_entries and size <= self.max_bytes:
+            return 0
+
+        rows = self._db.execute("SELECT id, size FROM entries ORDER BY used").fetchall()
+        evicted = []
+        for entry_id, entry_size in rows:
+            if entries <= self.max_entries and size <= self.max_bytes:
+                break
+            evicted.append((entry_id,))
+            entries -= 1
+            size -= entry_size
+        self._db.executemany("DELETE FROM entries WHERE id = ?", evicted)
+        return len(evicted)
+
+
+class HistorySuggest(AutoSuggest):
+    """
+    Suggests the end of the most recent history entry starting with what is being typed
+    """
+
+    def __init__(self, history: PromptHistory):
+        self.history = history
+
+    def get_suggestion(self, buffer, document) -> Optional[Suggestion]:
+        text = document.text
+        # Only single lines long enough to be worth completing
+        if len(text) < 3 or "\n" in text:
+            return None
+
+        # The search ignores case, the suggestion must continue the text as typed
+        for entry in self.history.search(text, limit=5, prefix=True):
+            if entry.startswith(text):
+                return Suggestion(entry[len(text):])
+        return None
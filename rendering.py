@@ -0,0 +1,587 @@
+import datetime
+import io
+import re
+import shlex
+import shutil
+import subprocess
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+
+from rich.console import Console
+
+# rich.markdown and rich.syntax pull in markdown-it and pygments, they are imported when the
+# first answer is rendered.
+
+CODE_THEME = "monokai"
+DEFAULT_PAGER_COMMAND = "less -R"
+# Answers taller than this many screens are shown in the pager
+DEFAULT_PAGER_SCREENS = 3
+# Code blocks longer than this are written to a file, only their first lines are shown
+DEFAULT_CODE_FILE_LINES = 500
+CODE_PREVIEW_LINES = 20
+
+# Fences are indented by up to 3 spaces, counted from the content of the list item they're in
+FENCE = re.compile(r"^( *)(`{3,}|~{3,})\s*([^\s`]*)")
+LIST_ITEM = re.compile(r"^ *(?:[-*+]|\d{1,9}[.)])(?: +|$)")
+
+
+@lru_cache(maxsize=None)
+def get_lexer(language: str):
+    """
+    Return the syntax highlighting lexer of a language, plain text if it's unknown.
+    Lexers are created once per language.
+    """
+    from pygments.lexers import get_lexer_by_name
+    from pygments.util import ClassNotFound
+
+    try:
+        return get_lexer_by_name(language or "text")
+    except ClassNotFound:
+        return get_lexer_by_name("text")
+
+
+@lru_cache(maxsize=None)
+def markdown_class():
+    """
+    rich's Markdown, with code blocks highlighted by the cached lexers
+    """
+    from rich.markdown import CodeBlock, Markdown
+    from rich.syntax import Syntax
+
+    class CachedLexerCodeBlock(CodeBlock):
+        def __rich_console__(self, console, options):
+            code = str(self.text).rstrip()
+            yield Syntax(
+                code, get_lexer(self.lexer_name), theme=self.theme, word_wrap=True, padding=1
+            )
+
+    class BlockMarkdown(Markdown):
+        elements = {
+            **Markdown.elements,
+            "fence": CachedLexerCodeBlock,
+            "code_block": CachedLexerCodeBlock,
+        }
+
+    return BlockMarkdown
+
+
+class Trimmed:
+    """
+    Renders Markdown without the empty line rich puts before a document starting with a list or a
+    table, so that blocks printed one after the other are spaced like a whole document
+    """
+
+    def __init__(self, renderable):
+        self.renderable = renderable
+
+    def __rich_console__(self, console, options):
+        leading = True
+        for segment in console.render(self.renderable, options):
+            if leading and segment.text == "\n":
+                continue
+            leading = False
+            yield segment
+
+
+class PagerConsole(Console):
+    """
+    Console writing to the pager. rich exits the program when its output is closed, here quitting
+    the pager only stops the rendering.
+    """
+
+    def on_broken_pipe(self) -> None:
+        raise BrokenPipeError
+
+
+class Block:
+    """
+    A top-level piece of Markdown: either a fenced code block or the text between blank lines
+    """
+
+    def __init__(self, text: str, language: Optional[str] = None):
+        self.text = text
+        self.language = language
+
+    @property
+    def is_code(self) -> bool:
+        return self.language is not None
+
+
+class BlockSplitter:
+    """
+    Splits Markdown into blocks as it arrives, so that each block is parsed and rendered once.
+
+    Blocks end at blank lines, except inside fenced code blocks which are kept whole. A code block
+    fenced inside a list item is a block of its own, without the indentation of the item.
+    """
+
+    def __init__(self):
+        self._partial = ""
+        self._lines = []
+        self._fence = None
+        self._fence_indent = 0
+        self._language = None
+        # Indentation of the content of the last list item, 0 outside lists
+        self._list_indent = 0
+
+    def feed(self, text: str) -> list:
+        """
+        Add text and return the blocks it completed
+        """
+        completed = []
+        lines = (self._partial + text).split("\n")
+        self._partial = lines.pop()
+        for line in lines:
+            block = self._add_line(line)
+            if block is not None:
+                completed.append(block)
+        return completed
+
+    def tail(self) -> Optional[Block]:
+        """
+        The block being received, None if there's none
+        """
+        lines = self._lines + ([self._partial] if self._partial else [])
+        if self._fence is not None:
+            lines = self._lines + ([self._dedent(self._partial)] if self._partial else [])
+            return Block("\n".join(lines), self._language)
+        if not "".join(lines).strip():
+            return None
+        return Block("\n".join(lines))
+
+    def completed_lines(self) -> list:
+        """
+        The completed lines of the block being received
+        """
+        return list(self._lines)
+
+    def close(self) -> list:
+        """
+        Return the last blocks, an unterminated code block included
+        """
+        completed = []
+        if self._partial:
+            block = self._add_line(self._partial)
+            self._partial = ""
+            if block is not None:
+                completed.append(block)
+
+        block = self._flush()
+        if block is not None:
+            completed.append(block)
+        self._fence = None
+        return completed
+
+    def _add_line(self, line: str) -> Optional[Block]:
+        match = FENCE.match(line)
+        if match and len(match[1]) - self._list_indent > 3:
+            # Indented code, not a fence
+            match = None
+
+        if self._fence is not None:
+            if match and match[2][0] == self._fence[0] and len(match[2]) >= len(self._fence):
+                if not match[3]:
+                    block = self._flush()
+                    self._fence = None
+                    return block
+            self._lines.append(self._dedent(line))
+            return None
+
+        item = LIST_ITEM.match(line)
+        if item:
+            self._list_indent = item.end()
+        elif not self._lines and line[:1] not in ("", " "):
+            # A paragraph at the margin ends the list
+            self._list_indent = 0
+
+        if match:
+            block = self._flush()
+            self._fence = match[2]
+            self._fence_indent = len(match[1])
+            self._language = match[3]
+            return block
+
+        if not line.strip():
+            return self._flush()
+
+        self._lines.append(line)
+        return None
+
+    def _dedent(self, line: str) -> str:
+        # Code lines lose the indentation of their fence, as far as they have it
+        return line[min(self._fence_indent, len(line) - len(line.lstrip(" "))):]
+
+    def _flush(self) -> Optional[Block]:
+        lines, self._lines = self._lines, []
+        if self._fence is not None:
+            return Block("\n".join(lines), self._language)
+        if not lines:
+            return None
+        return Block("\n".join(lines))
+
+
+def split_blocks(text: str) -> list:
+    """
+    Split a whole answer into blocks
+    """
+    splitter = BlockSplitter()
+    return splitter.feed(text) + splitter.close()
+
+
+def merge_blocks(blocks: list, max_lines: float, width: int) -> list:
+    """
+    Merge consecutive text blocks up to about max_lines lines, so that fewer, bigger documents are
+    parsed when the whole answer is known
+    """
+    merged = []
+    height = 0
+    for block in blocks:
+        block_height = estimate_height(block.text, width)
+        if (
+            merged
+            and not block.is_code
+            and not merged[-1].is_code
+            and height + block_height <= max_lines
+        ):
+            merged[-1] = Block(merged[-1].text + "\n\n" + block.text)
+            height += block_height + 1
+        else:
+            merged.append(block)
+            height = block_height
+    return merged
+
+
+def estimate_height(text: str, width: int) -> int:
+    """
+    Number of terminal lines a text takes, without rendering it
+    """
+    width = max(width, 1)
+    return sum(max(1, -(-len(line) // width)) for line in text.splitlines())
+
+
+class Renderer:
+    """
+    Renders answers block by block instead of parsing and laying out the whole text at once.
+
+    - Each block is parsed on its own, a streamed answer only redraws the block being received
+    - Code blocks are highlighted with lexers created once per language
+    - Code blocks longer than code_file_lines are written to a file in code_folder, with a preview
+    - Answers taller than pager_screens screens go to the pager, which is fed block by block:
+      rendering stops when the pager stops reading, and when it is quit
+
+    When the prompt shares the terminal with the answers, run_in_terminal is set to a function
+    that runs another one with the terminal to itself. Streamed answers are then printed a block
+    at a time without a live view, and the pager is run through it.
+    """
+
+    def __init__(
+        self,
+        console: Console,
+        markdown: bool = True,
+        code_folder: Optional[Path] = None,
+        code_file_lines: int = DEFAULT_CODE_FILE_LINES,
+        pager_command: Optional[str] = DEFAULT_PAGER_COMMAND,
+        pager_screens: float = DEFAULT_PAGER_SCREENS,
+    ):
+        self.console = console
+        self.markdown = markdown
+        self.code_folder = code_folder
+        self.code_file_lines = code_file_lines
+        self.pager_command = pager_command
+        self.pager_screens = pager_screens
+        self.run_in_terminal: Optional[Callable[[Callable[[], None]], None]] = None
+
+    @classmethod
+    def from_config(cls, console: Console, config: dict, code_folder: Path) -> "Renderer":
+        """
+        Build a renderer from the display settings of the config file
+        """
+        pager_command = None
+        if config.get("pager", True):
+            pager_command = config.get("pager_command", DEFAULT_PAGER_COMMAND)
+
+        return cls(
+            console,
+            markdown=config["markdown"],
+            code_folder=code_folder,
+            code_file_lines=config.get("code_file_lines", DEFAULT_CODE_FILE_LINES),
+            pager_command=pager_command,
+            pager_screens=config.get("pager_screens", DEFAULT_PAGER_SCREENS),
+        )
+
+    def render(self, text: str) -> None:
+        """
+        Display a whole answer, in the pager if it's too tall for the terminal
+        """
+        page = self._should_page(text)
+
+        blocks = [Block(text)]
+        if self.markdown:
+            # The pager is fed about a screen at a time, otherwise the text is parsed at once
+            max_lines = self.console.height if page else float("inf")
+            blocks = merge_blocks(split_blocks(text), max_lines, self.console.width)
+
+        if page and self.run_in_terminal is not None:
+            self.run_in_terminal(lambda: self._page(blocks))
+        elif page:
+            self._page(blocks)
+        else:
+            self.print_blocks(self.console, blocks)
+
+    def print_blocks(self, console: Console, blocks: Iterable, first: bool = True) -> None:
+        """
+        Print blocks one after the other, separated by blank lines
+        """
+        for block in blocks:
+            if not first:
+                console.line()
+            console.print(self.renderable(block))
+            first = False
+
+    def renderable(self, block: Block, height: Optional[int] = None):
+        """
+        Build what is printed for a block. With a height, only the end of a code block is kept,
+        for previews of a block being received.
+        """
+        from rich.text import Text
+
+        if not self.markdown:
+            return Text(block.text)
+
+        if not block.is_code:
+            return Trimmed(markdown_class()(block.text, code_theme=CODE_THEME))
+
+        from rich.console import Group
+        from rich.syntax import Syntax
+
+        code = block.text.rstrip()
+        lines = code.split("\n")
+        if height is not None and len(lines) > height:
+            code = "\n".join(lines[-height:])
+        elif self.writes_to_file(len(lines)):
+            path = self._write_code(block)
+            preview = "\n".join(lines[:CODE_PREVIEW_LINES])
+            return Group(
+                Syntax(
+                    preview, get_lexer(block.language), theme=CODE_THEME, word_wrap=True, padding=1
+                ),
+                Text(
+                    f"{len(lines) - CODE_PREVIEW_LINES} more lines written to {path}", style="dim"
+                ),
+            )
+
+        return Syntax(code, get_lexer(block.language), theme=CODE_THEME, word_wrap=True, padding=1)
+
+    def code_part(self, language: Optional[str], lines: list, first: bool, last: bool):
+        """
+        Build what is printed for some lines of a code block printed in parts, padded so that the
+        parts join up
+        """
+        from rich.syntax import Syntax
+        from rich.text import Text
+
+        code = "\n".join(lines)
+        if not self.markdown:
+            return Text(code)
+        # Without lines, the empty line is the bottom padding
+        padding = (1 if first else 0, 1, 1 if last and lines else 0, 1)
+        return Syntax(
+            code, get_lexer(language), theme=CODE_THEME, word_wrap=True, padding=padding
+        )
+
+    @property
+    def saves_code(self) -> bool:
+        """
+        Whether code blocks longer than code_file_lines are written to files
+        """
+        return self.markdown and self.code_folder is not None and self.code_file_lines > 0
+
+    def writes_to_file(self, lines: int) -> bool:
+        """
+        Whether a code block of this many lines is written to a file rather than shown whole
+        """
+        return self.saves_code and lines > self.code_file_lines
+
+    def save_code(self, block: Block) -> Path:
+        """
+        Write a code block to a file in code_folder and return its path
+        """
+        return self._write_code(block)
+
+    def stream(self, console: Optional[Console] = None) -> "StreamView":
+        """
+        Start the live view of a streamed answer
+        """
+        return StreamView(self, console or self.console, live=self.run_in_terminal is None)
+
+    def _should_page(self, text: str) -> bool:
+        if not self.pager_command or not self.console.is_terminal:
+            return False
+        if shutil.which(shlex.split(self.pager_command)[0]) is None:
+            return False
+        height = estimate_height(text, self.console.width)
+        return height > self.console.height * self.pager_screens
+
+    def _page(self, blocks: list) -> None:
+        process = subprocess.Popen(shlex.split(self.pager_command), stdin=subprocess.PIPE)
+        pipe = io.TextIOWrapper(process.stdin, encoding="utf-8", errors="replace")
+        pager_console = PagerConsole(
+            file=pipe,
+            force_terminal=True,
+            color_system=self.console.color_system,
+            width=self.console.width,
+        )
+        try:
+            for i, block in enumerate(blocks):
+                self.print_blocks(pager_console, [block], first=i == 0)
+                # The pager reads as the user scrolls, a full pipe blocks until then
+                pipe.flush()
+            pipe.close()
+        except BrokenPipeError:
+            # The pager was quit before the end, the rest is not rendered
+            pass
+        finally:
+            try:
+                pipe.close()
+            except BrokenPipeError:
+                pass
+            process.wait()
+
+    def _write_code(self, block: Block) -> Path:
+        lexer = get_lexer(block.language)
+        extension = ".txt"
+        if lexer.filenames and lexer.filenames[0].startswith("*."):
+            extension = lexer.filenames[0][1:]
+
+        self.code_folder.mkdir(parents=True, exist_ok=True)
+        name = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        path = Path(self.code_folder, f"{name}{extension}")
+        path.write_text(block.text.rstrip() + "\n", encoding="utf-8")
+        return path
+
+
+class StreamView:
+    """
+    Live view of a streamed answer: completed blocks are printed once and scroll away, only the
+    block being received is redrawn, and a code block being received shows its last lines only.
+
+    Without live, for terminals where the cursor belongs to the prompt, the completed lines of the
+    block being received are printed on refresh: a paragraph or list line by line, a code block a
+    few lines at a time. Tables are printed once complete. A code block that may be written to a
+    file only shows its first lines until it ends.
+    """
+
+    def __init__(self, renderer: Renderer, console: Console, live: bool = True):
+        from rich.live import Live
+
+        self.renderer = renderer
+        self.console = console
+        self.splitter = BlockSplitter()
+        self.printed = 0
+        # Lines of the block being received printed so far, without live
+        self._part_printed = 0
+        self._live = None
+        if live:
+            self._live = Live(console=console, auto_refresh=False, vertical_overflow="visible")
+            self._live.start()
+
+    def feed(self, text: str) -> None:
+        """
+        Add received text, completed blocks are printed above the live view
+        """
+        self._print(self.splitter.feed(text))
+
+    def refresh(self) -> None:
+        """
+        Redraw the block being received
+        """
+        from rich.padding import Padding
+        from rich.text import Text
+
+        if self._live is None:
+            self._print_lines()
+            return
+
+        tail = self.splitter.tail()
+        if tail is None:
+            self._live.update(Text(""), refresh=True)
+            return
+
+        height = max(self._live.console.height - 4, 1)
+        renderable = self.renderer.renderable(tail, height=height)
+        if self.printed:
+            renderable = Padding(renderable, (1, 0, 0, 0))
+        self._live.update(renderable, refresh=True)
+
+    def close(self) -> None:
+        """
+        Print the last blocks and stop the live view
+        """
+        from rich.text import Text
+
+        if self._live is None:
+            self._print(self.splitter.close())
+            return
+
+        try:
+            self._live.update(Text(""))
+            self._print(self.splitter.close())
+        finally:
+            self._live.stop()
+
+    def _print(self, blocks: list) -> None:
+        if blocks and self._part_printed:
+            # The block printed in parts ended, its last lines close it
+            block, blocks = blocks[0], blocks[1:]
+            self._print_end(block)
+            self._part_printed = 0
+            self.printed += 1
+        if blocks:
+            self.renderer.print_blocks(self.console, blocks, first=self.printed == 0)
+            self.printed += len(blocks)
+
+    def _print_end(self, block: Block) -> None:
+        from rich.text import Text
+
+        lines = block.text.split("\n")
+        rest = lines[self._part_printed:]
+        if not block.is_code:
+            if rest:
+                self.console.print(self.renderer.renderable(Block("\n".join(rest))))
+            return
+
+        code_lines = block.text.rstrip().split("\n")
+        if self.renderer.writes_to_file(len(code_lines)):
+            path = self.renderer.save_code(block)
+            more = len(code_lines) - self._part_printed
+            self.console.print(self.renderer.code_part(block.language, [], False, True))
+            self.console.print(Text(f"{more} more lines written to {path}", style="dim"))
+        else:
+            self.console.print(self.renderer.code_part(block.language, rest, False, True))
+
+    def _print_lines(self) -> None:
+        tail = self.splitter.tail()
+        lines = self.splitter.completed_lines()
+        if tail is None or not lines:
+            return
+
+        if tail.is_code:
+            # Past the preview, the block may end up in a file rather than on screen
+            if self.renderer.saves_code:
+                lines = lines[:CODE_PREVIEW_LINES]
+        elif any(line.lstrip().startswith("|") for line in lines):
+            # A table is laid out from all its rows
+            return
+        if len(lines) <= self._part_printed:
+            return
+
+        new = lines[self._part_printed:]
+        if self._part_printed == 0 and self.printed:
+            self.console.line()
+        if tail.is_code:
+            part = self.renderer.code_part(tail.language, new, self._part_printed == 0, False)
+        else:
+            part = self.renderer.renderable(Block("\n".join(new)))
+        self.console.print(part)
+        self._part_printed = len(lines)
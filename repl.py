@@ -0,0 +1,177 @@
+from __future__ import annotations
+
+import asyncio
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Callable, Coroutine
+
+if TYPE_CHECKING:
+    from prompt_toolkit import PromptSession
+
+# Output printed while the prompt is shown is written above it at most this often, in seconds.
+# prompt_toolkit waits 0.2s by default, which delays each streamed block as much.
+OUTPUT_INTERVAL = 0.05
+
+
+class Repl:
+    """
+    Interactive loop where the prompt stays available while answers are requested.
+
+    Work submitted from the handler is queued and run one call at a time in a worker thread, in the
+    order it was typed, since each answer is part of the context of the next message. Coroutines
+    spawned from the handler run in the background alongside the queue. Anything printed meanwhile
+    shows up above the prompt.
+
+    The handler is called in the event loop with each line typed, and ends the session by raising
+    EOFError (the queue is emptied first) or KeyboardInterrupt (only the running call is waited
+    for). Ctrl-D does the same as EOFError. Ctrl-C drops the queued calls and passes the id of the
+    worker thread to cancel, which should make the running call return early. At an idle prompt,
+    Ctrl-C ends the session.
+    """
+
+    def __init__(
+        self,
+        session: PromptSession,
+        message: Callable[[], Any],
+        after: Callable[[], None] = lambda: None,
+        cancel: Callable[[int], None] = lambda thread: None,
+    ):
+        self.session = session
+        self.message = message
+        self.after = after
+        self.cancel = cancel
+        self._queue = None
+        self._pending = 0
+        # Id of the worker thread while it runs a call
+        self._running = None
+        self._tasks = set()
+        self._loop = None
+        # A single worker keeps the turns in order
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    @property
+    def pending(self) -> int:
+        """
+        Number of queued calls, the running one included
+        """
+        return self._pending
+
+    def submit(self, func: Callable, *args) -> None:
+        """
+        Queue a blocking call, run after the ones submitted before it
+        """
+        self._queue.put_nowait((func, args))
+        self._pending += 1
+        self.session.app.invalidate()
+
+    def spawn(self, coroutine: Coroutine) -> None:
+        """
+        Run a coroutine in the background, without waiting for the queue
+        """
+        task = self._loop.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        task.add_done_callback(self._task_done)
+
+    def run_in_terminal(self, func: Callable[[], None]) -> None:
+        """
+        Run a function with the terminal to itself, such as a pager, the prompt is hidden
+        meanwhile. To be called from the worker thread.
+        """
+        from prompt_toolkit.application import run_in_terminal
+
+        async def run() -> None:
+            await run_in_terminal(func)
+
+        asyncio.run_coroutine_threadsafe(run(), self._loop).result()
+
+    async def run(self, handler: Callable[[str], None]) -> None:
+        """
+        Prompt for messages and pass them to the handler until the session ends
+        """
+        from prompt_toolkit.patch_stdout import StdoutProxy
+
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        worker = self._loop.create_task(self._work())
+        worker.add_done_callback(self._task_done)
+
+        # Escape sequences are let through, so that answers keep their colors
+        original_stdout, original_stderr = sys.stdout, sys.stderr
+        with StdoutProxy(sleep_between_writes=OUTPUT_INTERVAL, raw=True) as proxy:
+            sys.stdout = sys.stderr = proxy
+            wait_for_queue = True
+            try:
+                while True:
+                    if worker.done():
+                        worker.result()
+                    try:
+                        line = await self.session.prompt_async(self.message)
+                    except EOFError:
+                        break
+                    except KeyboardInterrupt:
+                        if self._cancel_pending():
+                            continue
+                        wait_for_queue = False
+                        break
+
+                    try:
+                        handler(line)
+                    except EOFError:
+                        break
+                    except KeyboardInterrupt:
+                        wait_for_queue = False
+                        break
+            finally:
+                if not wait_for_queue or worker.done():
+                    self._drop_queue()
+                if not worker.done():
+                    await self._queue.join()
+                    worker.cancel()
+                if self._tasks:
+                    await asyncio.gather(*self._tasks, return_exceptions=True)
+                self._executor.shutdown()
+                sys.stdout, sys.stderr = original_stdout, original_stderr
+
+    async def _work(self) -> None:
+        while True:
+            func, args = await self._queue.get()
+            try:
+                await self._loop.run_in_executor(self._executor, self._call, func, args)
+            finally:
+                self._pending -= 1
+                self._queue.task_done()
+                self.after()
+                self.session.app.invalidate()
+
+    def _call(self, func: Callable, args: tuple) -> None:
+        self._running = threading.get_ident()
+        try:
+            func(*args)
+        finally:
+            self._running = None
+
+    def _cancel_pending(self) -> bool:
+        # Returns False when there is nothing to cancel
+        if not self._pending:
+            return False
+        self._drop_queue()
+        thread = self._running
+        if thread is not None:
+            self.cancel(thread)
+        self.session.app.invalidate()
+        return True
+
+    def _drop_queue(self) -> None:
+        while not self._queue.empty():
+            self._queue.get_nowait()
+            self._queue.task_done()
+            self._pending -= 1
+
+    def _task_done(self, task: asyncio.Task) -> None:
+        # An unexpected error ends the session, as it did when the calls blocked the prompt
+        if task.cancelled() or task.exception() is None:
+            return
+        if self.session.app.is_running:
+            self.session.app.exit(exception=task.exception())
@@ -0,0 +1,96 @@
+import json
+import threading
+from collections import OrderedDict
+
+# Bounds of the fragments kept, the least recently sent messages are dropped first
+DEFAULT_MAX_FRAGMENTS = 4096
+DEFAULT_MAX_FRAGMENT_BYTES = 64 * 1024 * 1024
+
+
+def encode_json(value) -> bytes:
+    """
+    Compact UTF-8 JSON encoding of a value, as sent to the API
+    """
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+class RequestEncoder:
+    """
+    Encodes request bodies to JSON, reusing the encoding of the messages of previous requests.
+
+    A conversation is resent whole at each turn, with the context files it may include. Each
+    message is encoded once and kept as a JSON fragment, bodies are assembled by concatenating the
+    fragments, so that a turn only encodes the messages it added. Fragments are kept for the
+    most recently sent messages, up to max_fragments of them and max_bytes in all, so that
+    conversations sharing the encoder (batch workers, daemon clients) don't evict each other.
+
+    Messages are looked up by identity, a message changed since it was encoded is encoded again.
+    """
+
+    def __init__(
+        self,
+        max_fragments: int = DEFAULT_MAX_FRAGMENTS,
+        max_bytes: int = DEFAULT_MAX_FRAGMENT_BYTES,
+    ):
+        self.max_fragments = max_fragments
+        self.max_bytes = max_bytes
+        # id of the message -> (message, its items when encoded, fragment), least recently sent
+        # first. The message is kept so that its id can't be reused by another one.
+        self._fragments = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def encode(self, body: dict) -> bytes:
+        """
+        Encode a request body, its messages last
+        """
+        if "messages" not in body:
+            return encode_json(body)
+
+        messages = body["messages"]
+        with self._lock:
+            found = [self._fragments.get(id(message)) for message in messages]
+
+        encoded = {}
+        parts = []
+        for message, cached in zip(messages, found):
+            items = tuple(message.items())
+            # Compared item by item, unchanged values are the same objects and compare at once
+            if cached is None or cached[0] is not message or cached[1] != items:
+                cached = (message, items, encode_json(message))
+                encoded[id(message)] = cached
+            parts.append(cached[2])
+
+        with self._lock:
+            for message in messages:
+                key = id(message)
+                if key in encoded:
+                    self._drop(key)
+                    self._fragments[key] = encoded[key]
+                    self._bytes += len(encoded[key][2])
+                elif key in self._fragments:
+                    self._fragments.move_to_end(key)
+            while self._fragments and (
+                len(self._fragments) > self.max_fragments or self._bytes > self.max_bytes
+            ):
+                self._drop(next(iter(self._fragments)))
+            self._hits += len(parts) - len(encoded)
+            self._misses += len(encoded)
+
+        rest = encode_json({key: value for key, value in body.items() if key != "messages"})
+        separator = b"," if len(rest) > 2 else b""
+        return rest[:-1] + separator + b'"messages":[' + b",".join(parts) + b"]}"
+
+    def stats(self) -> dict:
+        """
+        Return how many messages were reused from previous requests and how many were encoded
+        """
+        with self._lock:
+            return {"reused": self._hits, "encoded": self._misses}
+
+    def _drop(self, key: int) -> None:
+        cached = self._fragments.pop(key, None)
+        if cached is not None:
+            self._bytes -= len(cached[2])
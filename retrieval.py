@@ -0,0 +1,314 @@
+import glob
+import hashlib
+import os
+import re
+import sqlite3
+import subprocess
+import threading
+from pathlib import Path
+from typing import Optional
+
+from context_window import count_tokens
+
+DEFAULT_CHUNK_TOKENS = 300
+DEFAULT_TOP_K = 5
+DEFAULT_BUDGET = 2000
+
+# Files found in directories bigger than this, or that look binary, are not used as context
+MAX_FILE_BYTES = 1024 * 1024
+SKIPPED_DIRECTORIES = {".git", ".hg", ".svn", "node_modules", "__pycache__", ".venv", "venv"}
+
+WORD = re.compile(r"[A-Za-z0-9]+")
+
+
+def expand_paths(patterns: tuple) -> tuple:
+    """
+    Turn the --context arguments (files, directories or glob patterns) into a list of text files.
+
+    Directories are walked without their hidden files and folders and the files ignored by git.
+    Files found in directories or by glob patterns are left out when they are bigger than
+    MAX_FILE_BYTES, files given by name are used whatever their size. Binary files are always left
+    out. Returns the files and the (path, reason) of the ones left out.
+    """
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            walked = []
+            # Absolute paths, git runs in the directory
+            for root, directories, files in os.walk(os.path.abspath(pattern)):
+                directories[:] = sorted(
+                    d for d in directories if d not in SKIPPED_DIRECTORIES and not d.startswith(".")
+                )
+                walked.extend(
+                    Path(root, name) for name in sorted(files) if not name.startswith(".")
+                )
+            ignored = ignored_by_git(pattern, walked)
+            paths.extend((path, True) for path in walked if path not in ignored)
+        elif os.path.isfile(pattern):
+            paths.append((Path(pattern), False))
+        else:
+            matches = sorted(glob.glob(pattern, recursive=True))
+            if not matches:
+                raise FileNotFoundError(f"No context file matches '{pattern}'")
+            paths.extend((Path(match), True) for match in matches if os.path.isfile(match))
+
+    # A file given by name is never capped, even if a directory or pattern found it too
+    unique = {}
+    for path, found in paths:
+        path = path.resolve()
+        unique[path] = unique.get(path, True) and found
+
+    files = []
+    skipped = []
+    for path, found in unique.items():
+        reason = skip_reason(path, MAX_FILE_BYTES if found else None)
+        if reason is None:
+            files.append(path)
+        else:
+            skipped.append((path, reason))
+    return files, skipped
+
+
+def ignored_by_git(directory: str, paths: list) -> set:
+    """
+    Return the paths ignored by the .gitignore files of their repository, none when the directory
+    is not in a git work tree or git is not installed
+    """
+    if not paths:
+        return set()
+
+    try:
+        result = subprocess.run(
+            ["git", "check-ignore", "--stdin", "-z"],
+            cwd=directory,
+            input=b"".join(os.fsencode(path) + b"\0" for path in paths),
+            capture_output=True,
+        )
+    except OSError:
+        return set()
+    # 1 when no path is ignored, 128 outside of a repository
+    if result.returncode != 0:
+        return set()
+    return {Path(os.fsdecode(path)) for path in result.stdout.split(b"\0") if path}
+
+
+def skip_reason(path: Path, max_bytes: Optional[int]) -> Optional[str]:
+    """
+    Tell why a file can't be used as context: binary, unreadable or bigger than max_bytes. None
+    for text files.
+    """
+    try:
+        if max_bytes is not None and path.stat().st_size > max_bytes:
+            return f"over {max_bytes / 1024 / 1024:g} MB"
+        with open(path, "rb") as f:
+            if b"\0" in f.read(8192):
+                return "binary"
+    except OSError as e:
+        return e.strerror or "unreadable"
+    return None
+
+
+def read_text(path: Path) -> str:
+    """
+    Read a context file, undecodable bytes are replaced
+    """
+    with open(path, encoding="utf-8", errors="replace") as f:
+        return f.read()
+
+
+def chunk_text(text: str, chunk_tokens: int = DEFAULT_CHUNK_TOKENS) -> list:
+    """
+    Split a text into chunks of about chunk_tokens tokens, preferably at blank lines.
+    Returns (first line, last line, content) tuples, line numbers start at 1.
+    """
+    # Chunks are sized by characters, counting tokens line by line would be too slow
+    limit = chunk_tokens * 4
+    chunks = []
+    lines = []
+    size = 0
+    start = 1
+
+    for number, line in enumerate(text.splitlines(keepends=True), start=1):
+        if lines and (size + len(line) > limit or (not line.strip() and size > limit // 2)):
+            chunks.append((start, number - 1, "".join(lines)))
+            lines, size, start = [], 0, number
+        lines.append(line)
+        size += len(line)
+
+    if "".join(lines).strip():
+        chunks.append((start, start + len(lines) - 1, "".join(lines)))
+
+    return [chunk for chunk in chunks if chunk[2].strip()]
+
+
+def match_query(text: str) -> str:
+    """
+    FTS5 query matching any of the words of a message, ranked by BM25
+    """
+    words = dict.fromkeys(word.lower() for word in WORD.findall(text))
+    return " OR ".join(f'"{word}"' for word in words)
+
+
+class ContextIndex:
+    """
+    Persistent BM25 index (SQLite FTS5) over the chunks of the context files.
+
+    Files are re-chunked only when their content changed: an unchanged size and modification time
+    skips the file without reading it, an unchanged hash only refreshes the stored stat.
+    """
+
+    def __init__(self, path: Path, chunk_tokens: int = DEFAULT_CHUNK_TOKENS):
+        self.chunk_tokens = chunk_tokens
+        # Chunks are retrieved from the turn worker thread and for fan-out requests
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                hash TEXT NOT NULL,
+                chunk_tokens INTEGER NOT NULL,
+                tokens INTEGER NOT NULL
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5(
+                content, path UNINDEXED, start UNINDEXED, end UNINDEXED, tokens UNINDEXED
+            );
+            CREATE TEMP TABLE selected (path TEXT PRIMARY KEY);
+            """
+        )
+
+    def update(self, paths: list) -> int:
+        """
+        Index the given files if they changed since the last run, returns how many were indexed
+        """
+        known = {
+            row[0]: row[1:]
+            for row in self._db.execute("SELECT path, size, mtime, hash, chunk_tokens FROM files")
+        }
+
+        indexed = 0
+        for path in paths:
+            stat = path.stat()
+            previous = known.get(str(path))
+            unchanged = previous and previous[:2] == (stat.st_size, stat.st_mtime)
+            if unchanged and previous[3] == self.chunk_tokens:
+                continue
+
+            text = read_text(path)
+            digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+            if previous and previous[2] == digest and previous[3] == self.chunk_tokens:
+                self._db.execute(
+                    "UPDATE files SET size = ?, mtime = ? WHERE path = ?",
+                    (stat.st_size, stat.st_mtime, str(path)),
+                )
+                continue
+
+            self._db.execute("DELETE FROM chunks WHERE path = ?", (str(path),))
+            rows = [
+                (content, str(path), first, last, count_tokens(content))
+                for first, last, content in chunk_text(text, self.chunk_tokens)
+            ]
+            self._db.executemany(
+                "INSERT INTO chunks (content, path, start, end, tokens) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    str(path),
+                    stat.st_size,
+                    stat.st_mtime,
+                    digest,
+                    self.chunk_tokens,
+                    sum(row[4] for row in rows),
+                ),
+            )
+            indexed += 1
+
+        self._db.execute("DELETE FROM temp.selected")
+        self._db.executemany(
+            "INSERT OR IGNORE INTO temp.selected VALUES (?)", ((str(p),) for p in paths)
+        )
+        self._db.commit()
+
+        return indexed
+
+    def total_tokens(self) -> int:
+        """
+        Number of tokens of the files selected by the last update
+        """
+        return self._db.execute(
+            "SELECT COALESCE(SUM(tokens), 0) FROM files WHERE path IN temp.selected"
+        ).fetchone()[0]
+
+    def retrieve(self, query: str, top_k: int, budget: int) -> list:
+        """
+        Return up to top_k of the most relevant chunks of the selected files, within a token budget
+        """
+        match = match_query(query)
+        if not match:
+            return []
+
+        with self._lock:
+            rows = self._db.execute(
+                """
+                SELECT content, path, start, end, tokens FROM chunks
+                WHERE chunks MATCH ? AND path IN temp.selected
+                ORDER BY rank LIMIT ?
+                """,
+                (match, top_k * 4),
+            ).fetchall()
+
+        chunks = []
+        used = 0
+        for content, path, start, end, tokens in rows:
+            if used + tokens > budget:
+                continue
+            chunks.append({"content": content, "path": path, "start": start, "end": end})
+            used += tokens
+            if len(chunks) == top_k:
+                break
+
+        return chunks
+
+    def close(self) -> None:
+        """
+        Close the index database
+        """
+        self._db.close()
+
+
+class ContextRetriever:
+    """
+    Picks, for each user message, the chunks of the context files worth sending with it
+    """
+
+    def __init__(
+        self, index: ContextIndex, top_k: int = DEFAULT_TOP_K, budget: int = DEFAULT_BUDGET
+    ):
+        self.index = index
+        self.top_k = top_k
+        self.budget = budget
+
+    def context_message(self, query: str) -> Optional[dict]:
+        """
+        Build a system message with the relevant excerpts, or None if nothing matches
+        """
+        chunks = self.index.retrieve(query, self.top_k, self.budget)
+        if not chunks:
+            return None
+
+        excerpts = [
+            f"{c['path']} (lines {c['start']}-{c['end']}):\n```\n{c['content'].rstrip()}\n```"
+            for c in chunks
+        ]
+        content = "Relevant excerpts from the context files:\n\n" + "\n\n".join(excerpts)
+        return {"role": "system", "content": content}
+
+    def close(self) -> None:
+        """
+        Close the index
+        """
+        self.index.close()
@@ -0,0 +1,272 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Iterator, Optional
+
+from client import APIConnectionError, APIError, ChatClient
+
+# Status codes worth retrying: rate limits, timeouts and server errors
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+# Status codes meaning the model is saturated, they count towards the fallback
+SATURATED_STATUS = {429, 503}
+
+DEFAULT_MAX_RETRIES = 4
+DEFAULT_BACKOFF_BASE = 0.5
+DEFAULT_BACKOFF_MAX = 20
+DEFAULT_DEADLINE = 120
+DEFAULT_FALLBACK_AFTER = 2
+
+# Latencies kept to compute the hedging threshold, and how many are needed before hedging starts
+LATENCY_WINDOW = 200
+MIN_LATENCY_SAMPLES = 20
+
+
+def percentile(values: list, fraction: float) -> float:
+    """
+    Nearest-rank percentile of a list of numbers
+    """
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class RequestScheduler:
+    """
+    Sends requests through a ChatClient with retries, deadlines, hedging and model fallback.
+
+    - Rate limits (429), timeouts and server errors are retried with jittered exponential backoff,
+      honouring Retry-After when the server sends it
+    - Every request must complete within a deadline, retries included, streams until their end
+    - With hedging enabled, a duplicate of a slow request is sent once it has been pending longer
+      than hedge_after seconds (or the p95 of recent latencies), the first answer wins
+    - A model that keeps answering 429/503 is swapped for its entry in fallback_models
+
+    Cancelled requests (APICancelledError) are not retried. Streaming requests are only retried
+    and hedged before the first byte, to never render an answer twice: the stream whose response
+    starts first wins, the other one is closed.
+    """
+
+    def __init__(
+        self,
+        client: ChatClient,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        backoff_base: float = DEFAULT_BACKOFF_BASE,
+        backoff_max: float = DEFAULT_BACKOFF_MAX,
+        deadline: float = DEFAULT_DEADLINE,
+        hedge: bool = False,
+        hedge_after: Optional[float] = None,
+        fallback_models: Optional[dict] = None,
+        fallback_after: int = DEFAULT_FALLBACK_AFTER,
+        notify: Optional[Callable[[str], None]] = None,
+    ):
+        self.client = client
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.deadline = deadline
+        self.hedge = hedge
+        self.hedge_after = hedge_after
+        self.fallback_models = fallback_models or {}
+        self.fallback_after = fallback_after
+        self.notify = notify
+
+        self.retries = 0
+        self.hedges = 0
+        self.fallbacks = 0
+
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        # A stream is timed until its response starts, not until its end
+        self._stream_latencies = deque(maxlen=LATENCY_WINDOW)
+        self._local = threading.local()
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(
+        cls, client: ChatClient, config: dict, notify: Optional[Callable[[str], None]] = None
+    ) -> "RequestScheduler":
+        """
+        Build a scheduler from the retry settings of the config file
+        """
+        return cls(
+            client,
+            max_retries=config.get("max_retries", DEFAULT_MAX_RETRIES),
+            backoff_base=config.get("backoff_base", DEFAULT_BACKOFF_BASE),
+            backoff_max=config.get("backoff_max", DEFAULT_BACKOFF_MAX),
+            deadline=config.get("deadline", DEFAULT_DEADLINE),
+            hedge=config.get("hedge", False),
+            hedge_after=config.get("hedge_after"),
+            fallback_models=config.get("fallback_models"),
+            fallback_after=config.get("fallback_after", DEFAULT_FALLBACK_AFTER),
+            notify=notify,
+        )
+
+    @property
+    def last_model(self) -> Optional[str]:
+        """
+        Model that answered the last request of the current thread, after any fallback
+        """
+        return getattr(self._local, "model", None)
+
+    @property
+    def last_timing(self) -> Optional[dict]:
+        """
+        Timings of the request that answered the last call of the current thread, see
+        ChatClient.last_timing
+        """
+        return getattr(self._local, "timing", None)
+
+    def chat(self, body: dict) -> dict:
+        """
+        Send a chat completion request and return the decoded response
+        """
+        return self._run(body, self._chat_once)
+
+    def stream(self, body: dict) -> Iterator:
+        """
+        Send a streaming chat completion request and return an iterator over the raw SSE lines
+        """
+        return self._run(body, self._stream_once)
+
+    def hedge_delay(self, streaming: bool = False) -> Optional[float]:
+        """
+        Seconds after which a pending request is duplicated, None when hedging is off
+        """
+        if not self.hedge:
+            return None
+        if self.hedge_after is not None:
+            return self.hedge_after
+        latencies = self._stream_latencies if streaming else self._latencies
+        with self._lock:
+            if len(latencies) < MIN_LATENCY_SAMPLES:
+                return None
+            return percentile(list(latencies), 0.95)
+
+    def stats(self) -> dict:
+        """
+        Return the number of retries, hedged requests and fallbacks so far
+        """
+        with self._lock:
+            return {"retries": self.retries, "hedges": self.hedges, "fallbacks": self.fallbacks}
+
+    def close(self) -> None:
+        """
+        Stop the hedging threads, requests still in flight are abandoned
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def _run(self, body: dict, send: Callable):
+        # A cancel only applies to the request it was meant for, and its retries
+        self.client.reset_cancel()
+        body = dict(body)
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        saturated = 0
+
+        while True:
+            self._local.timing = None
+            try:
+                result = send(body, max(deadline - time.monotonic(), 0.001))
+                self._local.model = body["model"]
+                if self._local.timing is None:
+                    self._local.timing = self.client.last_timing
+                return result
+            except APIError as e:
+                if e.status_code not in RETRYABLE_STATUS:
+                    raise
+                error, retry_after = e, e.retry_after
+                if e.status_code in SATURATED_STATUS:
+                    saturated += 1
+            except APIConnectionError as e:
+                error, retry_after = e, None
+
+            attempt += 1
+            if attempt > self.max_retries:
+                raise error
+
+            fallback = self.fallback_models.get(body["model"])
+            if fallback and saturated >= self.fallback_after:
+                # Another model has its own rate limits, no need to wait
+                self._notify(f"{body['model']} is saturated, falling back to {fallback}")
+                body["model"] = fallback
+                saturated = 0
+                delay = 0.0
+                with self._lock:
+                    self.fallbacks += 1
+            elif retry_after is not None:
+                delay = retry_after
+            else:
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+            if time.monotonic() + delay >= deadline:
+                raise error
+
+            if delay:
+                self._notify(f"{error}, retrying in {delay:.1f}s")
+            with self._lock:
+                self.retries += 1
+            time.sleep(delay)
+
+    def _chat_once(self, body: dict, timeout: float) -> dict:
+        return self._send_once(body, timeout, self.client.chat, self._latencies)
+
+    def _stream_once(self, body: dict, timeout: float) -> Iterator:
+        return self._send_once(body, timeout, self.client.stream, self._stream_latencies)
+
+    def _send_once(self, body: dict, timeout: float, send: Callable, latencies: deque):
+        start = time.monotonic()
+        delay = self.hedge_delay(streaming=latencies is self._stream_latencies)
+        if delay is None or delay >= timeout:
+            result = send(body, timeout)
+        else:
+            result = self._hedged(body, timeout, delay, send)
+
+        with self._lock:
+            latencies.append(time.monotonic() - start)
+        return result
+
+    def _hedged(self, body: dict, timeout: float, delay: float, send: Callable):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(thread_name_prefix="hedge")
+            executor = self._executor
+
+        pending = {executor.submit(self._timed, send, body, timeout)}
+        done, _ = wait(pending, timeout=delay)
+        if not done:
+            pending.add(executor.submit(self._timed, send, body, timeout - delay))
+            with self._lock:
+                self.hedges += 1
+
+        # The first successful answer wins, the other request finishes in the background
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    result, self._local.timing = future.result()
+                    for loser in pending:
+                        loser.add_done_callback(self._discard)
+                    return result
+                error = error or future.exception()
+        raise error
+
+    def _timed(self, send: Callable, body: dict, timeout: float) -> tuple:
+        # Timings are kept per thread, they are handed over along with the result
+        result = send(body, timeout)
+        return result, self.client.last_timing
+
+    @staticmethod
+    def _discard(future) -> None:
+        # A stream that lost the race is closed, its connection must not stay open
+        if future.cancelled() or future.exception() is not None:
+            return
+        result, _ = future.result()
+        if hasattr(result, "close"):
+            result.close()
+
+    def _notify(self, message: str) -> None:
+        if self.notify is not None:
+            self.notify(message)
@@ -0,0 +1,148 @@
+import json
+import sqlite3
+from pathlib import Path
+from typing import Optional
+
+from journal import read_journal
+
+INDEX_FILE = "index.sqlite"
+DEFAULT_LIMIT = 10
+
+# Markers around the matching words in snippets, they can't appear in the indexed text
+HIGHLIGHT_START = "\x02"
+HIGHLIGHT_END = "\x03"
+
+
+def fts_query(text: str) -> str:
+    """
+    Turn free text into an FTS5 query matching all the words, whatever characters they contain
+    """
+    return " ".join('"' + word.replace('"', '""') + '"' for word in text.split())
+
+
+class SessionIndex:
+    """
+    Full-text index (SQLite FTS5) over the saved sessions.
+
+    Journals are append-only, so a grown journal is indexed from where it was left; a file that
+    didn't change since the last update is skipped without being read.
+    """
+
+    def __init__(self, folder: Path):
+        self.folder = Path(folder)
+        self._db = sqlite3.connect(str(self.folder / INDEX_FILE))
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                name TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                offset INTEGER NOT NULL,
+                turns INTEGER NOT NULL
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS turns USING fts5(
+                content, role UNINDEXED, session UNINDEXED, turn UNINDEXED
+            );
+            """
+        )
+
+    def update(self) -> int:
+        """
+        Index every new or changed session of the folder, returns the number of turns added
+        """
+        added = 0
+        for path in sorted(self.folder.glob("chatgpt-session-*.json*")):
+            added += self.update_file(path, commit=False)
+        self._db.commit()
+        return added
+
+    def update_file(self, path: Path, commit: bool = True) -> int:
+        """
+        Index the turns of a session that are not in the index yet, returns how many were added
+        """
+        path = Path(path)
+        stat = path.stat()
+        row = self._db.execute(
+            "SELECT size, mtime, offset, turns FROM files WHERE name = ?", (path.name,)
+        ).fetchone()
+
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime:
+            return 0
+
+        # A journal that only grew is read from where the last update stopped
+        offset, turn = 0, 0
+        if row is not None and path.suffix == ".jsonl" and stat.st_size >= row[2]:
+            offset, turn = row[2], row[3]
+        elif row is not None:
+            self._db.execute("DELETE FROM turns WHERE session = ?", (path.stem,))
+
+        rows = []
+        if path.suffix == ".jsonl":
+            with open(path, "rb") as f:
+                f.seek(offset)
+                for line in f:
+                    # A line still being written is picked up by the next update
+                    if not line.endswith(b"\n"):
+                        break
+                    offset += len(line)
+                    rows.append(self._row(json.loads(line), path.stem, turn))
+                    turn += 1
+        else:
+            for message in read_journal(path):
+                rows.append(self._row(message, path.stem, turn))
+                turn += 1
+            offset = stat.st_size
+
+        rows = [r for r in rows if r[0]]
+        self._db.executemany(
+            "INSERT INTO turns (content, role, session, turn) VALUES (?, ?, ?, ?)", rows
+        )
+        self._db.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+            (path.name, stat.st_size, stat.st_mtime, offset, turn),
+        )
+        if commit:
+            self._db.commit()
+
+        return len(rows)
+
+    @staticmethod
+    def _row(message: dict, session: str, turn: int) -> tuple:
+        return (message.get("content") or "", message["role"], session, turn)
+
+    def search(self, text: str, limit: int = DEFAULT_LIMIT) -> list:
+        """
+        Return the best matching turns as dicts with session, turn, role and a highlighted snippet
+        """
+        query = fts_query(text)
+        if not query:
+            return []
+
+        rows = self._db.execute(
+            """
+            SELECT session, turn, role, snippet(turns, 0, ?, ?, '...', 16)
+            FROM turns WHERE turns MATCH ? ORDER BY rank LIMIT ?
+            """,
+            (HIGHLIGHT_START, HIGHLIGHT_END, query, limit),
+        ).fetchall()
+
+        return [
+            {"session": session, "turn": turn, "role": role, "snippet": snippet}
+            for session, turn, role, snippet in rows
+        ]
+
+    def session_path(self, session: str) -> Optional[Path]:
+        """
+        Find the file of a session from its name, as displayed in the search results
+        """
+        for suffix in (".jsonl", ".json"):
+            path = self.folder / f"{Path(session).stem}{suffix}"
+            if path.exists():
+                return path
+        return None
+
+    def close(self) -> None:
+        """
+        Close the index database
+        """
+        self._db.close()
@@ -0,0 +1,132 @@
+import json
+import time
+from typing import Iterable, Iterator, Optional
+
+from rich.console import Console
+
+from context_window import count_tokens
+from rendering import Renderer
+
+# How often the Markdown view is redrawn while tokens are arriving
+REFRESH_PER_SECOND = 8
+
+
+def iter_sse_events(lines: Iterable, timing: Optional[dict] = None) -> Iterator[dict]:
+    """
+    Parse the server-sent-event lines of a streamed chat completion and yield each JSON chunk.
+    The time spent decoding is added to timing["parse"], if given.
+    """
+    for line in lines:
+        start = time.perf_counter()
+        if not line:
+            continue
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        if not line.startswith("data:"):
+            continue
+
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            break
+
+        event = json.loads(data)
+        if timing is not None:
+            timing["parse"] += time.perf_counter() - start
+        yield event
+
+
+def estimate_usage(messages: list, content: str) -> dict:
+    """
+    Local usage estimate for servers that don't report usage in streams
+    """
+    prompt_tokens = sum(count_tokens(m.get("content") or "") for m in messages)
+    completion_tokens = count_tokens(content)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def stream_chat_completion(
+    lines: Iterable,
+    console: Console,
+    markdown: bool,
+    messages: list,
+    renderer: Optional[Renderer] = None,
+) -> dict:
+    """
+    Render a streamed chat completion as it arrives and return the assembled result.
+    Markdown is rendered block by block, by the given renderer or a default one.
+
+    The result holds the final assistant message, the usage (reported by the server when
+    available, estimated otherwise), the time to first token, the total stream time and the time
+    spent parsing events and rendering text, in seconds.
+    """
+    start = time.perf_counter()
+    timing = {"parse": 0.0, "render": 0.0}
+    ttft = None
+    role = "assistant"
+    parts = []
+    usage = None
+
+    # The view is redrawn from this thread rather than by a background refresher, so that the
+    # time spent rendering can be measured
+    view = None
+    refreshed = 0.0
+    if markdown:
+        view = (renderer or Renderer(console)).stream(console)
+
+    try:
+        for event in iter_sse_events(lines, timing):
+            if event.get("usage"):
+                usage = event["usage"]
+
+            for choice in event.get("choices", []):
+                delta = choice.get("delta", {})
+                role = delta.get("role", role)
+                text = delta.get("content")
+                if not text:
+                    continue
+
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                parts.append(text)
+
+                render_start = time.perf_counter()
+                if view is None:
+                    console.print(text, end="", markup=False, highlight=False, soft_wrap=True)
+                else:
+                    view.feed(text)
+                    if render_start - refreshed >= 1 / REFRESH_PER_SECOND:
+                        view.refresh()
+                        refreshed = render_start
+                timing["render"] += time.perf_counter() - render_start
+
+        # Read what follows [DONE], a stream closed before its end can't go back to the pool
+        for _ in lines:
+            pass
+    finally:
+        # An interrupted stream is closed right away rather than when the iterator is collected
+        if hasattr(lines, "close"):
+            lines.close()
+
+        render_start = time.perf_counter()
+        if view is not None:
+            view.close()
+        else:
+            console.line()
+        timing["render"] += time.perf_counter() - render_start
+
+    content = "".join(parts)
+    if usage is None:
+        usage = estimate_usage(messages, content)
+
+    return {
+        "message": {"role": role, "content": content},
+        "usage": usage,
+        "ttft": ttft,
+        "elapsed": time.perf_counter() - start,
+        "parse": timing["parse"],
+        "render": timing["render"],
+    }
@@ -0,0 +1,163 @@
+import asyncio
+import io
+import json
+
+from batch import RateLimiter, read_jobs, run_batch
+from client import APIError
+
+CONFIG = {"model": "gpt-3.5-turbo", "temperature": 0.7}
+
+
+class FakeScheduler:
+    """
+    Answers every request with its last message, fails the ones asking to
+    """
+
+    def chat(self, body: dict) -> dict:
+        content = body["messages"][-1]["content"]
+        if content == "fail":
+            raise APIError(500)
+        if content == "not json":
+            # What a 200 with a body that isn't JSON raises
+            raise json.JSONDecodeError("Expecting value", "<html>", 0)
+        if content == "no usage":
+            return {"choices": [{"message": {"role": "assistant", "content": content}}]}
+        return {
+            "choices": [{"message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+        }
+
+
+def test_read_jobs_builds_bodies():
+    lines = io.StringIO(
+        '{"id": "a", "prompt": "hi", "max_tokens": 5}\n'
+        "\n"
+        '{"messages": [{"role": "user", "content": "yo"}], "model": "gpt-4"}\n'
+    )
+    jobs = list(read_jobs(lines, CONFIG))
+
+    assert jobs[0] == {
+        "id": "a",
+        "body": {
+            "model": "gpt-3.5-turbo",
+            "temperature": 0.7,
+            "messages": [{"role": "user", "content": "hi"}],
+            "max_tokens": 5,
+        },
+    }
+    # Lines are numbered from 1, blank ones included
+    assert jobs[1]["id"] == 3
+    assert jobs[1]["body"]["model"] == "gpt-4"
+
+
+def test_read_jobs_reports_invalid_lines():
+    lines = io.StringIO('{"id": 1, "prompt": "ok"}\nnot json\n{"id": "x"}\n[1, 2]\n')
+    jobs = list(read_jobs(lines, CONFIG))
+
+    assert "body" in jobs[0]
+    assert jobs[1]["id"] == 2 and "Invalid JSON on line 2" in jobs[1]["error"]
+    assert jobs[2] == {"id": "x", "error": "No prompt or messages on line 3"}
+    assert jobs[3] == {"id": 4, "error": "No prompt or messages on line 4"}
+
+
+def test_read_jobs_reports_fields_of_the_wrong_type():
+    lines = io.StringIO(
+        '{"id": 1, "prompt": 123}\n'
+        '{"id": 2, "messages": "hi"}\n'
+        '{"id": 3, "messages": [{"role": "user"}]}\n'
+        '{"id": 4, "messages": ["hi"]}\n'
+        '{"id": 5, "prompt": "hi", "max_tokens": "10"}\n'
+        '{"id": 6, "prompt": "hi", "max_tokens": true}\n'
+        '{"id": 7, "prompt": "hi", "temperature": "hot"}\n'
+        '{"id": 8, "prompt": "hi", "model": 4}\n'
+    )
+    jobs = list(read_jobs(lines, CONFIG))
+
+    assert [job["id"] for job in jobs] == list(range(1, 9))
+    assert all("body" not in job for job in jobs)
+    assert jobs[0]["error"] == "prompt is not a string on line 1"
+    assert jobs[1]["error"] == "messages is not a list of messages on line 2"
+    assert jobs[2]["error"] == "A message has no text content on line 3"
+    assert jobs[3]["error"] == "A message has no role on line 4"
+    assert jobs[4]["error"] == "max_tokens is not a positive integer on line 5"
+    assert jobs[5]["error"] == "max_tokens is not a positive integer on line 6"
+    assert jobs[6]["error"] == "temperature is not a number on line 7"
+    assert jobs[7]["error"] == "model is not a string on line 8"
+
+
+def test_run_batch_goes_on_after_jobs_of_the_wrong_type():
+    lines = io.StringIO(
+        '{"id": 1, "prompt": 123}\n'
+        '{"id": 2, "messages": "hi"}\n'
+        '{"id": 3, "prompt": "hi", "max_tokens": "10"}\n'
+        '{"id": 4, "prompt": "four"}\n'
+    )
+    output = io.StringIO()
+    totals = asyncio.run(run_batch(read_jobs(lines, CONFIG), FakeScheduler(), output, 2))
+
+    records = {r["id"]: r for r in map(json.loads, output.getvalue().splitlines())}
+    assert all("error" in records[i] for i in (1, 2, 3))
+    assert records[4]["message"]["content"] == "four"
+    assert totals["jobs"] == 4 and totals["errors"] == 3
+
+
+def test_run_batch_goes_on_after_unexpected_answers():
+    lines = io.StringIO(
+        '{"id": 1, "prompt": "not json"}\n'
+        '{"id": 2, "prompt": "no usage"}\n'
+        '{"id": 3, "prompt": "three"}\n'
+    )
+    output = io.StringIO()
+    totals = asyncio.run(run_batch(read_jobs(lines, CONFIG), FakeScheduler(), output, 1))
+
+    records = {r["id"]: r for r in map(json.loads, output.getvalue().splitlines())}
+    assert records[1]["error"].startswith("Unexpected error: JSONDecodeError")
+    assert records[2]["error"].startswith("Unexpected error: KeyError")
+    assert records[3]["message"]["content"] == "three"
+    assert totals["jobs"] == 3 and totals["errors"] == 2
+
+
+def test_run_batch_goes_on_after_bad_lines():
+    lines = io.StringIO(
+        '{"id": 1, "prompt": "one"}\n'
+        "{broken\n"
+        '{"id": 3, "prompt": "fail"}\n'
+        '{"id": 4, "prompt": "four"}\n'
+    )
+    output = io.StringIO()
+    totals = asyncio.run(run_batch(read_jobs(lines, CONFIG), FakeScheduler(), output, 2))
+
+    records = {r["id"]: r for r in map(json.loads, output.getvalue().splitlines())}
+    assert set(records) == {1, 2, 3, 4}
+    assert records[1]["message"]["content"] == "one"
+    assert "error" in records[2] and "error" in records[3]
+    assert records[4]["message"]["content"] == "four"
+    assert totals["jobs"] == 4 and totals["errors"] == 2
+
+
+def test_rate_limiter_waits_for_the_request_budget():
+    async def run() -> float:
+        # 600 requests per minute: a burst of 600, then one every 0.1s
+        limiter = RateLimiter(600, None)
+        limiter._requests = 1
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await limiter.acquire(0)
+        await limiter.acquire(0)
+        return loop.time() - start
+
+    assert 0.05 < asyncio.run(run()) < 0.5
+
+
+def test_rate_limiter_settles_the_token_estimate():
+    limiter = RateLimiter(None, 1000)
+    asyncio.run(limiter.acquire(800))
+    limiter.settle(800, 100)
+    # 700 tokens given back, on top of the 200 left (and what was refilled meanwhile)
+    assert 900 <= limiter._tokens <= 1000
+
+
+def test_rate_limiter_caps_oversized_requests():
+    # A request bigger than the whole budget must not wait forever
+    limiter = RateLimiter(None, 100)
+    asyncio.run(asyncio.wait_for(limiter.acquire(1000), 1))
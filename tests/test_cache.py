@@ -0,0 +1,60 @@
+import itertools
+import json
+import time
+
+from cache import ResponseCache, cache_key
+
+BODY = {"model": "gpt-4", "temperature": 0, "messages": [{"role": "user", "content": "hi"}]}
+
+
+def response(text: str) -> dict:
+    return {"choices": [{"message": {"role": "assistant", "content": text}}]}
+
+
+def test_key_ignores_field_order():
+    assert cache_key(BODY) == cache_key(dict(reversed(list(BODY.items()))))
+    assert cache_key(BODY) != cache_key(dict(BODY, model="gpt-3.5-turbo"))
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, monkeypatch):
+    clock = itertools.count(1000)
+    monkeypatch.setattr(time, "time", lambda: next(clock))
+    cache = ResponseCache(tmp_path / "cache.sqlite", max_entries=2)
+
+    cache.put("a", response("a"))
+    cache.put("b", response("b"))
+    assert cache.get("a") == response("a")
+    cache.put("c", response("c"))
+
+    assert cache.get("b") is None
+    assert cache.get("a") == response("a")
+    assert cache.get("c") == response("c")
+    assert cache.stats()["entries"] == 2
+    cache.close()
+
+
+def test_entries_are_evicted_beyond_the_size(tmp_path, monkeypatch):
+    clock = itertools.count(1000)
+    monkeypatch.setattr(time, "time", lambda: next(clock))
+    size = len(json.dumps(response("a" * 50), separators=(",", ":")))
+    cache = ResponseCache(tmp_path / "cache.sqlite", max_bytes=size * 3 // 2)
+
+    cache.put("a", response("a" * 50))
+    cache.put("b", response("b" * 50))
+
+    assert cache.get("a") is None
+    assert cache.stats() == {"hits": 0, "misses": 1, "entries": 1, "bytes": size}
+    cache.close()
+
+
+def test_expired_entries_are_misses(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    cache = ResponseCache(tmp_path / "cache.sqlite", max_age=60)
+    cache.put("a", response("a"))
+
+    now[0] += 61
+
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0
+    cache.close()
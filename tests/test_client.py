@@ -0,0 +1,44 @@
+import threading
+import time
+
+import pytest
+
+from benchmarks.mock_server import MockServer
+from client import APICancelledError, ChatClient
+
+BODY = {"model": "gpt-3.5-turbo", "messages": [{"role": "user", "content": "hi"}]}
+
+
+def cancel_soon(client: ChatClient, delay: float = 0.3) -> None:
+    threading.Timer(delay, client.cancel, (threading.get_ident(),)).start()
+
+
+def test_cancel_stops_a_stream():
+    with MockServer(tokens=20, token_delay=2) as server:
+        client = ChatClient(server.url, "key")
+        lines = client.stream(dict(BODY, stream=True))
+        cancel_soon(client)
+        start = time.monotonic()
+        with pytest.raises(APICancelledError):
+            for _ in lines:
+                pass
+        assert time.monotonic() - start < 1.5
+        client.close()
+
+
+def test_cancel_stops_a_pending_request():
+    with MockServer(latency=3) as server:
+        client = ChatClient(server.url, "key")
+        cancel_soon(client)
+        start = time.monotonic()
+        with pytest.raises(APICancelledError):
+            client.chat(BODY)
+        assert time.monotonic() - start < 2
+
+        # Until it's reset, the thread's requests stay cancelled
+        with pytest.raises(APICancelledError):
+            client.chat(BODY)
+        client.reset_cancel()
+        server.latency = 0
+        assert client.chat(BODY)["choices"]
+        client.close()
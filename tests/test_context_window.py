@@ -0,0 +1,118 @@
+import pytest
+
+from context_window import ContextWindow
+
+MODEL = "gpt-3.5-turbo"
+
+
+def conversation() -> list:
+    """
+    A system message followed by two turns and the prompt being answered, about the same size each
+    """
+    return [
+        {"role": "system", "content": "You answer questions. " * 20},
+        {"role": "user", "content": "first question " * 25},
+        {"role": "assistant", "content": "first answer " * 30},
+        {"role": "user", "content": "second question " * 25},
+        {"role": "assistant", "content": "second answer " * 30},
+        {"role": "user", "content": "third question " * 25},
+    ]
+
+
+def window(policy: str, budget: int, **kwargs) -> ContextWindow:
+    # No reserve, the budget is the whole window
+    return ContextWindow(MODEL, budget, policy=policy, reserve_tokens=0, **kwargs)
+
+
+@pytest.mark.parametrize("policy", ["none", "sliding", "pin", "summarize"])
+def test_fit_leaves_a_conversation_within_budget(policy):
+    messages = conversation()
+    budget = window(policy, 0).count(messages)
+
+    assert window(policy, budget).fit(messages) == (messages, 0)
+
+
+def test_none_sends_everything():
+    messages = conversation()
+    assert window("none", 10).fit(messages) == (messages, 0)
+
+
+def test_sliding_drops_the_oldest_messages_first():
+    messages = conversation()
+    manager = window("sliding", 0)
+    # One token short: the oldest message goes, even the system one
+    manager.budget = manager.count(messages) - 1
+
+    fitted, saved = manager.fit(messages)
+    assert fitted == messages[1:]
+    assert saved == manager.count_message(messages[0])
+
+
+def test_pin_keeps_the_system_messages():
+    messages = conversation()
+    manager = window("pin", 0)
+    # Room for the system message and the last turn only
+    manager.budget = manager.count(messages[:1] + messages[-2:])
+
+    fitted, saved = manager.fit(messages)
+    assert fitted == messages[:1] + messages[-2:]
+    assert saved == sum(manager.count_message(m) for m in messages[1:-2])
+    assert manager.count(fitted) <= manager.budget
+
+
+def test_summarize_replaces_dropped_turns_after_the_system_messages():
+    messages = conversation()
+    manager = window("summarize", 0, summary_tokens=100)
+    manager.budget = manager.count(messages[:1] + messages[-2:]) + manager.summary_tokens
+
+    fitted, saved = manager.fit(messages)
+    summary = fitted[1]
+    assert fitted[0] == messages[0] and fitted[2:] == messages[-2:]
+    assert summary["role"] == "system"
+    assert summary["content"].startswith("Summary of the earlier conversation:")
+    # The most recent dropped turns are the ones kept in the summary
+    assert "second question" in summary["content"]
+    assert manager.count_message(summary) <= manager.summary_tokens
+    assert saved == manager.count(messages) - manager.count(fitted)
+    assert manager.count(fitted) <= manager.budget
+
+
+def test_summarize_goes_first_without_system_messages():
+    messages = conversation()[1:]
+    manager = window("summarize", 0, summary_tokens=100)
+    manager.budget = manager.count(messages[-1:]) + manager.summary_tokens
+
+    fitted, _ = manager.fit(messages)
+    assert fitted[0]["content"].startswith("Summary of the earlier conversation:")
+    assert fitted[1:] == messages[-1:]
+
+
+@pytest.mark.parametrize("policy", ["pin", "summarize"])
+def test_pinned_messages_over_budget_are_sent_with_a_warning(policy):
+    messages = conversation()
+    notes = []
+    manager = window(policy, 0, summary_tokens=10, notify=notes.append)
+    # Not even the system message fits
+    manager.budget = manager.count_message(messages[0]) // 2
+
+    fitted, saved = manager.fit(messages)
+    assert fitted[0] == messages[0] and fitted[-1] == messages[-1]
+    assert saved > 0
+    assert len(notes) == 1 and "may be rejected" in notes[0]
+
+
+def test_no_warning_when_the_messages_fit():
+    notes = []
+    manager = window("pin", 0, notify=notes.append)
+    manager.budget = manager.count(conversation()) - 1
+
+    manager.fit(conversation())
+    assert notes == []
+
+
+def test_unknown_model_is_not_trimmed():
+    notes = []
+    manager = ContextWindow.from_config({"model": "mystery"}, {MODEL: 4096}, notify=notes.append)
+
+    assert manager.policy == "none"
+    assert notes == ["Unknown context window for mystery, the conversation won't be trimmed"]
@@ -0,0 +1,144 @@
+import os
+
+import pytest
+
+from daemon import Contexts
+
+
+class FakeRetriever:
+    def __init__(self):
+        self.closed = False
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class Preparer:
+    """
+    Counts expansions and preparations, every context gets a retriever
+    """
+
+    def __init__(self):
+        self.expanded = 0
+        self.prepared = 0
+
+    def expand(self, patterns: tuple) -> tuple:
+        self.expanded += 1
+        files = sorted(path for pattern in patterns for path in pattern.iterdir())
+        if not files:
+            raise FileNotFoundError("No context file")
+        return files, []
+
+    def prepare(self, files: list) -> tuple:
+        self.prepared += 1
+        return [{"role": "system", "content": path.read_text()} for path in files], FakeRetriever()
+
+
+def test_context_is_prepared_once(tmp_path):
+    (tmp_path / "a.txt").write_text("a")
+    preparer = Preparer()
+    contexts = Contexts(preparer.expand, preparer.prepare, rescan_interval=60)
+
+    first = contexts.open((tmp_path,))
+    second = contexts.open((tmp_path,))
+
+    assert first is second
+    assert first.messages == [{"role": "system", "content": "a"}]
+    assert (preparer.expanded, preparer.prepared) == (1, 1)
+    assert contexts.stats() == {"open": 1, "files": 1}
+
+
+def test_changed_file_replaces_the_retriever(tmp_path):
+    path = tmp_path / "a.txt"
+    path.write_text("a")
+    preparer = Preparer()
+    contexts = Contexts(preparer.expand, preparer.prepare, rescan_interval=60)
+    retriever = contexts.open((tmp_path,)).retriever
+
+    path.write_text("b")
+    os.utime(path, ns=(0, path.stat().st_mtime_ns + 1))
+    context = contexts.open((tmp_path,))
+
+    assert context.messages == [{"role": "system", "content": "b"}]
+    assert retriever.closed
+    # The files found were checked without walking the directory again
+    assert (preparer.expanded, preparer.prepared) == (1, 2)
+
+    contexts.close()
+    assert context.retriever.closed
+
+
+def test_new_files_are_found_on_rescan(tmp_path):
+    (tmp_path / "a.txt").write_text("a")
+    preparer = Preparer()
+    contexts = Contexts(preparer.expand, preparer.prepare, rescan_interval=0)
+    contexts.open((tmp_path,))
+
+    (tmp_path / "b.txt").write_text("b")
+
+    assert len(contexts.open((tmp_path,)).files) == 2
+    assert preparer.prepared == 2
+
+
+def test_unmatched_pattern_raises(tmp_path):
+    contexts = Contexts(Preparer().expand, Preparer().prepare)
+
+    with pytest.raises(FileNotFoundError):
+        contexts.open((tmp_path,))
+
+
+class RecordingScheduler:
+    """
+    Streams a short answer and keeps the bodies it was sent
+    """
+
+    last_model = None
+    last_timing = {"encode": 0.0, "bytes": 0, "connect": 0.0, "ttfb": 0.0, "total": 0.0}
+
+    def __init__(self):
+        self.bodies = []
+
+    def stream(self, body: dict) -> list:
+        self.bodies.append(body)
+        self.last_model = body["model"]
+        return [b'data: {"choices": [{"delta": {"content": "ok"}}]}', b"data: [DONE]"]
+
+
+def test_request_is_fitted_to_the_window_of_its_model(tmp_path):
+    import json
+    from functools import lru_cache
+
+    import main
+    from context_window import ContextWindow
+    from daemon import Conversations
+    from metrics import Metrics
+
+    config = {"model": "gpt-3.5-turbo", "temperature": 0, "markdown": False}
+    # About 6000 tokens, more than the window of gpt-3.5-turbo, less than the one of gpt-4-32k
+    long_turn = [
+        {"role": "user", "content": "word " * 6000},
+        {"role": "assistant", "content": "noted"},
+    ]
+    (tmp_path / "chatgpt-session-long.jsonl").write_text(
+        "".join(json.dumps(m) + "\n" for m in long_turn)
+    )
+    scheduler = RecordingScheduler()
+    conversations = Conversations(tmp_path, lambda: [])
+    events = []
+
+    @lru_cache(maxsize=None)
+    def window(model: str) -> ContextWindow:
+        return ContextWindow(model, main.CONTEXT_WINDOW[model], "sliding")
+
+    for model in ("gpt-4-32k", "gpt-3.5-turbo"):
+        request = {"message": "Summarize", "session": "long", "model": model}
+        main.serve_request(
+            request, events.append, config, scheduler, window, None, Metrics(), conversations, None
+        )
+    conversations.close()
+
+    sent_long_turn = [
+        any(m["content"].startswith("word") for m in body["messages"]) for body in scheduler.bodies
+    ]
+    assert sent_long_turn == [True, False]
+    assert events[-1]["done"]
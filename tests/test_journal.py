@@ -0,0 +1,48 @@
+import json
+
+from journal import SessionJournal, read_journal
+
+MESSAGES = [{"role": "system", "content": "Be brief"}, {"role": "user", "content": "héllo"}]
+
+
+def test_sync_appends_new_messages_only(tmp_path):
+    path = tmp_path / "session.jsonl"
+    journal = SessionJournal(path)
+    journal.sync(MESSAGES[:1])
+    journal.sync(MESSAGES)
+    journal.sync(MESSAGES)
+    journal.close()
+
+    assert path.read_text(encoding="utf-8").count("\n") == 2
+    assert list(read_journal(path)) == MESSAGES
+
+
+def test_truncated_line_is_ignored_and_cut(tmp_path):
+    path = tmp_path / "session.jsonl"
+    lines = "".join(json.dumps(m) + "\n" for m in MESSAGES)
+    path.write_text(lines + '{"role": "assistant", "cont', encoding="utf-8")
+
+    assert list(read_journal(path)) == MESSAGES
+
+    journal = SessionJournal(path, written=2)
+    journal.sync(MESSAGES + [{"role": "assistant", "content": "hi"}])
+    journal.close()
+
+    assert list(read_journal(path))[-1] == {"role": "assistant", "content": "hi"}
+    assert len(list(read_journal(path))) == 3
+
+
+def test_truncated_only_line_is_cut(tmp_path):
+    path = tmp_path / "session.jsonl"
+    path.write_text('{"role"' + " " * 5000, encoding="utf-8")
+
+    SessionJournal(path).close()
+
+    assert path.read_bytes() == b""
+
+
+def test_json_sessions_are_read(tmp_path):
+    path = tmp_path / "session.json"
+    path.write_text(json.dumps(MESSAGES), encoding="utf-8")
+
+    assert list(read_journal(path)) == MESSAGES
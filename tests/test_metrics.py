@@ -0,0 +1,50 @@
+import main
+from cache import ResponseCache
+from metrics import Metrics
+
+USAGE = {"prompt_tokens": 100, "completion_tokens": 50, "total_tokens": 150}
+
+
+def test_record_adds_to_the_totals():
+    metrics = Metrics()
+    metrics.record("gpt-4", USAGE, {"build": 0.01, "request": 0.5}, cost=0.006)
+    metrics.record("gpt-4", USAGE, {"build": 0.01}, cached=True)
+
+    assert metrics.totals() == {
+        "gpt-4": {
+            "turns": 2,
+            "prompt_tokens": 100,
+            "completion_tokens": 50,
+            "cached_tokens": 150,
+            "cost": 0.006,
+        }
+    }
+    assert metrics.summary()["measurements"]["build"]["count"] == 2
+
+
+def test_expense_is_displayed_after_the_sources_are_closed(tmp_path, capsys):
+    metrics = Metrics()
+    cache = ResponseCache(tmp_path / "cache.sqlite")
+    metrics.add_source("cache", cache.stats)
+    metrics.record("gpt-3.5-turbo", USAGE, {"request": 0.5}, cost=0.0002)
+    cache.close()
+
+    main.display_expense(metrics)
+
+    output = capsys.readouterr().out
+    assert "Total tokens used: 150" in output
+    assert "Estimated expense: $0.0002" in output
+
+
+def test_closed_sources_have_no_stats(tmp_path):
+    from prompt_history import PromptHistory
+
+    metrics = Metrics()
+    history = PromptHistory(tmp_path / "history.sqlite")
+    cache = ResponseCache(tmp_path / "cache.sqlite")
+    metrics.add_source("history", history.stats)
+    metrics.add_source("cache", cache.stats)
+    history.close()
+    cache.close()
+
+    assert metrics.summary()["sources"] == {"history": {}, "cache": {}}
@@ -0,0 +1,89 @@
+import itertools
+import time
+
+from prompt_history import PromptHistory, read_file_history
+
+LEGACY = """
+# 2023-05-01 10:00:00.000000
++first prompt
+
+# 2023-05-02 10:00:00.000000
++a prompt
++on two lines
+
+# not a date
++dated like the previous one
+"""
+
+
+def test_repeated_prompt_is_stored_once(tmp_path, monkeypatch):
+    clock = itertools.count(1000)
+    monkeypatch.setattr(time, "time", lambda: next(clock))
+    history = PromptHistory(tmp_path / "history.sqlite")
+
+    for prompt in ("one", "two", "one"):
+        history.store_string(prompt)
+
+    assert list(history.load_history_strings()) == ["one", "two"]
+    history.close()
+
+
+def test_least_recently_used_prompts_are_evicted(tmp_path, monkeypatch):
+    clock = itertools.count(1000)
+    monkeypatch.setattr(time, "time", lambda: next(clock))
+    history = PromptHistory(tmp_path / "history.sqlite", max_entries=2)
+
+    for prompt in ("one", "two", "one", "three"):
+        history.store_string(prompt)
+
+    assert list(history.load_history_strings()) == ["three", "one"]
+    assert history.stats() == {"entries": 2, "bytes": 8}
+    history.close()
+
+
+def test_search_matches_literally(tmp_path):
+    history = PromptHistory(tmp_path / "history.sqlite")
+    for prompt in ("100% sure", "100 percent", "git status"):
+        history.store_string(prompt)
+
+    assert history.search("0% s") == ["100% sure"]
+    assert history.search("GIT", prefix=True) == ["git status"]
+    assert history.search("status", prefix=True) == []
+    history.close()
+
+
+def test_legacy_history_is_read(tmp_path):
+    path = tmp_path / ".history"
+    path.write_text(LEGACY, encoding="utf-8")
+
+    entries = list(read_file_history(path))
+
+    assert [text for text, _ in entries] == [
+        "first prompt",
+        "a prompt\non two lines",
+        "dated like the previous one",
+    ]
+    assert entries[0][1] < entries[1][1] == entries[2][1]
+
+
+def test_legacy_history_is_migrated_once(tmp_path):
+    path = tmp_path / ".history"
+    path.write_text(LEGACY, encoding="utf-8")
+    history = PromptHistory(tmp_path / "history.sqlite", legacy_path=path)
+
+    assert list(history.load_history_strings()) == [
+        "dated like the previous one",
+        "a prompt\non two lines",
+        "first prompt",
+    ]
+    assert not path.exists()
+    assert (tmp_path / ".history.migrated").exists()
+    assert history.stats()["entries"] == 3
+    history.close()
+
+
+def test_closed_history_has_no_stats(tmp_path):
+    history = PromptHistory(tmp_path / "history.sqlite")
+    history.close()
+
+    assert history.stats() == {}
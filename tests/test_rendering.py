@@ -0,0 +1,108 @@
+from rendering import BlockSplitter, split_blocks
+
+
+def blocks(text: str) -> list:
+    return [(block.language, block.text) for block in split_blocks(text)]
+
+
+def test_blocks_end_at_blank_lines_except_in_code():
+    text = "Intro\nstill intro\n\n```python\na = 1\n\nb = 2\n```\n\nOutro"
+
+    assert blocks(text) == [
+        (None, "Intro\nstill intro"),
+        ("python", "a = 1\n\nb = 2"),
+        (None, "Outro"),
+    ]
+
+
+def test_fence_in_a_list_item():
+    text = "1. Install:\n\n    ```bash\n    pip install x\n\n    pip install y\n    ```"
+
+    assert blocks(text) == [(None, "1. Install:"), ("bash", "pip install x\n\npip install y")]
+
+
+def test_indented_fence_outside_a_list_is_text():
+    assert blocks("Text\n\n    ```\n    code") == [(None, "Text"), (None, "    ```\n    code")]
+
+
+def test_closing_fence_must_be_as_long():
+    assert blocks("````\n```\n````") == [("", "```")]
+
+
+def test_feed_returns_completed_blocks_only():
+    splitter = BlockSplitter()
+
+    assert splitter.feed("First para") == []
+    assert splitter.tail().text == "First para"
+    assert [b.text for b in splitter.feed("graph\n\n```sh\nls")] == ["First paragraph"]
+    assert splitter.tail().text == "ls"
+    assert splitter.tail().is_code
+    assert [(b.language, b.text) for b in splitter.close()] == [("sh", "ls")]
+
+
+def test_code_block_is_printed_in_parts_without_live():
+    from rich.console import Console
+
+    from rendering import Renderer, StreamView
+
+    console = Console(record=True, width=40, color_system=None)
+    view = StreamView(Renderer(console), console, live=False)
+
+    view.feed("Intro\n\n```python\nfirst = 1\n")
+    view.refresh()
+    assert "first = 1" in console.export_text(clear=False)
+
+    view.feed("second = 2\n")
+    view.refresh()
+    view.feed("```\n\nOutro\n")
+    view.close()
+
+    text = console.export_text()
+    assert text.count("first = 1") == 1
+    assert text.count("second = 2") == 1
+    assert text.index("Intro") < text.index("first") < text.index("second") < text.index("Outro")
+
+
+def test_huge_code_block_only_shows_its_preview_without_live(tmp_path):
+    from rich.console import Console
+
+    from rendering import CODE_PREVIEW_LINES, Renderer, StreamView
+
+    console = Console(record=True, width=60, color_system=None)
+    view = StreamView(Renderer(console, code_folder=tmp_path), console, live=False)
+
+    view.feed("```python\n")
+    for i in range(600):
+        view.feed(f"line_{i} = {i}\n")
+        view.refresh()
+    view.feed("```\n")
+    view.close()
+
+    text = console.export_text()
+    assert text.count("line_") == CODE_PREVIEW_LINES
+    assert f"{600 - CODE_PREVIEW_LINES} more lines written to" in text
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_text_lines_are_printed_before_the_block_ends_without_live():
+    from rich.console import Console
+
+    from rendering import Renderer, StreamView
+
+    console = Console(record=True, width=60, color_system=None)
+    view = StreamView(Renderer(console), console, live=False)
+
+    view.feed("- first item\n- second")
+    view.refresh()
+    assert "first item" in console.export_text(clear=False)
+    assert "second" not in console.export_text(clear=False)
+
+    view.feed(" item\n\n| a | b |\n|---|---|\n")
+    view.refresh()
+    # The rows of a table are laid out together
+    assert "─" not in console.export_text(clear=False)
+
+    view.close()
+    text = console.export_text()
+    assert text.count("first item") == 1
+    assert text.count("second item") == 1
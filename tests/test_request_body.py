@@ -0,0 +1,61 @@
+import json
+
+from request_body import RequestEncoder
+
+
+def conversation(name: str, turns: int) -> list:
+    return [{"role": "user", "content": f"{name} {turn}"} for turn in range(turns)]
+
+
+def test_encoding_matches_json():
+    encoder = RequestEncoder()
+    body = {"model": "gpt-4", "messages": conversation("a", 3), "temperature": 0.5}
+
+    assert json.loads(encoder.encode(body)) == body
+    assert json.loads(encoder.encode({"messages": []})) == {"messages": []}
+
+
+def test_messages_are_encoded_once():
+    encoder = RequestEncoder()
+    messages = conversation("a", 2)
+    encoder.encode({"messages": messages})
+
+    messages.append({"role": "assistant", "content": "b"})
+    encoder.encode({"messages": messages})
+
+    assert encoder.stats() == {"reused": 2, "encoded": 3}
+
+
+def test_changed_message_is_encoded_again():
+    encoder = RequestEncoder()
+    messages = conversation("a", 1)
+    encoder.encode({"messages": messages})
+
+    messages[0]["content"] = "changed"
+
+    assert json.loads(encoder.encode({"messages": messages}))["messages"][0]["content"] == "changed"
+    assert encoder.stats() == {"reused": 0, "encoded": 2}
+
+
+def test_conversations_dont_evict_each_other():
+    encoder = RequestEncoder()
+    first, second = conversation("a", 3), conversation("b", 3)
+
+    for _ in range(2):
+        encoder.encode({"messages": first})
+        encoder.encode({"messages": second})
+
+    assert encoder.stats() == {"reused": 6, "encoded": 6}
+
+
+def test_least_recently_sent_fragments_are_dropped():
+    encoder = RequestEncoder(max_fragments=3)
+    first, second = conversation("a", 2), conversation("b", 2)
+
+    encoder.encode({"messages": first})
+    encoder.encode({"messages": second})
+    encoder.encode({"messages": second})
+    encoder.encode({"messages": first})
+
+    # The first message of the first conversation was dropped, the second one was kept
+    assert encoder.stats() == {"reused": 3, "encoded": 5}
@@ -0,0 +1,141 @@
+import io
+import os
+import subprocess
+import sys
+
+import pytest
+
+from context_window import count_tokens
+from retrieval import MAX_FILE_BYTES, ContextIndex, chunk_text, expand_paths
+
+
+@pytest.fixture
+def project(tmp_path):
+    (tmp_path / "main.py").write_text("print('hi')\n")
+    (tmp_path / ".env").write_text("OPENAI_API_KEY=secret\n")
+    (tmp_path / ".hidden").mkdir()
+    (tmp_path / ".hidden" / "notes.txt").write_text("hidden\n")
+    (tmp_path / "image.png").write_bytes(b"\x89PNG\0\0\0")
+    (tmp_path / "big.log").write_text("x" * (MAX_FILE_BYTES + 1))
+    return tmp_path
+
+
+def test_directories_skip_hidden_files(project):
+    files, skipped = expand_paths((str(project),))
+
+    assert files == [project / "main.py"]
+    assert sorted((path.name, reason) for path, reason in skipped) == [
+        ("big.log", "over 1 MB"),
+        ("image.png", "binary"),
+    ]
+
+
+def test_files_given_by_name_are_not_capped(project):
+    files, skipped = expand_paths((str(project / "big.log"), str(project)))
+
+    assert project / "big.log" in files
+    assert [path.name for path, _ in skipped] == ["image.png"]
+
+
+def test_directories_skip_files_ignored_by_git(project):
+    subprocess.run(["git", "init", "-q", str(project)], check=True)
+    (project / ".gitignore").write_text("build/\n*.tmp\n")
+    (project / "build").mkdir()
+    (project / "build" / "out.py").write_text("generated\n")
+    (project / "scratch.tmp").write_text("scratch\n")
+
+    files, _ = expand_paths((str(project),))
+
+    assert files == [project / "main.py"]
+
+
+def test_patterns_must_match(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        expand_paths((str(tmp_path / "*.nothing"),))
+
+
+def test_chunk_text_splits_at_blank_lines():
+    paragraph = "".join(f"line {i} of the paragraph\n" for i in range(10))
+    text = paragraph + "\n" + paragraph + "\n\n" + paragraph
+
+    # Each paragraph is over half of a chunk, they end at the next blank line
+    chunks = chunk_text(text, chunk_tokens=80)
+    assert [(first, last) for first, last, _ in chunks] == [(1, 10), (11, 21), (22, 33)]
+    assert "".join(content for _, _, content in chunks) == text
+
+
+def test_chunk_text_cuts_long_paragraphs():
+    text = "".join(f"line {i}\n" for i in range(100))
+
+    chunks = chunk_text(text, chunk_tokens=20)
+    assert len(chunks) > 1
+    assert all(len(content) <= 80 for _, _, content in chunks)
+    assert chunks[-1][1] == 100
+    assert chunk_text("\n\n  \n") == []
+
+
+def test_index_skips_unchanged_files(tmp_path):
+    notes = tmp_path / "notes.txt"
+    notes.write_text("apples and pears\n")
+    other = tmp_path / "other.txt"
+    other.write_text("plums\n")
+    index = ContextIndex(tmp_path / "index.sqlite")
+
+    assert index.update([notes, other]) == 2
+    assert index.update([notes, other]) == 0
+
+    # Same content with a new modification time: the hash matches, nothing is re-chunked
+    os.utime(notes, (1, 1))
+    assert index.update([notes, other]) == 0
+    row = index._db.execute("SELECT mtime FROM files WHERE path = ?", (str(notes),)).fetchone()
+    assert row == (1,)
+
+    notes.write_text("apples and cherries\n")
+    assert index.update([notes, other]) == 1
+    assert [c["content"] for c in index.retrieve("cherries", 5, 1000)] == ["apples and cherries\n"]
+    index.close()
+
+    # The index persists between runs
+    index = ContextIndex(tmp_path / "index.sqlite")
+    assert index.update([notes, other]) == 0
+    index.close()
+
+
+def test_retrieve_respects_top_k_and_the_budget(tmp_path):
+    paths = []
+    for i in range(6):
+        path = tmp_path / f"file{i}.txt"
+        path.write_text(f"shared word, file number {i}\n" + "filler " * 40 * i)
+        paths.append(path)
+    index = ContextIndex(tmp_path / "index.sqlite")
+    index.update(paths)
+
+    assert len(index.retrieve("shared", 3, 100000)) == 3
+
+    # Only the selected files are searched
+    index.update(paths[:2])
+    assert {c["path"] for c in index.retrieve("shared", 10, 100000)} == {str(p) for p in paths[:2]}
+
+    index.update(paths)
+    budget = 100
+    chunks = index.retrieve("shared", 10, budget)
+    assert chunks and len(chunks) < 6
+    assert sum(count_tokens(c["content"]) for c in chunks) <= budget
+    assert index.retrieve("nothing matches", 10, budget) == []
+    index.close()
+
+
+def test_context_from_stdin(tmp_path, monkeypatch):
+    import main
+
+    notes = tmp_path / "notes.txt"
+    notes.write_text("from a file\n")
+    monkeypatch.setattr(main, "messages", [])
+    monkeypatch.setattr(main, "CONTEXT_INDEX_FILE", tmp_path / "index.sqlite")
+    monkeypatch.setattr(sys, "stdin", io.StringIO("from stdin\n"))
+
+    assert main.prepare_context(("-", str(notes)), {}) is None
+    assert main.messages == [
+        {"role": "system", "content": "from stdin\n"},
+        {"role": "system", "content": "from a file\n"},
+    ]
@@ -0,0 +1,85 @@
+import threading
+import time
+
+import pytest
+
+from benchmarks.mock_server import MockServer
+from client import APITimeoutError, ChatClient
+from scheduler import RequestScheduler
+
+BODY = {"model": "gpt-3.5-turbo", "messages": [{"role": "user", "content": "hi"}]}
+
+
+class FakeLines:
+    """
+    Stream of a single line, remembers whether it was closed
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        return iter([self.name])
+
+    def close(self) -> None:
+        self.closed.set()
+
+
+class SlowFirstClient:
+    """
+    Starts the first stream after a second, the next ones right away
+    """
+
+    last_timing = None
+
+    def __init__(self):
+        self.streams = []
+        self._lock = threading.Lock()
+
+    def reset_cancel(self) -> None:
+        pass
+
+    def stream(self, body: dict, timeout: float) -> FakeLines:
+        with self._lock:
+            lines = FakeLines(f"stream {len(self.streams)}")
+            self.streams.append(lines)
+        if lines.name == "stream 0":
+            time.sleep(1)
+        return lines
+
+
+def test_read_timeout_is_not_replaced_by_the_deadline():
+    with MockServer(latency=1) as server:
+        client = ChatClient(server.url, "key", read_timeout=0.2)
+        scheduler = RequestScheduler(client, max_retries=0, deadline=60)
+        start = time.monotonic()
+        with pytest.raises(APITimeoutError):
+            scheduler.chat(BODY)
+        assert time.monotonic() - start < 0.9
+        client.close()
+
+
+def test_stream_stops_at_the_deadline():
+    with MockServer(tokens=100, token_delay=0.05) as server:
+        client = ChatClient(server.url, "key")
+        lines = client.stream(dict(BODY, stream=True), timeout=0.5)
+        start = time.monotonic()
+        with pytest.raises(APITimeoutError):
+            for _ in lines:
+                pass
+        assert time.monotonic() - start < 2
+        client.close()
+
+
+def test_stream_is_hedged_until_it_starts():
+    client = SlowFirstClient()
+    scheduler = RequestScheduler(client, hedge=True, hedge_after=0.1)
+
+    lines = scheduler.stream(BODY)
+
+    assert list(lines) == ["stream 1"]
+    assert scheduler.stats()["hedges"] == 1
+    # The stream that lost the race is closed once it starts
+    assert client.streams[0].closed.wait(2)
+    scheduler.close()
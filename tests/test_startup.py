@@ -0,0 +1,56 @@
+import subprocess
+import sys
+from pathlib import Path
+from typing import Optional
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+# Only imported when first needed, see "Startup time" in the README
+DEFERRED_MODULES = ("prompt_toolkit", "requests", "httpx", "rich.markdown", "yaml", "tiktoken")
+# Written next to the script, the benchmark must leave the ones of the repo alone
+STATE_FILES = (".history.sqlite", ".history", ".cache.sqlite")
+
+
+def loaded_modules(module: str, candidates: tuple) -> list:
+    """
+    Import a module in a fresh interpreter and return which of the candidates it loaded
+    """
+    code = f"import sys, {module}; print(*[m for m in {candidates!r} if m in sys.modules])"
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    return result.stdout.split()
+
+
+def state(path: Path) -> Optional[tuple]:
+    """
+    Modification time and size of a file, None when it doesn't exist
+    """
+    if not path.exists():
+        return None
+    stat = path.stat()
+    return stat.st_mtime_ns, stat.st_size
+
+
+@pytest.mark.parametrize("module", ["main", "main_improved"])
+def test_heavy_modules_are_deferred(module):
+    assert loaded_modules(module, DEFERRED_MODULES) == []
+
+
+def test_thin_client_only_imports_the_standard_library():
+    assert loaded_modules("ask", DEFERRED_MODULES + ("click", "rich")) == []
+
+
+@pytest.mark.parametrize("script", ["main.py", "main_improved.py"])
+def test_startup_within_budget(script):
+    before = {name: state(ROOT / name) for name in STATE_FILES}
+    # The budgets are the defaults of the benchmark, which exits with 1 when one is exceeded
+    result = subprocess.run(
+        [sys.executable, str(ROOT / "benchmarks" / "startup.py"), "--script", script, "--runs", "3"],
+        capture_output=True,
+        text=True,
+        timeout=120,
+    )
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert {name: state(ROOT / name) for name in STATE_FILES} == before
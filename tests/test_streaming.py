@@ -0,0 +1,40 @@
+import json
+
+import pytest
+
+from streaming import estimate_usage, iter_sse_events
+
+
+def sse(*events) -> list:
+    return [f"data: {json.dumps(event)}".encode("utf-8") for event in events]
+
+
+def test_events_are_parsed_until_done():
+    lines = [
+        b": keep-alive",
+        b"",
+        *sse({"choices": [{"delta": {"content": "Hel"}}]}),
+        b"event: message",
+        "data:{\"choices\": [{\"delta\": {\"content\": \"lo\"}}]}",
+        b"data: [DONE]",
+        *sse({"after": "done"}),
+    ]
+    timing = {"parse": 0.0}
+
+    events = list(iter_sse_events(lines, timing))
+
+    assert [e["choices"][0]["delta"]["content"] for e in events] == ["Hel", "lo"]
+    assert timing["parse"] > 0
+
+
+def test_invalid_event_raises():
+    with pytest.raises(ValueError):
+        list(iter_sse_events([b"data: {not json"]))
+
+
+def test_usage_is_estimated_without_a_report():
+    usage = estimate_usage([{"role": "user", "content": "How are you?"}], "Fine, thanks.")
+
+    assert usage["prompt_tokens"] > 0
+    assert usage["completion_tokens"] > 0
+    assert usage["total_tokens"] == usage["prompt_tokens"] + usage["completion_tokens"]